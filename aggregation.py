@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+# Columns of the session log holding the identifiers at each level of the dropdown selection values (0 being the grand
+# total, 1 the activity group and 2 the activity name)
+LEVEL_COLUMNS = {1: 'Activity group', 2: 'Activity name'}
+
+
+def split_selection(value):
+    """
+    The values in the timeseries dropdown are the identifier with the level appended as the last character, e.g.
+    'Climbing2'. Returns the identifier and the level as a tuple
+
+    """
+    return value[:-1], int(value[-1])
+
+
+def day_values(dates):
+    """
+    Converts dates to numpy day values (datetime64[D]), dropping any time of day
+
+    """
+    return pd.DatetimeIndex(dates).normalize().values.astype('datetime64[D]')
+
+
+def day_numbers(dates):
+    """
+    Converts dates to int32 day numbers (days since 1970-01-01), dropping any time of day
+
+    """
+    return day_values(dates).astype(np.int32)
+
+
+def day_positions(dates, date_list):
+    """
+    For each date returns the position of that day in date_list. Dates before the first day are put on the first day
+    (so that cumulative sums include everything logged before the start) and dates after the last day get position
+    len(date_list), i.e. they fall outside of the range
+
+    """
+    return date_list.searchsorted(pd.DatetimeIndex(dates).normalize(), side='left')
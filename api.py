@@ -0,0 +1,197 @@
+import hashlib
+
+import flask
+import pandas as pd
+
+from aggregation import split_selection
+from figures import GRANULARITIES, period_ends
+from goal_evaluation import cumulative_goal_counts, goals_in_period
+from instrumentation import timed
+from storage import SqliteBackend
+
+# Number of sessions or goals on a page of the API responses unless another page size is asked for, and the largest
+# page size that can be asked for
+API_PAGE_SIZE = 100
+MAX_API_PAGE_SIZE = 1000
+
+# The sessions and goals are sent with the same field names as the columns of the SQLite database
+SESSION_FIELDS = dict(SqliteBackend.session_column_map, Keywords='keywords')
+GOAL_FIELDS = dict(SqliteBackend.goal_column_map, Progress='progress', Satisfied='satisfied', Finalized='finalized')
+
+
+def _day_argument(name, default=None):
+    value = flask.request.args.get(name)
+    if not value:
+        return default
+    try:
+        return pd.Timestamp(value).normalize()
+    except ValueError:
+        raise ValueError(f"'{name}' is not a valid date: {value!r}")
+
+
+def _int_argument(name, default, minimum=1, maximum=None):
+    value = flask.request.args.get(name)
+    if not value:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"'{name}' is not a whole number: {value!r}")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"'{name}' has to be between {minimum} and {maximum}" if maximum is not None else
+                         f"'{name}' has to be at least {minimum}")
+    return value
+
+
+def _choice_argument(name, choices, default):
+    value = flask.request.args.get(name) or default
+    if value not in choices:
+        raise ValueError(f"'{name}' has to be one of {', '.join(choices)}")
+    return value
+
+
+def _json_value(value):
+    # Values of the frames as JSON values; days as ISO dates, missing values as null and numpy scalars as Python ones
+    if isinstance(value, list):
+        return value
+    if pd.isnull(value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d')
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _records(frame_df, fields, id_field):
+    return [dict({id_field: int(row_id)}, **{field: _json_value(value) for field, value in zip(fields.values(), row)})
+            for row_id, row in zip(frame_df.index, frame_df[list(fields)].itertuples(index=False))]
+
+
+def conditional_response(store, build_function):
+    """
+    Responds to a GET request with the JSON payload built by build_function, tagged with an ETag derived from the
+    version of the data, the request and the day. A client sending the ETag back in If-None-Match gets an empty
+    304 Not Modified as long as none of these have changed, which only takes looking up the version of the data.
+
+    The version is taken before the payload is built, so if the data changes in the meantime the client gets the newer
+    data with the older ETag, and fetches it once more on the next request rather than missing a change. Invalid
+    arguments (raised as ValueError) give a 400 response with the error message
+
+    """
+    try:
+        today = pd.Timestamp.today().normalize()
+        key = (store.version(), flask.request.path, sorted(flask.request.args.items(multi=True)), today)
+        etag = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        if flask.request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
+        else:
+            response = flask.jsonify(build_function(today))
+    except ValueError as error:
+        return flask.jsonify(error=str(error)), 400
+
+    response.set_etag(etag)
+    # Clients may keep the response, but have to check with the server before using it again
+    response.cache_control.no_cache = True
+    return response
+
+
+def sessions_payload(store, today):
+    """
+    One page of the sessions, newest first, optionally only those logged from the 'start' to the 'end' day
+
+    """
+    first_day, last_day = _day_argument('start'), _day_argument('end')
+    page = _int_argument('page', 1)
+    page_size = _int_argument('page_size', API_PAGE_SIZE, maximum=MAX_API_PAGE_SIZE)
+
+    page_df, page_count = store.session_page(page, page_size, first_day, last_day)
+
+    return {'page': min(page, page_count), 'page_count': page_count,
+            'sessions': _records(page_df, SESSION_FIELDS, 'session_id')}
+
+
+def goals_payload(store, today):
+    """
+    One page of the goals in the 'period' (active, past or future, see goal_evaluation.goals_in_period) along with
+    their progress, ordered by end date. With 'start' and 'end' only the goals whose window overlaps those days are
+    listed
+
+    """
+    period = _choice_argument('period', ('active', 'past', 'future'), 'active')
+    first_day, last_day = _day_argument('start'), _day_argument('end')
+    page = _int_argument('page', 1)
+    page_size = _int_argument('page_size', API_PAGE_SIZE, maximum=MAX_API_PAGE_SIZE)
+
+    goals_df = store.goal_status().sort_values('End date', kind='stable')
+    selected = goals_in_period(goals_df, period, today)
+    if first_day is not None:
+        selected &= goals_df['End date'] >= first_day
+    if last_day is not None:
+        selected &= goals_df['Start date'] <= last_day
+    goals_df = goals_df[selected]
+
+    page_count = max(1, -(-goals_df.shape[0] // page_size))
+    page = min(page, page_count)
+    goals_df = goals_df.iloc[(page - 1) * page_size:page * page_size]
+    goals_df['Identifier'] = goals_df['Identifier'].astype(object)
+    goals_df['Condition type'] = goals_df['Condition type'].astype(object)
+
+    return {'period': period, 'page': page, 'page_count': page_count,
+            'goals': _records(goals_df, GOAL_FIELDS, 'goal_id')}
+
+
+def series_payload(store, today, first_graph_day):
+    """
+    Cumulative series for the selected 'keys' (values of the timeseries dropdown, e.g. 'Climbing2'); the number of
+    sessions logged, and the number of goals ended and satisfied, up to and including the end of each period from the
+    'start' to the 'end' day. The periods are days, weeks or months depending on the 'granularity'
+
+    """
+    keys = [key for key in flask.request.args.get('keys', 'Total0').split(',') if key]
+    for key in keys:
+        if len(key) < 2 or not key[-1].isdigit() or int(key[-1]) > 3:
+            raise ValueError(f"'keys' has to hold dropdown values such as 'Climbing2', not {key!r}")
+    start, end = _day_argument('start', pd.Timestamp(first_graph_day)), _day_argument('end', today)
+    granularity = _choice_argument('granularity', list(GRANULARITIES), 'daily')
+
+    date_list = period_ends(start, end, granularity)
+    session_counts = store.rollup().cumulative_counts(keys, date_list)
+    goals_df = store.goal_status()
+
+    goals = {}
+    for key in keys:
+        identifier, level = split_selection(key)
+        ended, satisfied = cumulative_goal_counts(goals_df, date_list, None if level == 0 else identifier)
+        goals[key] = {'ended': ended.tolist(), 'satisfied': satisfied.tolist()}
+
+    return {'granularity': granularity, 'dates': list(date_list.strftime('%Y-%m-%d')),
+            'sessions': {key: session_counts[key].tolist() for key in keys}, 'goals': goals}
+
+
+def init_api(server, store_for_request, first_graph_day):
+    """
+    Adds the read-only JSON API to the Flask server of the app, serving the sessions (/api/sessions), the goals and
+    their progress (/api/goals) and the cumulative series of the graphs (/api/series) from the same data and evaluation
+    as the callbacks. store_for_request returns the data store of the current request, or None if the request may not
+    be served. The graph series start at first_graph_day unless another start is asked for
+
+    """
+    def respond(build_function):
+        store = store_for_request()
+        if store is None:
+            return flask.jsonify(error='Invalid user'), 400
+        return conditional_response(store, lambda today: build_function(store, today))
+
+    @server.route('/api/sessions')
+    @timed
+    def api_sessions():
+        return respond(sessions_payload)
+
+    @server.route('/api/goals')
+    @timed
+    def api_goals():
+        return respond(goals_payload)
+
+    @server.route('/api/series')
+    @timed
+    def api_series():
+        return respond(lambda store, today: series_payload(store, today, first_graph_day))
@@ -1,13 +1,186 @@
-from dash import Dash, html, dcc, Input, Output, State
+from dash import Dash, html, dcc, Input, Output, State, ClientsideFunction, callback_context, no_update
+from dash.exceptions import MissingCallbackContextException, PreventUpdate
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
 from plotly.colors import DEFAULT_PLOTLY_COLORS
 import datetime as dt
+import os
+import flask
+import numpy as np
 import pandas as pd
-import ast
+from api import init_api
+from data_store import USER_PATTERN, store, user_stores
+from figures import MAX_POINTS, USE_WEBGL, encode_matrix, period_ends, scatter, step_points, visible_range
+from goal_evaluation import cumulative_goal_counts, goals_in_period
+from instrumentation import init_app, phase, timed
+from memo_cache import CACHE_DIR, MemoCache
+from taxonomy import SUBACTIVITIES, HIGHLIGHTS
+
+# Number of sessions shown on each page of the activity log, and of goals on each page of the goal log
+LOG_PAGE_SIZE = 15
+
+# When the app serves many users (see PRODUCTIVITY_USERS_DIR in data_store), the user of each request is taken from
+# this header. It has to be set by an authenticating reverse proxy in front of the app, never by the browser. Requests
+# without it get the data of the default user
+USER_HEADER = os.environ.get('PRODUCTIVITY_USER_HEADER', 'X-Forwarded-User')
+DEFAULT_USER = 'default'
+
+# First day shown in the graphs unless another window is picked. The pace lines towards the yearly goals start here
+FIRST_GRAPH_DAY = '2025-01-01'
+
+# Labels for the visualisations. Number in the value is to indiciate the "level" at which the label is (activity,
+# subacitivity, etc - 0 for grand total)
+TIMESERIES_OPTIONS = [{'label': 'Total', 'value': 'Total0'},
+                      {'label': 'Exercise', 'value': 'Exercise1'},
+                      {'label': 'Self-development', 'value': 'Technical1'},
+                      {'label': 'Culture', 'value': 'Culture1'},
+                      {'label': 'Climbing', 'value': 'Climbing2'},
+                      {'label': 'Running', 'value': 'Running2'},
+                      {'label': 'Strength', 'value': 'Strength2'},
+                      {'label': 'Cross-country skiing', 'value': 'Cross-country skiing2'},
+                      {'label': 'Cycling', 'value': 'Cycling2'},
+                      {'label': 'Technical skills', 'value': 'Technical skills2'},
+                      {'label': 'Reading', 'value': 'Reading2'},
+                      {'label': 'Languages', 'value': 'Languages2'}]
+
+# We don't want the colors in the timeseries graph to change whenever we add or remove a label from the dropdown so we
+# hardcode the desired color codes here. They are handed out in order of selection
+TRACE_COLORS = ['#636efa', '#EF553B', '#00cc96', '#ab63fa', '#FFA15A', '#19d3f3', '#FF6692', '#B6E880', '#FF97FF',
+                '#FECB52'] #DEFAULT_PLOTLY_COLORS
+
+# Want to define this elsewhere in the long term, but a quick way to add yearly goals for number of session. We can
+# then plot an indication of how progress should be throughout the year
+YEARLY_SESSION_GOALS = {'Climbing2': 85, 'Running2': 60, 'Strength2': 60}
+
+TIMESERIES_LAYOUT = dict(
+    margin=dict(l=0, r=0, t=30, b=0),  # Left, Right, Top, Bottom
+    xaxis_title="Date",
+    yaxis_title="Session count",
+    #plot_bgcolor="#343a40",  # Dark background
+    paper_bgcolor="#272b30",
+    font=dict(color="#f8f9fa"),
+    # Keeps the zoom when the figure is updated with the points for the new range
+    uirevision='timeseries',
+    legend=dict(
+        x=0.05,  # Horizontal position (0: left, 1: right)
+        y=0.95,  # Vertical position (0: bottom, 1: top)
+        xanchor='left',  # Align legend box's right side at x
+        yanchor='top',  # Align legend box's top side at y
+        bgcolor='#343a40',  # Optional: Semi-transparent white background
+    )
+)
+
+# The callbacks evaluating goals and counting sessions can be run as Dash background callbacks, in a separate process
+# per call, so that they don't hold up a web worker while other requests (saving a session, loading the page) wait.
+# This is switched on by setting PRODUCTIVITY_BACKGROUND_DIR to a directory for the job results, and needs the
+# diskcache extra of Dash (pip install "dash[diskcache]")
+BACKGROUND_DIR = os.environ.get('PRODUCTIVITY_BACKGROUND_DIR')
+if BACKGROUND_DIR:
+    import diskcache
+    from dash import DiskcacheManager
+    background_manager = DiskcacheManager(diskcache.Cache(os.path.join(BACKGROUND_DIR, 'jobs')))
+else:
+    background_manager = None
 
 # Initialising the dash app, with the SLATE theme to get a nice dark mode layout
 app = Dash(external_stylesheets=[dbc.themes.SLATE])
+# The underlying Flask server, for serving the app with a WSGI server such as gunicorn (gunicorn -w 4 app:server)
+server = app.server
+# Time spent in each phase of the callbacks is recorded, and served on /metrics
+init_app(server)
+
+# Results of the callbacks that only depend on the data and their inputs, see memo_cache for the settings. Background
+# jobs run in their own process, so their results are only kept if the cache has a disk tier; one is set up next to
+# the job results if no cache directory was given
+callback_cache = MemoCache(directory=CACHE_DIR or (os.path.join(BACKGROUND_DIR, 'results') if BACKGROUND_DIR else None))
+
+
+def request_user(headers):
+    """
+    Returns the user named in the user header of a request, the default user if the header is missing, or None if it
+    doesn't hold a valid user name
+
+    """
+    user = next((value for name, value in headers.items() if name.lower() == USER_HEADER.lower()), None)
+    if not user:
+        return DEFAULT_USER
+    return user if USER_PATTERN.fullmatch(user) else None
+
+
+def current_user():
+    """
+    Returns the user of the callback being run, from the user header of the request. Outside of a callback (e.g. when
+    a callback function is called directly) this is the default user
+
+    """
+    try:
+        headers = callback_context.headers
+    except MissingCallbackContextException:
+        return DEFAULT_USER
+    user = request_user(headers)
+    if user is None:
+        raise PreventUpdate
+    return user
+
+
+def user_store(user):
+    # The store of the user when the app serves many users, otherwise the shared store
+    return user_stores.get(user) if user_stores is not None else store
+
+
+def current_store():
+    """
+    Returns the data store the callback being run works on; the store of the current user when the app serves many
+    users, otherwise the shared store. The user is looked up for every call, which also works in background callbacks
+    as Dash passes the request headers along to them
+
+    """
+    return user_store(current_user())
+
+
+def request_store():
+    # The data store an API request works on, or None if the user header is invalid
+    user = request_user(flask.request.headers)
+    return None if user is None else user_store(user)
+
+
+# Read-only JSON API serving the sessions, goals and graph series from the same data as the callbacks, see api.py
+init_api(server, request_store, FIRST_GRAPH_DAY)
+
+
+def no_progress(done, total):
+    # Progress reporter used when a heavy callback runs as a regular callback, or is called directly
+    pass
+
+
+def heavy_callback(*dependencies, progress_bar):
+    """
+    Decorator registering a callback that does heavy computations. When background callbacks are switched on it runs
+    as a background job, which reports its progress on the progress bar with the given ID. The function is then called
+    with a set_progress keyword argument, taking the number of steps done and the total number of steps. Otherwise it
+    is registered as a regular callback and the progress bar stays hidden
+
+    Dash stops the job of a callback when the callback is triggered again (e.g. the selection changes) before the job
+    has finished, so stale results are never computed to the end
+
+    """
+    def decorator(function):
+        if background_manager is None:
+            app.callback(*dependencies)(function)
+            return function
+
+        def background_function(set_progress, *args):
+            return function(*args, set_progress=lambda done, total: set_progress((done, total)))
+
+        app.callback(*dependencies,
+                     background=True,
+                     manager=background_manager,
+                     progress=[Output(progress_bar, 'value'), Output(progress_bar, 'max')],
+                     running=[(Output(progress_bar, 'style'), {'height': '3px'}, {'display': 'none'})],
+                     interval=250)(background_function)
+        return function
+
+    return decorator
 
 # Layout for the dash app
 app.layout = dbc.Container(children=[
@@ -46,8 +219,19 @@ app.layout = dbc.Container(children=[
                                         ],
                               width=4,
                               ),
-                      # Block for visualising the logged activities
-                      dbc.Col(children=[html.H2('My log')],
+                      # Block for visualising the logged activities. Only one page of the log is shown at a time
+                      dbc.Col(children=[html.H2('My log',
+                                                className="d-flex justify-content-center align-items-center"),
+                                        dbc.Row(children=[dbc.Col('Activity', style={"font-weight": "bold"}),
+                                                          dbc.Col('Activity group', style={"font-weight": "bold"}),
+                                                          dbc.Col('Date', style={"font-weight": "bold"})]),
+                                        html.Div(id='Log-rows'),
+                                        dbc.Pagination(id='Log-pagination',
+                                                       max_value=1,
+                                                       active_page=1,
+                                                       fully_expanded=False,
+                                                       size='sm',
+                                                       className="d-flex justify-content-center")],
                               id='Log-col',
                               width=4,
                               style={'height': '100%',
@@ -71,476 +255,362 @@ app.layout = dbc.Container(children=[
                                                           dbc.Col('Start date', style={"font-weight": "bold"}),
                                                           dbc.Col('End date', style={"font-weight": "bold"}),
                                                           dbc.Col('Progress', style={"font-weight": "bold"})]),
-                                        dbc.Row(dbc.Col(id='goals-log'))],
+                                        dbc.Row(dbc.Col(id='goals-log')),
+                                        # Like the activity log, only one page of the goals is shown at a time
+                                        dbc.Pagination(id='goals-pagination',
+                                                       max_value=1,
+                                                       active_page=1,
+                                                       fully_expanded=False,
+                                                       size='sm',
+                                                       className="d-flex justify-content-center")],
                               id='Active-goals-col',
                               style={'height': '100%',
-                                     'overflow-y': 'auto'}),
-                      # Dummy col used to initiate callback chains when saving a new session
-                      dbc.Col(id='Temp-log-initiator',
-                              style={'display': 'none'},
-                              width=0)],
+                                     'overflow-y': 'auto'})],
             style={'height': '45vh'}
             ),
-    # Dropwdown menu for selecting labels for the visualisations. Number in the value is to indiciate the "level" at
-    # which the label is (activity, subacitivity, etc - 0 for grand total)
-    dbc.Row(children=[dbc.Col(dcc.Dropdown([{'label': 'Total', 'value': 'Total0'},
-                                            {'label': 'Exercise', 'value': 'Exercise1'},
-                                            {'label': 'Self-development', 'value': 'Technical1'},
-                                            {'label': 'Culture', 'value': 'Culture1'},
-                                            {'label': 'Climbing', 'value': 'Climbing2'},
-                                            {'label': 'Running', 'value': 'Running2'},
-                                            {'label': 'Strength', 'value': 'Strength2'},
-                                            {'label': 'Cross-country skiing', 'value': 'Cross-country skiing2'},
-                                            {'label': 'Cycling', 'value': 'Cycling2'},
-                                            {'label': 'Technical skills', 'value': 'Technical skills2'},
-                                            {'label': 'Reading', 'value': 'Reading2'},
-                                            {'label': 'Languages', 'value': 'Languages2'}],
+    # Dropwdown menu for selecting labels for the visualisations
+    # along with the window of dates shown in the graphs (up to today if no end date is picked) and whether the graphs
+    # are plotted per day, week or month
+    dbc.Row(children=[dbc.Col(dcc.Dropdown(TIMESERIES_OPTIONS,
                                            ['Climbing2', 'Running2', 'Strength2'],
                                            multi=True,
-                                           id='timeseries-selection-dropdown'))],
+                                           id='timeseries-selection-dropdown'),
+                              width=6),
+                      dbc.Col(dcc.DatePickerRange(display_format='DD/MM/YYYY',
+                                                  start_date=FIRST_GRAPH_DAY,
+                                                  clearable=True,
+                                                  id='graph-date-range'),
+                              width='auto'),
+                      dbc.Col(dbc.RadioItems(options=[{'label': 'Daily', 'value': 'daily'},
+                                                      {'label': 'Weekly', 'value': 'weekly'},
+                                                      {'label': 'Monthly', 'value': 'monthly'}],
+                                             value='daily',
+                                             inline=True,
+                                             id='graph-granularity'),
+                              width='auto',
+                              className='d-flex align-items-center')],
             style={'margin-top': '5vh'}),
-    dbc.Row(children=[dbc.Col(children=[dcc.Graph(id='timeseries-graph')], width=6),
-                      dbc.Col(children=[dcc.Graph(id='goal-reaching-graph')], width=6)],
+    # The progress bars are only shown while the graphs are computed in background callbacks
+    dbc.Row(children=[dbc.Col(children=[dbc.Progress(id='timeseries-progress', style={'display': 'none'}),
+                                        dcc.Graph(id='timeseries-graph')], width=6),
+                      dbc.Col(children=[dbc.Progress(id='goals-progress', style={'display': 'none'}),
+                                        dcc.Graph(id='goal-reaching-graph')], width=6)],
             id='graph-row',
             style={'height': '35vh', 'padding': '0', 'margin': '0', 'margin-bottom': '15vh'}
             ),
-    dcc.Location(id='date-picker-updater', refresh=False)
+    dcc.Location(id='date-picker-updater', refresh=False),
+    # Token identifying the version of the data. Saving a session updates it, which initiates the callback chains
+    # updating the log, goals and graphs
+    dcc.Store(id='data-version'),
+    # Daily session counts the timeseries graph is built from in the browser
+    dcc.Store(id='timeseries-counts')
 ], fluid=True
 )
 
 @app.callback(Output('Session-calendar', 'date'),
               Input('date-picker-updater', 'pathname'))
+@timed
 def update_calendar_date(_):
     return dt.date.today()
 
-@app.callback(
+@heavy_callback(
     Output('goal-reaching-graph', 'figure'),
-    Input('Log-col', 'children'), Input('timeseries-selection-dropdown', 'value')
+    Input('data-version', 'data'), Input('timeseries-selection-dropdown', 'value'),
+    Input('goal-reaching-graph', 'relayoutData'),
+    Input('graph-date-range', 'start_date'), Input('graph-date-range', 'end_date'),
+    Input('graph-granularity', 'value'),
+    progress_bar='goals-progress'
 )
-def plot_goals_graph(_, selection):
+@timed
+def plot_goals_graph(_, selection, relayout_data=None, start_date=None, end_date=None, granularity='daily',
+                     set_progress=no_progress):
     """
-    Callback function for updating the figure visualising the satisfaction of periodic goals.  Using the log col as
-    an input means that this will be updated everytime a new activity is logged
+    Callback function for updating the figure visualising the satisfaction of periodic goals.  Using the data version as
+    an input means that this will be updated everytime a new activity is logged. The figure is also updated when
+    zooming, so that only the points within the visible range are sent. Progress is reported per selected value
 
     """
-    # Start by reading in data files
-    my_goals_df = pd.read_csv('Period_goals.csv', index_col=0)
-    my_sessions_df = pd.read_csv('Session_log.csv', index_col=0)
+    # The figure is cached for each version of the data (which differs per user), set of selected values, zoom range,
+    # window, granularity and day. The traces are built in a fixed order, and then put in the order of the selection so
+    # that they get the same colors as before
+    store = current_store()
+    selection = selection or []
+    categories = sorted(set(selection))
+    x_range = visible_range(relayout_data)
+    today = pd.Timestamp.today().normalize()
+    start, end = graph_window(start_date, end_date, today)
+    figure = callback_cache.get_or_compute(
+        ('plot_goals_graph', store.version(), tuple(categories), x_range, start, end, granularity, today),
+        lambda: goals_figure(store, categories, x_range, period_ends(start, end, granularity), set_progress))
 
-    # Convert time columns to datetime objects
-    my_goals_df['Start date'] = pd.to_datetime(my_goals_df['Start date'])
-    my_goals_df['End date'] = pd.to_datetime(my_goals_df['End date'])
+    traces = dict(zip(categories, figure['data']))
+    return {'data': [traces[category] for category in selection], 'layout': figure['layout']}
 
-    # Create a new column "Satisfied" initiated to False that will be updated to indicate whether a particular goals
-    # was satisfied
-    my_goals_df['Satisfied'] = False
-    my_goals_df['Satisfied'] = my_goals_df['Satisfied'].astype(bool)
+def graph_window(start_date, end_date, today):
+    """
+    First and last day shown in the graphs, from the dates picked in the date range. Without a start date the graphs
+    start at FIRST_GRAPH_DAY, and without an end date they run up to today
 
-    my_sessions_df['Date'] = pd.to_datetime(my_sessions_df['Date'])
-    # The keywords were populated as a list, when reading in the CSV file again we have to translate a list-like string
-    # back to an actual list
-    my_sessions_df['Keywords'] = my_sessions_df['Keywords'].apply(
-        lambda x: ast.literal_eval(x) if pd.notnull(x) else [])
+    """
+    start = pd.Timestamp(start_date or FIRST_GRAPH_DAY).normalize()
+    end = pd.Timestamp(end_date).normalize() if end_date else today
+    return start, end
 
-    my_sessions_df.sort_values('Date', ascending=False, inplace=True)
+def goals_figure(store, categories, x_range, date_list, set_progress=no_progress):
+    """
+    Builds the figure visualising the satisfaction of periodic goals in a data store for the selected categories,
+    returned as a dict with one trace per category in the same order. The fractions are taken at each day of
+    date_list, which are the ends of the periods plotted
 
-    date_list = pd.date_range(start='2025-01-01', end=pd.Timestamp.today())
-    categories = selection # selection is list of values from the dropdown menu
+    """
+    # Start by getting the goals from the store. Their status is materialised there, giving the number of
+    # sessions logged within each goal window ("Progress") and whether the target quantity was reached ("Satisfied").
+    # Condition type so far only allows 'Count'
+    step_count = len(categories) + 2
+    set_progress(0, step_count)
+    my_goals_df = store.goal_status()
+    set_progress(1, step_count)
 
     counter_lists = {}
 
-    # We loop through all the goals in the dataframe, and evaluate the ones where the end date has already passed
-    # Condition type so far only allows 'Count', so we then check the sessions dataframe to see if the target quantity
-    # of sessions has been logged within the specified date range. The "Satisfied" column for the goal is then
-    # updated
-    for index, row in my_goals_df.iterrows():
-        if pd.Timestamp.today().normalize() >= row['End date']:
-            if row['Condition type'] == 'Count':
-                if row['Identifier level'] == 0:
-                    pass
-                elif row['Identifier level'] == 1:
-                    relevant_df = my_sessions_df.loc[((my_sessions_df['Date'] >= row['Start date']) &
-                                                     (my_sessions_df['Date'] <= row['End date']) &
-                                                     (my_sessions_df['Activity group'] == row['Identifier']))]
-
-                    active_count = relevant_df.shape[0]
-                    target = row['Quantity']
-                    if active_count >= target:
-                        my_goals_df.at[index, 'Satisfied'] = True
-                elif row['Identifier level'] == 2:
-                    relevant_df = my_sessions_df.loc[((my_sessions_df['Date'] >= row['Start date']) &
-                                                     (my_sessions_df['Date'] <= row['End date']) &
-                                                     (my_sessions_df['Activity name'] == row['Identifier']))]
-
-                    active_count = relevant_df.shape[0]
-                    target = row['Quantity']
-                    if active_count >= target:
-                        my_goals_df.at[index, 'Satisfied'] = True
-                elif row['Identifier level'] == 3:
-                    # For the highlights, since these are lists we use DataFrame.apply() with a lambda function to see
-                    # if the specific identifier is in this list
-                    relevant_df = my_sessions_df.loc[((my_sessions_df['Date'] >= row['Start date']) &
-                                                     (my_sessions_df['Date'] <= row['End date']) &
-                                                     (my_sessions_df['Keywords'].apply(
-                                                         lambda x: row['Identifier'] in x if isinstance(x,
-                                                                                                        list) else False)))]
-
-                    active_count = relevant_df.shape[0]
-                    target = row['Quantity']
-                    if active_count >= target:
-                        my_goals_df.at[index, 'Satisfied'] = True
-        #print(my_goals_df.iloc[index])
-
-    # For plotting cumulative fractions of completed goals we then count satisfied and not satisfied goals. Slightly
-    # different logic is needed for categories at different levels (0 being grand total, 1 being activity, 2 being
-    # sub-activity, etc.)
-    for category in categories:
-        if category[-1] == '0':
-            counter_lists[category[:-1]] = [my_goals_df.loc[my_goals_df['End date'] <= date].shape[0] for date in date_list]
-            counter_lists[category[:-1] + ' - satisfied'] = [my_goals_df.loc[((my_goals_df['End date'] <= date) &
-                                                                              (my_goals_df['Satisfied']))].shape[0] for date in date_list]
-            counter_lists[category[:-1] + ' - not satisfied'] = [my_goals_df.loc[((my_goals_df['End date'] <= date) &
-                                                                                  (~my_goals_df['Satisfied']))].shape[0] for date in date_list]
-
-        elif category[-1] == '1':
-            counter_lists[category[:-1]] = [my_goals_df.loc[((my_goals_df['End date'] <= date) &
-                                                             my_goals_df['Identifier'] == category[:-1])].shape[0]
-                                            for date in date_list]
-            counter_lists[category[:-1] + ' - satisfied'] = [
-                my_goals_df.loc[((my_goals_df['End date'] <= date) &
-                                 (my_goals_df['Satisfied']) &
-                                 (my_goals_df['Identifier'] == category[:-1]))].shape[0] for date in date_list]
-            counter_lists[category[:-1] + ' - not satisfied'] = [
-                my_goals_df.loc[((my_goals_df['End date'] <= date) &
-                                 (~my_goals_df['Satisfied']) &
-                                 (my_goals_df['Identifier'] == category[:-1]))].shape[0] for date in date_list]
-        elif category[-1] == '2':
-            counter_lists[category[:-1]] = [my_goals_df.loc[((my_goals_df['End date'] <= date) &
-                                                             (my_goals_df['Identifier'] == category[:-1]))].shape[0]
-                                            for date in date_list]
-            counter_lists[category[:-1] + ' - satisfied'] = [
-                my_goals_df.loc[((my_goals_df['End date'] <= date) &
-                                 (my_goals_df['Satisfied']) &
-                                 (my_goals_df['Identifier'] == category[:-1]))].shape[0] for date in date_list]
-            counter_lists[category[:-1] + ' - not satisfied'] = [
-                my_goals_df.loc[((my_goals_df['End date'] <= date) &
-                                 (~my_goals_df['Satisfied']) &
-                                 (my_goals_df['Identifier'] == category[:-1]))].shape[0] for date in date_list]
-
-    # We now return the figure
-    figure_to_return = go.Figure()
-
-    for category in categories:
-        counter_lists[category[:-1] + ' - fraction'] = [1.0 if target == 0 else done / target for done, target in
-                                                        zip(counter_lists[category[:-1] + ' - satisfied'],
-                                                            counter_lists[category[:-1]])]
-        figure_to_return.add_trace(
-            go.Scatter(y=counter_lists[category[:-1] + ' - fraction'], x=date_list, name=category[:-1]))
-        #figure_to_return.add_trace(go.Scatter(y=counter_lists[category[:-1]], x=date_list, name=category[:-1] + ' - target'))
-        #figure_to_return.add_trace(go.Scatter(y=counter_lists[category[:-1] + ' - satisfied'], x=date_list, name=category[:-1] + ' - satisfied'))
-        #figure_to_return.add_trace(go.Scatter(y=counter_lists[category[:-1] + ' - not satisfied'], x=date_list, name=category[:-1] + ' - not satisfied'))
-
-    figure_to_return.update_layout(
-        margin=dict(l=0, r=0, t=30, b=0),  # Left, Right, Top, Bottom
-        xaxis_title="Date",
-        yaxis_title="Goal count",
-        # plot_bgcolor="#343a40",  # Dark background
-        paper_bgcolor="#272b30",
-        font=dict(color="#f8f9fa"),
-        yaxis_range=[-0.1, 1.1],
-        legend=dict(
-            x=0.05,  # Horizontal position (0: left, 1: right)
-            y=0.95,  # Vertical position (0: bottom, 1: top)
-            xanchor='left',  # Align legend box's right side at x
-            yanchor='top',  # Align legend box's top side at y
-            bgcolor='#343a40',  # Optional: Semi-transparent white background
+    # For plotting cumulative fractions of completed goals we then count goals that have ended on or before each date,
+    # and how many of these were satisfied, including the goals that ended before the window. For the grand total
+    # (level 0) all goals are counted, otherwise only the goals with the selected identifier
+    for position, category in enumerate(categories):
+        identifier = None if category[-1] == '0' else category[:-1]
+        counter_lists[category[:-1]], counter_lists[category[:-1] + ' - satisfied'] = cumulative_goal_counts(
+            my_goals_df, date_list, identifier)
+        counter_lists[category[:-1] + ' - not satisfied'] = (counter_lists[category[:-1]] -
+                                                             counter_lists[category[:-1] + ' - satisfied'])
+        set_progress(position + 2, step_count)
+
+    # We now build and return the figure
+    with phase('figure'):
+        figure_to_return = go.Figure()
+
+        for category in categories:
+            counter_lists[category[:-1] + ' - fraction'] = np.where(
+                counter_lists[category[:-1]] == 0, 1.0,
+                counter_lists[category[:-1] + ' - satisfied'] / np.maximum(counter_lists[category[:-1]], 1))
+            # The fraction only changes on days a goal ends, so only those days are plotted, as steps
+            x, y = step_points(date_list, counter_lists[category[:-1] + ' - fraction'], x_range)
+            figure_to_return.add_trace(scatter(y=y, x=x, name=category[:-1], line_shape='hv'))
+            #figure_to_return.add_trace(go.Scatter(y=counter_lists[category[:-1]], x=date_list, name=category[:-1] + ' - target'))
+            #figure_to_return.add_trace(go.Scatter(y=counter_lists[category[:-1] + ' - satisfied'], x=date_list, name=category[:-1] + ' - satisfied'))
+            #figure_to_return.add_trace(go.Scatter(y=counter_lists[category[:-1] + ' - not satisfied'], x=date_list, name=category[:-1] + ' - not satisfied'))
+
+        figure_to_return.update_layout(
+            margin=dict(l=0, r=0, t=30, b=0),  # Left, Right, Top, Bottom
+            xaxis_title="Date",
+            yaxis_title="Goal count",
+            # plot_bgcolor="#343a40",  # Dark background
+            paper_bgcolor="#272b30",
+            font=dict(color="#f8f9fa"),
+            yaxis_range=[-0.1, 1.1],
+            # Keeps the zoom when the figure is updated with the points for the new range
+            uirevision='goals',
+            legend=dict(
+                x=0.05,  # Horizontal position (0: left, 1: right)
+                y=0.95,  # Vertical position (0: bottom, 1: top)
+                xanchor='left',  # Align legend box's right side at x
+                yanchor='top',  # Align legend box's top side at y
+                bgcolor='#343a40',  # Optional: Semi-transparent white background
+            )
         )
-    )
 
-    return figure_to_return
+    set_progress(step_count, step_count)
+    return figure_to_return.to_plotly_json()
 
 @app.callback(Output('goals-log', 'children'),
-              Input('Log-col', 'children'), Input('goal-period-selector', 'value'))
-def goal_log_update(_, period):
+              Output('goals-pagination', 'max_value'),
+              Input('data-version', 'data'), Input('goal-period-selector', 'value'),
+              Input('goals-pagination', 'active_page'))
+@timed
+def goal_log_update(_, period, page=1):
     """
     Function to update the log of goals, especially in case new activities are logged or if the user switches between
-    past, active and future goals
+    past, active and future goals. Only the goals on the selected page are sent to the browser, ordered by end date.
+    Each page is cached for each version of the data, period and day, so switching back and forth between the periods
+    doesn't build it again
 
     """
-    list_to_return = []
-
-    my_goals_df = pd.read_csv('Period_goals.csv', index_col=0)
-    my_session_df = pd.read_csv('Session_log.csv', index_col=0)
-
-    my_goals_df['Start date'] = pd.to_datetime(my_goals_df['Start date'])
-    my_goals_df['End date'] = pd.to_datetime(my_goals_df['End date'])
-
-    my_session_df['Date'] = pd.to_datetime(my_session_df['Date'])
-
-    my_session_df['Keywords'] = my_session_df['Keywords'].apply(lambda x: ast.literal_eval(x) if pd.notnull(x) else [])
-
+    store = current_store()
     today = pd.Timestamp.today().normalize()
+    return callback_cache.get_or_compute(('goal_log_update', store.version(), period, page or 1, today),
+                                         lambda: goal_log(store, period, today, page or 1))
 
-    # We want to save dbc.Row() elements with the identifier name (maybe this should be a separate label actually),
-    # the date range and an indication of goal progress. Typically this is something like #achieved / #target
-    for index, row in my_goals_df.sort_values('End date').iterrows():
-        if ((period == 'active' and row['Start date'] <= today <= row['End date']) or
-                (period == 'past' and today >= row['End date']) or
-                (period == 'future' and today <= row['Start date'])):
-            if row['Condition type'] == 'Count':
-                if row['Identifier level'] == 0:
-                    pass
-                elif row['Identifier level'] == 1:
-                    relevant_df = my_session_df.loc[((my_session_df['Date'] >= row['Start date']) &
-                                                     (my_session_df['Date'] <= row['End date']) &
-                                                     (my_session_df['Activity group'] == row['Identifier']))]
-
-                    active_count = relevant_df.shape[0]
-                    target = row['Quantity']
-                    this_row = dbc.Row(children=[dbc.Col(row['Identifier']),
-                                                 dbc.Col(row['Start date'].strftime('%d-%m-%Y')),
-                                                 dbc.Col(row['End date'].strftime('%d-%m-%Y')),
-                                                 dbc.Col(str(active_count) + ' / ' + str(target))])
-                elif row['Identifier level'] == 2:
-                    relevant_df = my_session_df.loc[((my_session_df['Date'] >= row['Start date']) &
-                                                     (my_session_df['Date'] <= row['End date']) &
-                                                     (my_session_df['Activity name'] == row['Identifier']))]
-
-                    active_count = relevant_df.shape[0]
-                    target = row['Quantity']
-                    this_row = dbc.Row(children=[dbc.Col(row['Identifier']),
-                                                 dbc.Col(row['Start date'].strftime('%d-%m-%Y')),
-                                                 dbc.Col(row['End date'].strftime('%d-%m-%Y')),
-                                                 dbc.Col(str(active_count) + ' / ' + str(target))])
-                elif row['Identifier level'] == 3:
-                    relevant_df = my_session_df.loc[((my_session_df['Date'] >= row['Start date']) &
-                                                     (my_session_df['Date'] <= row['End date']) &
-                                                     (my_session_df['Keywords'].apply(lambda x: row['Identifier'] in x if isinstance(x, list) else False)))]
-
-                    active_count = relevant_df.shape[0]
-                    target = row['Quantity']
-                    this_row = dbc.Row(children=[dbc.Col(row['Identifier']),
-                                                 dbc.Col(row['Start date'].strftime('%d-%m-%Y')),
-                                                 dbc.Col(row['End date'].strftime('%d-%m-%Y')),
-                                                 dbc.Col(str(active_count) + ' / ' + str(target))])
-            list_to_return.append(this_row)
-
-    return list_to_return
-
-@app.callback(Output('timeseries-graph', 'figure'),
-              Input('Log-col', 'children'), Input('timeseries-selection-dropdown', 'value'))
-def update_timeseries_graph(_, selection):
+def goal_log(store, period, today, page):
     """
-    Callback function to update the logged activity timeseries. This is to indicate how well we are doing in terms of
-    reaching highlevel (yearly) goals in terms of number of sessions
+    Builds the rows of one page of the log of goals in a data store in the given period, along with the number of pages
 
     """
+    my_goals_df = store.goal_status()
+    period_df = my_goals_df[goals_in_period(my_goals_df, period, today)].sort_values('End date', kind='stable')
 
-    my_sessions_df = pd.read_csv('Session_log.csv', index_col=0)
-
-    my_sessions_df.sort_values('Date', ascending=False, inplace=True)
+    # Pages past the last one show the last page, as the number of goals in the period may have shrunk
+    page_count = max(1, -(-period_df.shape[0] // LOG_PAGE_SIZE))
+    start = (min(max(page, 1), page_count) - 1) * LOG_PAGE_SIZE
+    page_df = period_df.iloc[start:start + LOG_PAGE_SIZE]
 
-    date_list = pd.date_range(start='2025-01-01', end=pd.Timestamp.today())
-
-    counter_lists = {}
-    figure_to_return = go.Figure()
-    # We don't want the colors to change whenever we add or remove a label from the dropdown so we hardcode the
-    # desired color codes here
-    free_colors = ['#636efa', '#EF553B', '#00cc96', '#ab63fa', '#FFA15A', '#19d3f3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52'] #DEFAULT_PLOTLY_COLORS
-    my_color_map = {}
-
-    for selected in selection:
-        if selected[-1] == '0':
-            counter_lists[selected] = [my_sessions_df.loc[pd.to_datetime(my_sessions_df['Date']) <= date].shape[0] for date in date_list]
-        elif selected[-1] == '1':
-            counter_lists[selected] = [my_sessions_df.loc[(my_sessions_df['Activity group'] == selected[:-1]) &
-                                                          (pd.to_datetime(my_sessions_df['Date']) <= date)].shape[0] for
-                                       date in date_list]
-        else:
-            counter_lists[selected] = [my_sessions_df.loc[(my_sessions_df['Activity name'] == selected[:-1]) &
-                                                          (pd.to_datetime(my_sessions_df['Date']) <= date)].shape[0] for
-                                       date in date_list]
-
-        my_color_map[selected] = free_colors.pop(0)
-        if len(free_colors) == 0:
-            free_colors = ['#636efa', '#EF553B', '#00cc96', '#ab63fa', '#FFA15A', '#19d3f3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52']
-
-        figure_to_return.add_trace(go.Scatter(y=counter_lists[selected], x=date_list, name=selected[:-1],
-                                              line=dict(color=my_color_map[selected])))
-
-    # Want to define this elsewhere in the long term, but a quick way to add yearly goals for number of session
-    # We can then plot an indication of how progress should be throughout the year
-    climbing_session_goal = 85
-    running_session_goal = 60
-    strength_session_goal = 60
-
-    goal_date = pd.Timestamp.today()
-    full_date_list = pd.date_range(start='2025-01-01', end=goal_date)
-    climbing_goal_list = [climbing_session_goal * (i / 365) for i in range(len(full_date_list))]
-    running_goal_list = [running_session_goal * (i / 365) for i in range(len(full_date_list))]
-    strength_goal_list = [strength_session_goal * (i / 365) for i in range(len(full_date_list))]
-
-    # We only want to plot the progress indicator if the activity has been selected in the dropdown, i.e. if it is
-    # in the my_color_map dict. Then we also want to make sure we are plotting it in the same color (but dashed)
-    if 'Climbing2' in my_color_map:
-        figure_to_return.add_trace(go.Scatter(y=climbing_goal_list, x=full_date_list, mode='lines', showlegend=False,
-                                              line={'dash': 'dash', 'color': my_color_map['Climbing2']},
-                                              name='Climbing target'))
-    if 'Running2' in my_color_map:
-        figure_to_return.add_trace(go.Scatter(y=running_goal_list, x=full_date_list, mode='lines', showlegend=False,
-                                              line={'dash': 'dash', 'color': my_color_map['Running2']},
-                                              name='Running target'))
-    if 'Strength2' in my_color_map:
-        figure_to_return.add_trace(go.Scatter(y=strength_goal_list, x=full_date_list, mode='lines', showlegend=False,
-                                              line={'dash': 'dash', 'color': my_color_map['Strength2']},
-                                              name='Strength target'))
-
-    figure_to_return.update_layout(
-        margin=dict(l=0, r=0, t=30, b=0),  # Left, Right, Top, Bottom
-        xaxis_title="Date",
-        yaxis_title="Session count",
-        #plot_bgcolor="#343a40",  # Dark background
-        paper_bgcolor="#272b30",
-        font=dict(color="#f8f9fa"),
-        legend=dict(
-            x=0.05,  # Horizontal position (0: left, 1: right)
-            y=0.95,  # Vertical position (0: bottom, 1: top)
-            xanchor='left',  # Align legend box's right side at x
-            yanchor='top',  # Align legend box's top side at y
-            bgcolor='#343a40',  # Optional: Semi-transparent white background
-        )
-    )
-
-    return figure_to_return
+    # We want to save dbc.Row() elements with the identifier name (maybe this should be a separate label actually),
+    # the date range and an indication of goal progress. Typically this is something like #achieved / #target. The
+    # columns are formatted for the whole page in one go
+    start_dates = page_df['Start date'].dt.strftime('%d-%m-%Y')
+    end_dates = page_df['End date'].dt.strftime('%d-%m-%Y')
+    progress = page_df['Progress'].astype(str) + ' / ' + page_df['Quantity'].astype(str)
+    with phase('figure'):
+        list_to_return = [dbc.Row(children=[dbc.Col(identifier),
+                                            dbc.Col(start_date),
+                                            dbc.Col(end_date),
+                                            dbc.Col(goal_progress)])
+                          for identifier, start_date, end_date, goal_progress in
+                          zip(page_df['Identifier'].astype(str), start_dates, end_dates, progress)]
+
+    return list_to_return, page_count
+
+@heavy_callback(Output('timeseries-counts', 'data'),
+                Input('data-version', 'data'),
+                Input('graph-date-range', 'start_date'), Input('graph-date-range', 'end_date'),
+                Input('graph-granularity', 'value'),
+                progress_bar='timeseries-progress')
+@timed
+def publish_timeseries_counts(_, start_date=None, end_date=None, granularity='daily', set_progress=no_progress):
+    """
+    Callback function to publish the number of sessions per period for every value in the timeseries dropdown, which
+    the timeseries graph is built from in the browser (see assets/timeseries.js). This only runs when the data, the
+    window or the granularity changes, so changing the selection or zooming in the graph doesn't need the server at all
 
-@app.callback(Output('Log-col', 'children'),
-              Input('Temp-log-initiator', 'children'))
-def update_log(_):
     """
-    Function to update the activity log column upon updating of the dummy col. This should happen at the initial
-    opening of the dashboard, reloads and whenever an activity is saved
+    store = current_store()
+    today = pd.Timestamp.today().normalize()
+    start, end = graph_window(start_date, end_date, today)
+    return callback_cache.get_or_compute(('publish_timeseries_counts', store.version(), start, end, granularity, today),
+                                         lambda: timeseries_counts(store, start, period_ends(start, end, granularity),
+                                                                   set_progress))
 
+def timeseries_counts(store, start, date_list, set_progress=no_progress):
     """
-    # The headers of the column
-    to_return = [html.H2('My log',
-                         className="d-flex justify-content-center align-items-center"),
-                 dbc.Row(children=[dbc.Col('Activity', style={"font-weight": "bold"}),
-                                   dbc.Col('Activity group', style={"font-weight": "bold"}),
-                                   dbc.Col('Date', style={"font-weight": "bold"})])]
+    Builds the data for the timeseries counts store from a data store, for the periods from the start up to and
+    including each day of date_list
 
-    my_sessions_df = pd.read_csv('Session_log.csv', index_col=0)
+    """
+    keys = [option['value'] for option in TIMESERIES_OPTIONS]
+
+    # One row per dropdown value and one column per period, sent as a typed array. The sessions logged before the
+    # window are sent separately, as the values the cumulative counts start from
+    set_progress(0, 2)
+    rollup = store.rollup()
+    set_progress(1, 2)
+    offsets, counts = rollup.period_counts(keys, start, date_list)
+    set_progress(2, 2)
+
+    return {'first_day': start.strftime('%Y-%m-%d'),
+            # Days from the first day to the end of each period
+            'days': encode_matrix((date_list - start).days),
+            'keys': keys,
+            'offsets': [int(offset) for offset in offsets],
+            'counts': encode_matrix(counts.to_numpy().T),
+            'pace_start': FIRST_GRAPH_DAY,
+            'colors': TRACE_COLORS,
+            'targets': YEARLY_SESSION_GOALS,
+            # The layout is resolved on the server, so that the graph gets the same template as the other graphs
+            'layout': go.Figure(layout=TIMESERIES_LAYOUT).to_plotly_json()['layout'],
+            'webgl': USE_WEBGL,
+            'max_points': MAX_POINTS}
+
+# The timeseries graph itself is assembled in the browser from the published counts. It shows the cumulative session
+# counts of the selected values, as steps on the periods they change, along with the dashed pace lines towards the
+# yearly goals. Just like on the server, only the points within the visible range are used when zoomed in
+app.clientside_callback(ClientsideFunction(namespace='productivity', function_name='timeseries_figure'),
+                        Output('timeseries-graph', 'figure'),
+                        Input('timeseries-counts', 'data'),
+                        Input('timeseries-selection-dropdown', 'value'),
+                        Input('timeseries-graph', 'relayoutData'))
+
+@app.callback(Output('Log-rows', 'children'),
+              Output('Log-pagination', 'max_value'),
+              Input('data-version', 'data'),
+              Input('Log-pagination', 'active_page'))
+@timed
+def update_log(_, page):
+    """
+    Function to update the activity log column upon updating of the data version or when switching page. This should
+    happen at the initial opening of the dashboard, reloads and whenever an activity is saved. Only the sessions on
+    the selected page are sent to the browser, with the most recent sessions on the first page
 
-    my_sessions_df.sort_values('Date', ascending=False, inplace=True)
+    """
+    page_df, page_count = current_store().session_page(page or 1, LOG_PAGE_SIZE)
 
-    # Gradually build the content from the data file
-    for index, row in my_sessions_df.iterrows():
-        this_row = dbc.Row(children=[dbc.Col(row['Activity name']),
-                                     dbc.Col(row['Activity group']),
-                                     dbc.Col(dt.datetime.strptime(row['Date'], '%Y-%m-%d').strftime('%d-%m-%Y'))])
+    # Format the dates for the whole page in one go
+    dates = page_df['Date'].dt.strftime('%d-%m-%Y')
 
-        to_return.append(this_row)
+    with phase('figure'):
+        to_return = [dbc.Row(children=[dbc.Col(activity_name),
+                                       dbc.Col(activity_group),
+                                       dbc.Col(date)])
+                     for activity_name, activity_group, date in zip(page_df['Activity name'],
+                                                                    page_df['Activity group'], dates)]
 
-    return to_return
+    return to_return, page_count
 
-@app.callback(Output('Temp-log-initiator', 'children'),
+@app.callback(Output('data-version', 'data'),
               Input('Session-save-button', 'n_clicks'),
               State('Session-calendar', 'date'),
               State('Activity-type-select', 'value'),
               State('Subactivity-type-select', 'value'),
               State('Activity-highlights', 'value'),
               State('Session-notes', 'value'),
+              State('data-version', 'data'),
               prevent_initial_call=True)
-def save_session(_, date, activity_type, subactivity_type, highlights, notes):
+@timed
+def save_session(_, date, activity_type, subactivity_type, highlights, notes, data_version=None):
     """
     Function to save a session to data file. The input is the button, but the callback also needs access to the
-    states of a number of input fields. It then updates a dummy col to intiate a callback chain
+    states of a number of input fields. It then updates the data version to intiate a callback chain
 
     """
-    session_log_df = pd.read_csv('Session_log.csv', index_col=0)
-
-    # We want to pick the lowest positive id number which is available
-    new_session_id = 1
-
-    while new_session_id in session_log_df.index:
-        new_session_id += 1
-
-    session_log_df.loc[new_session_id] = {'Date': date,
-                                          'Activity group': activity_type,
-                                          'Activity name': subactivity_type,
-                                          'Keywords': highlights,
-                                          'Notes': notes,
-                                          'Duration': ''}
-
-    session_log_df.to_csv('Session_log.csv')
-
-    return 'Update'
+    # The session is appended to the end of the user's log, and the storage backend hands out the next free ID
+    store = current_store()
+    store.add_session({'Date': date,
+                       'Activity group': activity_type,
+                       'Activity name': subactivity_type,
+                       'Keywords': highlights,
+                       'Notes': notes,
+                       'Duration': ''})
+
+    # The callbacks depending on the data are only run again if the data actually changed
+    new_version = store.version()
+    if new_version == data_version:
+        return no_update
+
+    return new_version
 
 @app.callback(Output('Subactivity-type-select', 'options'),
               Output('Subactivity-type-select', 'value'),
               Input('Activity-type-select', 'value'))
+@timed
 def set_subactivities(selected_activity):
     """
     Callback function to specify subactivity selection based on the selected activity
 
     """
 
-    subactivity_dict = {}
-    selected_value = None
-    # Define the subactivity for each activity group. Remember to specify the desired selected value. Also note that
-    # ordering here defines the ordering in the app
-    if selected_activity == 'Exercise':
-        subactivity_dict['Climbing'] = 'Climbing'
-        subactivity_dict['Running'] = 'Running'
-        subactivity_dict['Strength'] = 'Strength'
-        subactivity_dict['Cross-country skiing'] = 'Cross-country skiing'
-        subactivity_dict['Cycling'] = 'Cycling'
-        selected_value = 'Climbing'
-    elif selected_activity == 'Technical':
-        subactivity_dict['Technical skills'] = 'Technical skills'
-        selected_value = 'Technical skills'
-    elif selected_activity == 'Culture':
-        subactivity_dict['Reading'] = 'Reading'
-        subactivity_dict['Languages'] = 'Languages'
-
-        selected_value = 'Reading'
+    # The subactivities for each activity group are defined in the taxonomy module. Remember that the ordering there
+    # defines the ordering in the app, and that the first subactivity is the selected value
+    subactivity_dict = {subactivity: subactivity for subactivity in SUBACTIVITIES.get(selected_activity, [])}
+    selected_value = next(iter(subactivity_dict), None)
 
     return subactivity_dict, selected_value
 
 @app.callback(Output('Activity-highlights', 'options'),
               Input('Subactivity-type-select', 'value'))
+@timed
 def set_activity_highlights(selected_subactivity):
     """
-    Certain (sub-)activities might have desired keywords or highlights. These can be defined here.
+    Certain (sub-)activities might have desired keywords or highlights. These are defined in the taxonomy module.
 
     """
-    highlights = {}
-
-    if selected_subactivity == 'Climbing':
-        highlights['Lead climbing'] = 'Lead climbing'
-        highlights['Toprope climbing'] = 'Toprope climbing'
-        highlights['Bouldering'] = 'Bouldering'
-    elif selected_subactivity == 'Running':
-        highlights['Base'] = 'Base'
-        highlights['Tempo'] = 'Tempo'
-        highlights['Intervals'] = 'Intervals'
-    elif selected_subactivity == 'Strength':
-        highlights['Bench press'] = 'Bench press'
-        highlights['Deadlifts'] = 'Deadlifts'
-        highlights['Squats'] = 'Squats'
-    elif selected_subactivity == 'Cross-country skiing':
-        highlights['Classic'] = 'Classic'
-        highlights['Skate'] = 'Skate'
-    elif selected_subactivity == 'Cycling':
-        pass
-    elif selected_subactivity == 'Technical skills':
-        highlights['Personal projects'] = 'Personal projects'
-        highlights['Technical books'] = 'Technical books'
-        highlights['Courses'] = 'Courses'
-    elif selected_subactivity == 'Reading':
-        highlights['Fiction'] = 'Fiction'
-        highlights['Non-fiction'] = 'Non-fiction'
-    elif selected_subactivity == 'Languages':
-        pass
+    highlights = {highlight: highlight for highlight in HIGHLIGHTS.get(selected_subactivity, [])}
 
     return highlights
 
@@ -0,0 +1,137 @@
+// Builds the timeseries graph in the browser from the session counts per period published by the server in the
+// 'timeseries-counts' store (see publish_timeseries_counts in app.py), so that changing the selection or zooming
+// doesn't need a round trip to the server
+
+const DAY_MS = 24 * 60 * 60 * 1000;
+
+function decodeInt32(encoded) {
+    // The counts and days are sent as base64 encoded little-endian int32 values. The counts have one row per dropdown
+    // value and one column per period
+    const binary = atob(encoded);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return new Int32Array(bytes.buffer);
+}
+
+function dayOffset(value, firstDay) {
+    // Number of days (possibly fractional) between the first day and a date string or timestamp from plotly
+    const text = String(value).replace(' ', 'T');
+    const time = Date.parse(/[zZ]|[+-]\d\d:?\d\d$/.test(text) || !text.includes('T') ? text : text + 'Z');
+    return (time - firstDay) / DAY_MS;
+}
+
+function sortedPosition(values, target, right) {
+    // Position at which the target would be inserted into the sorted values, after any equal values if right is true.
+    // Same as numpy's searchsorted
+    let low = 0;
+    let high = values.length;
+    while (low < high) {
+        const middle = (low + high) >> 1;
+        if (values[middle] < target || (right && values[middle] === target)) {
+            low = middle + 1;
+        } else {
+            high = middle;
+        }
+    }
+    return low;
+}
+
+function visibleWindow(relayoutData, firstDay, days) {
+    // First and last period to plot; the periods ending within the zoomed in range along with the one before and after
+    // it, so the lines run on to the edges of the graph. Same as figures._window on the server
+    let range = null;
+    if (relayoutData && 'xaxis.range[0]' in relayoutData && 'xaxis.range[1]' in relayoutData) {
+        range = [relayoutData['xaxis.range[0]'], relayoutData['xaxis.range[1]']];
+    } else if (relayoutData && 'xaxis.range' in relayoutData) {
+        range = relayoutData['xaxis.range'];
+    }
+    if (range === null) {
+        return [0, days.length];
+    }
+    const start = Math.max(sortedPosition(days, dayOffset(range[0], firstDay), true) - 1, 0);
+    const stop = Math.min(sortedPosition(days, dayOffset(range[1], firstDay), false) + 1, days.length);
+    return [start, Math.max(stop, start)];
+}
+
+function isoDay(firstDay, offset) {
+    return new Date(firstDay + offset * DAY_MS).toISOString().slice(0, 10);
+}
+
+function stepPoints(cumulative, firstDay, days, start, stop, maxPoints) {
+    // The periods in which the cumulative count changes, along with the first and last period, thinned out evenly if
+    // there are more than maxPoints of them. Same as figures.step_points on the server
+    let positions = [];
+    for (let period = start; period < stop; period++) {
+        if (period === start || period === stop - 1 || cumulative[period] !== cumulative[period - 1]) {
+            positions.push(period);
+        }
+    }
+    if (positions.length > maxPoints) {
+        const thinned = new Set();
+        for (let i = 0; i < maxPoints; i++) {
+            thinned.add(positions[Math.round(i * (positions.length - 1) / (maxPoints - 1))]);
+        }
+        positions = Array.from(thinned);
+    }
+    return {x: positions.map(period => isoDay(firstDay, days[period])),
+            y: positions.map(period => cumulative[period])};
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    productivity: {
+        timeseries_figure: function (data, selection, relayoutData) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+            const firstDay = Date.parse(data.first_day);
+            const days = decodeInt32(data.days);
+            const nPeriods = days.length;
+            const counts = decodeInt32(data.counts);
+            const [start, stop] = visibleWindow(relayoutData, firstDay, days);
+            const type = data.webgl ? 'scattergl' : 'scatter';
+
+            const traces = [];
+            const colors = {};
+            let freeColors = data.colors.slice();
+            for (const selected of selection || []) {
+                colors[selected] = freeColors.shift();
+                if (freeColors.length === 0) {
+                    freeColors = data.colors.slice();
+                }
+
+                // Cumulative number of sessions up to and including each period, starting from the number of sessions
+                // logged before the window
+                const key = data.keys.indexOf(selected);
+                const row = key * nPeriods;
+                const cumulative = new Array(nPeriods);
+                let total = key >= 0 ? data.offsets[key] : 0;
+                for (let period = 0; period < nPeriods; period++) {
+                    total += key >= 0 ? counts[row + period] : 0;
+                    cumulative[period] = total;
+                }
+
+                const points = stepPoints(cumulative, firstDay, days, start, stop, data.max_points);
+                traces.push({type: type, x: points.x, y: points.y, name: selected.slice(0, -1),
+                             line: {color: colors[selected], shape: 'hv'}});
+            }
+
+            // The dashed pace lines towards the yearly goals are straight, so only their end points are needed. The pace
+            // is counted from the pace start rather than from the start of the window
+            const paceOffset = (firstDay - Date.parse(data.pace_start)) / DAY_MS;
+            for (const [selected, goal] of Object.entries(data.targets)) {
+                if (!(selected in colors) || stop <= start) {
+                    continue;
+                }
+                const ends = (stop - 1 > start ? [start, stop - 1] : [start]).map(period => days[period]);
+                traces.push({type: type, x: ends.map(day => isoDay(firstDay, day)),
+                             y: ends.map(day => goal * (paceOffset + day) / 365),
+                             mode: 'lines', showlegend: false, line: {dash: 'dash', color: colors[selected]},
+                             name: selected.slice(0, -1) + ' target'});
+            }
+
+            return {data: traces, layout: data.layout};
+        }
+    }
+});
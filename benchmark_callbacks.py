@@ -0,0 +1,272 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import plotly
+
+from memo_cache import MemoCache
+from storage import GOAL_COLUMNS, SESSION_COLUMNS
+from taxonomy import HIGHLIGHTS, SUBACTIVITIES
+
+# Default file the baselines are saved to and compared against
+BASELINE_PATH = 'benchmark_baseline.json'
+
+# Sizes benchmarked by default, as (number of sessions, number of goals). --large adds the largest size
+SIZES = [(10 ** 3, 10 ** 2), (10 ** 4, 10 ** 3), (10 ** 5, 10 ** 4)]
+LARGE_SIZES = [(10 ** 6, 10 ** 5)]
+
+# The selection in the timeseries dropdown used for the graphs, i.e. the grand total, every activity group and every
+# activity name
+SELECTION = (['Total0'] + [group + '1' for group in SUBACTIVITIES] +
+             [name + '2' for names in SUBACTIVITIES.values() for name in names])
+
+# Relative weight of each activity group, so the synthetic log isn't spread evenly over the groups
+GROUP_WEIGHTS = {'Exercise': 0.6, 'Technical': 0.15, 'Culture': 0.25}
+
+# A callback is reported as a regression if it is this much slower than the baseline. Saving a session should take the
+# same time whatever the size of the data, so the save is also reported if it is this much slower for the largest size
+# than for the smallest
+REGRESSION_THRESHOLD = 1.5
+
+
+def _keyword_options(name):
+    # The keyword lists that can be logged for an activity, as written in the session log; no highlights, a single
+    # highlight or two highlights
+    highlights = HIGHLIGHTS[name]
+    options = [''] + [str([highlight]) for highlight in highlights]
+    options += [str([first, second]) for position, first in enumerate(highlights) for second in
+                highlights[position + 1:]]
+    return np.array(options, dtype=object)
+
+
+def generate_sessions(count, first_date, last_date, seed=0):
+    """
+    Generates a synthetic session log in the same format as Session_log.csv, using the activity groups, names and
+    highlights of the taxonomy. Sessions are spread uniformly over the date range, and roughly half of them have
+    highlights
+
+    """
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(first_date, last_date)
+
+    groups = np.array(list(GROUP_WEIGHTS), dtype=object)
+    weights = np.array(list(GROUP_WEIGHTS.values()))
+    session_groups = rng.choice(groups, size=count, p=weights / weights.sum())
+
+    names = np.empty(count, dtype=object)
+    keywords = np.empty(count, dtype=object)
+    for group in groups:
+        in_group = np.flatnonzero(session_groups == group)
+        names[in_group] = rng.choice(np.array(SUBACTIVITIES[group], dtype=object), size=len(in_group))
+        for name in SUBACTIVITIES[group]:
+            with_name = in_group[names[in_group] == name]
+            options = _keyword_options(name)
+            # Half of the sessions are logged without highlights
+            picks = np.where(rng.random(len(with_name)) < 0.5, 0, rng.integers(0, len(options), len(with_name)))
+            keywords[with_name] = options[picks]
+
+    sessions_df = pd.DataFrame({'Date': days[rng.integers(0, len(days), count)].strftime('%Y-%m-%d'),
+                                'Activity group': session_groups,
+                                'Activity name': names,
+                                'Keywords': keywords,
+                                'Notes': np.where(rng.random(count) < 0.2, 'Synthetic session', ''),
+                                'Duration': ''},
+                               index=pd.RangeIndex(1, count + 1, name='Session ID'))
+
+    return sessions_df[SESSION_COLUMNS]
+
+
+def generate_goals(count, first_date, last_date, seed=0):
+    """
+    Generates synthetic period goals in the same format as Period_goals.csv. Each goal is for the grand total, an
+    activity group, an activity name or a highlight, over a window of one to five weeks or a month, within the date
+    range
+
+    """
+    rng = np.random.default_rng(seed + 1)
+    identifiers = ([(0, 'Total')] + [(1, group) for group in SUBACTIVITIES] +
+                   [(2, name) for names in SUBACTIVITIES.values() for name in names] +
+                   [(3, highlight) for highlights in HIGHLIGHTS.values() for highlight in highlights])
+    picks = rng.integers(0, len(identifiers), count)
+
+    lengths = rng.choice([7, 14, 21, 28, 35, 30], size=count)
+    days = pd.date_range(first_date, last_date)
+    starts = days[rng.integers(0, len(days), count)]
+
+    goals_df = pd.DataFrame({'Start date': starts.strftime('%Y-%m-%d'),
+                             'End date': (starts + pd.to_timedelta(lengths - 1, unit='D')).strftime('%Y-%m-%d'),
+                             'Label': [identifiers[pick][1] for pick in picks],
+                             'Identifier level': [identifiers[pick][0] for pick in picks],
+                             'Identifier': [identifiers[pick][1] for pick in picks],
+                             'Condition type': 'Count',
+                             'Quantity': rng.integers(1, 6, count)})
+
+    return goals_df[GOAL_COLUMNS]
+
+
+def payload_size(output):
+    # Size of the callback response as Dash would send it to the browser
+    return len(json.dumps(output, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def measure(function, arguments, repeats):
+    """
+    Calls a function once cold and then repeatedly, returning the time of the first call, the median time of the
+    repeated calls (in milliseconds), the peak memory allocated during one call (in KiB) and the response size (in
+    bytes). The memory is measured in a separate call, since tracing slows the calls down
+
+    """
+    start = time.perf_counter()
+    output = function(*arguments)
+    first = (time.perf_counter() - start) * 1000
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*arguments)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    function(*arguments)
+    peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+
+    return {'first_ms': round(first, 3), 'median_ms': round(statistics.median(timings), 3) if timings else None,
+            'peak_kib': round(peak, 1), 'payload_bytes': payload_size(output)}
+
+
+def run_callbacks(directory, repeats):
+    """
+    Imports the app against the data in the directory and measures each callback. This runs in a fresh process for
+    each size, so that the app module and its shared data store are set up from scratch
+
+    """
+    os.environ['PRODUCTIVITY_STORAGE'] = 'csv'
+    os.environ['PRODUCTIVITY_SESSION_LOG'] = os.path.join(directory, 'Session_log.csv')
+    os.environ['PRODUCTIVITY_PERIOD_GOALS'] = os.path.join(directory, 'Period_goals.csv')
+    import app
+
+    # The callback results are memoized, which would turn every call after the first into a cache hit. A cache that
+    # keeps nothing, in memory or on disk, is swapped in so that each call does the work
+    app.callback_cache = MemoCache(max_entries=0, directory=None)
+
+    today = pd.Timestamp.today().strftime('%Y-%m-%d')
+    callbacks = [('plot_goals_graph', app.plot_goals_graph, (None, SELECTION)),
+                 # The timeseries graph is built in the browser, from the counts published by this callback
+                 ('publish_timeseries_counts', app.publish_timeseries_counts, (None,)),
+                 ('goal_log_update[past]', app.goal_log_update, (None, 'past', 1)),
+                 ('goal_log_update[active]', app.goal_log_update, (None, 'active', 1)),
+                 ('update_log[first page]', app.update_log, (None, 1)),
+                 ('update_log[last page]', app.update_log, (None, 10 ** 9)),
+                 # Saving writes to the (temporary) data, so it is measured last
+                 ('save_session', app.save_session, (1, today, 'Exercise', 'Climbing', ['Lead climbing'],
+                                                     'Benchmark session'))]
+
+    return {name: measure(function, arguments, repeats) for name, function, arguments in callbacks}
+
+
+def benchmark(sizes, repeats, first_date, last_date):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for session_count, goal_count in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_sessions(session_count, first_date, last_date).to_csv(os.path.join(directory, 'Session_log.csv'))
+            generate_goals(goal_count, first_date, last_date).to_csv(os.path.join(directory, 'Period_goals.csv'))
+            with context.Pool(1) as pool:
+                measurements = pool.apply(run_callbacks, (directory, repeats))
+        finally:
+            shutil.rmtree(directory)
+
+        for callback, measurement in measurements.items():
+            results.append(dict(sessions=session_count, goals=goal_count, callback=callback, **measurement))
+        print(f'Benchmarked {session_count} sessions and {goal_count} goals')
+
+    return pd.DataFrame(results)
+
+
+def compare(results_df, baseline_df, threshold):
+    """
+    Joins the results with the baseline on size and callback, adding the ratio of the median times and whether the
+    callback got slower than the threshold allows
+
+    """
+    keys = ['sessions', 'goals', 'callback']
+    comparison_df = results_df.merge(baseline_df[keys + ['median_ms', 'peak_kib', 'payload_bytes']], on=keys,
+                                     how='left', suffixes=('', '_baseline'))
+    comparison_df['ratio'] = (comparison_df['median_ms'] / comparison_df['median_ms_baseline']).round(2)
+    comparison_df['regression'] = comparison_df['ratio'] > threshold
+
+    return comparison_df
+
+
+def save_growth(results_df):
+    """
+    Ratio of the median time of saving a session for the largest size benchmarked to the one for the smallest size,
+    which should stay close to 1 as the cost of a save must not grow with the history
+
+    """
+    save_df = results_df[results_df['callback'] == 'save_session'].sort_values('sessions')
+    return save_df['median_ms'].iloc[-1] / save_df['median_ms'].iloc[0]
+
+
+if __name__ == '__main__':
+    """
+    This script can be run to benchmark the Dash callbacks on synthetic data. For each size a session log and goals
+    are generated from the activities in the taxonomy, the app is loaded against them in a fresh process, and each
+    callback is called directly. The time of the first (cold) call, the median time of the repeated calls, the peak
+    memory of a call and the size of the response are reported.
+
+    Use --save to store the results as the baseline, and later runs are compared against it, listing the callbacks
+    that got slower. Every run also checks that saving a session doesn't get slower as the data grows
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the Dash callbacks on synthetic data')
+    parser.add_argument('--large', action='store_true', help='Also benchmark 10^6 sessions and 10^5 goals')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of repeated calls per callback')
+    parser.add_argument('--first-date', default='2025-01-01', help='First date of the synthetic data')
+    parser.add_argument('--last-date', default=pd.Timestamp.today().strftime('%Y-%m-%d'),
+                        help='Last date of the synthetic data')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='File holding the baseline results')
+    parser.add_argument('--save', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='Slowdown relative to the baseline reported as a regression')
+    args = parser.parse_args()
+
+    results_df = benchmark(SIZES + (LARGE_SIZES if args.large else []), args.repeats, args.first_date,
+                           args.last_date)
+
+    pd.set_option('display.width', 200)
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        comparison_df = compare(results_df, pd.DataFrame(baseline['results']), args.threshold)
+        print(f"Compared to the baseline from {baseline['created']} ({baseline['machine']})")
+        print(comparison_df.to_string(index=False))
+        regressions_df = comparison_df[comparison_df['regression']]
+        if regressions_df.shape[0]:
+            print(f'{regressions_df.shape[0]} callbacks are more than {args.threshold} times slower than the baseline')
+            raise SystemExit(1)
+    else:
+        print(results_df.to_string(index=False))
+
+    growth = save_growth(results_df)
+    if growth > args.threshold:
+        print(f'Saving a session is {growth:.2f} times slower for the largest size than for the smallest')
+        raise SystemExit(1)
+
+    if args.save:
+        baseline = {'created': pd.Timestamp.now().isoformat(timespec='seconds'),
+                    'machine': f'{platform.machine()}, Python {platform.python_version()}',
+                    'results': results_df.to_dict(orient='records')}
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+        print(f'Saved the results as the baseline in {args.baseline}')
@@ -0,0 +1,313 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from aggregation import LEVEL_COLUMNS, day_numbers
+from rollup import TOTAL
+from storage import SESSION_COLUMNS
+from taxonomy import SUBACTIVITIES, all_highlights
+
+# Number of keywords held in each word of the keyword bitsets
+WORD_BITS = 64
+
+# Memory taken by a Python string besides its characters, used to estimate the memory of the notes
+STRING_OVERHEAD = 49
+
+# Odd multiplier used to combine the hashes of the columns of a session into one hash
+HASH_MULTIPLIER = 0x100000001B3
+
+# Smallest number of rows the buffers of a session table make room for once sessions are appended to it
+MIN_CAPACITY = 1024
+
+
+def taxonomy_vocabularies():
+    """
+    The values of each level as defined in the taxonomy, in the order they are defined; the activity groups (level 1),
+    activity names (level 2) and highlights (level 3). These are the first values of the vocabularies the codes are
+    drawn from, so the same activity gets the same code in every worker
+
+    """
+    return {1: list(SUBACTIVITIES),
+            2: [name for names in SUBACTIVITIES.values() for name in names],
+            3: all_highlights()}
+
+
+def encode(values, vocabulary):
+    """
+    Codes of the values in the vocabulary, as int16, or int32 once the vocabulary has outgrown int16 (e.g. after
+    importing many free-text activity names). Values not in the vocabulary yet are appended to it (in place), and
+    missing values get code -1
+
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    positions = {value: code for code, value in enumerate(vocabulary)}
+    for value in uniques:
+        if value not in positions:
+            positions[value] = len(vocabulary)
+            vocabulary.append(value)
+    # The extra entry at the end maps the -1 of missing values to -1
+    dtype = np.int16 if len(vocabulary) <= np.iinfo(np.int16).max else np.int32
+    mapping = np.array([positions[value] for value in uniques] + [-1], dtype=dtype)
+    return mapping[codes]
+
+
+class _Buffers:
+    # Arrays holding the columns of session tables, by column name, with spare rows at the end. Several tables can share
+    # the buffers, each seeing its own number of rows, and filled is the number of rows written so far
+    def __init__(self, columns, filled):
+        self.columns = columns
+        self.filled = filled
+
+    @property
+    def capacity(self):
+        return len(self.columns['ids'])
+
+    def fits(self, start, length, new_columns):
+        # Whether rows can be written from start to length in place; the rows after start must not be taken by
+        # another table, there must be room for them, and the new values must fit the arrays
+        return (self.filled == start and length <= self.capacity and
+                all(np.can_cast(values.dtype, self.columns[name].dtype, 'safe') and
+                    values.shape[1:] <= self.columns[name].shape[1:] for name, values in new_columns.items()))
+
+    def grown(self, length, capacity, new_columns):
+        # Copies of the first length rows in new buffers with room for capacity rows, wide enough for the new values.
+        # The spare rows are zero, which the keyword bitsets rely on
+        columns = {}
+        for name, buffer in self.columns.items():
+            values = new_columns[name]
+            shape = (capacity,) + tuple(np.maximum(buffer.shape[1:], values.shape[1:]))
+            columns[name] = np.zeros(shape, dtype=np.promote_types(buffer.dtype, values.dtype))
+            columns[name][(slice(length),) + tuple(map(slice, buffer.shape[1:]))] = buffer[:length]
+        return _Buffers(columns, length)
+
+
+class SessionTable:
+    """
+    Compact in-memory form of the session log, which the data store keeps instead of the parsed frame. Each session is
+    held as its ID, its day as an int32 day number, its activity group and name as int16 codes (int32 for very large
+    vocabularies) into vocabularies that start with the taxonomy, and its keywords as a bitset over the keyword
+    vocabulary. Only the notes and durations are kept as they are. Finding the sessions of an identifier is then an
+    integer comparison, and the table takes a fraction of the memory of a frame holding a string per group and name and
+    a list per keyword set.
+
+    A table is never modified once built, as it is shared between callers; appending sessions returns a new table. The
+    frame form can be recovered with to_frame, with the keywords listed in vocabulary order
+
+    """
+    def __init__(self, ids, days, codes, keyword_bits, notes, durations, vocabularies, note_bytes=0):
+        columns = {'ids': ids, 'days': days, 'keyword_bits': keyword_bits, 'notes': notes, 'durations': durations}
+        columns.update((('codes', level), level_codes) for level, level_codes in codes.items())
+        self._buffers = _Buffers(columns, len(ids))
+        self._length = len(ids)
+        self._vocabularies = vocabularies
+        self._note_bytes = note_bytes
+
+    @classmethod
+    def _from_buffers(cls, buffers, length, vocabularies, note_bytes):
+        table = cls.__new__(cls)
+        table._buffers = buffers
+        table._length = length
+        table._vocabularies = vocabularies
+        table._note_bytes = note_bytes
+        return table
+
+    def _column(self, name):
+        return self._buffers.columns[name][:self._length]
+
+    @property
+    def ids(self):
+        return self._column('ids')
+
+    @property
+    def days(self):
+        return self._column('days')
+
+    @property
+    def _keyword_bits(self):
+        return self._column('keyword_bits')
+
+    @property
+    def _notes(self):
+        return self._column('notes')
+
+    @property
+    def _durations(self):
+        return self._column('durations')
+
+    @property
+    def _codes(self):
+        return {level: self._column(('codes', level)) for level in LEVEL_COLUMNS}
+
+    @classmethod
+    def from_frame(cls, sessions_df, vocabularies=None):
+        """
+        Builds the table from a parsed session frame, as returned by the storage backends. The vocabularies are copied
+        before any new values are added to them
+
+        """
+        vocabularies = {level: list(values) for level, values in
+                        (vocabularies if vocabularies is not None else taxonomy_vocabularies()).items()}
+        codes = {level: encode(sessions_df[column].to_numpy(), vocabularies[level])
+                 for level, column in LEVEL_COLUMNS.items()}
+
+        # The keyword lists are flattened to one entry per (session, keyword) pair, and each pair sets one bit
+        keyword_lists = sessions_df['Keywords'].to_numpy()
+        rows = np.repeat(np.arange(len(keyword_lists)), [len(keywords) for keywords in keyword_lists])
+        keyword_codes = encode(list(itertools.chain.from_iterable(keyword_lists)), vocabularies[3]).astype(np.int64)
+        keyword_bits = np.zeros((len(keyword_lists), max(1, -(-len(vocabularies[3]) // WORD_BITS))), dtype=np.uint64)
+        np.bitwise_or.at(keyword_bits, (rows, keyword_codes // WORD_BITS),
+                         np.left_shift(np.uint64(1), (keyword_codes % WORD_BITS).astype(np.uint64)))
+
+        # The strings of the notes are measured once, as they are the only part of the table that isn't in arrays
+        notes = pd.Series(sessions_df['Notes'].to_numpy(), dtype=object)
+        # Only strings are measured; notes can be missing, and a column without any strings has no .str accessor
+        strings = notes[notes.map(type).eq(str)]
+        note_bytes = int(strings.map(len).sum()) + STRING_OVERHEAD * len(strings)
+
+        return cls(sessions_df.index.to_numpy().astype(np.int64), day_numbers(sessions_df['Date']), codes,
+                   keyword_bits, notes.to_numpy(), sessions_df['Duration'].to_numpy(), vocabularies, note_bytes)
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def index(self):
+        return pd.Index(self.ids, name='Session ID')
+
+    @property
+    def nbytes(self):
+        """
+        Estimate of the memory taken by the table, in bytes, including the spare rows of its buffers
+
+        """
+        return sum(buffer.nbytes for buffer in self._buffers.columns.values()) + self._note_bytes
+
+    def vocabulary(self, level):
+        return self._vocabularies[level]
+
+    def codes(self, level):
+        """
+        The code of each session at level 1 (activity group) or level 2 (activity name)
+
+        """
+        return self._column(('codes', level))
+
+    def code(self, level, identifier):
+        """
+        Code of an identifier at a level, or -1 if no session has it
+
+        """
+        try:
+            return self._vocabularies[level].index(identifier)
+        except ValueError:
+            return -1
+
+    def mask(self, level, identifier):
+        """
+        Boolean mask of the sessions counting towards an identifier at a level; all sessions for the grand total
+        (level 0), the sessions with the activity group or name (levels 1 and 2) or the sessions with the keyword
+        (level 3)
+
+        """
+        if level == 0:
+            return np.ones(len(self), dtype=bool)
+        code = self.code(level, identifier)
+        if code < 0:
+            return np.zeros(len(self), dtype=bool)
+        if level in LEVEL_COLUMNS:
+            return self.codes(level) == code
+        word, bit = divmod(code, WORD_BITS)
+        if word >= self._keyword_bits.shape[1]:
+            return np.zeros(len(self), dtype=bool)
+        return (self._keyword_bits[:, word] >> np.uint64(bit)) & np.uint64(1) == 1
+
+    def row_hashes(self, start=0):
+        """
+        64-bit hash of the content of each session from position start on; its ID, day, activity group and name,
+        keywords, notes and duration. The identifiers are hashed by value rather than by code, so the hashes don't
+        depend on the order of the vocabularies the table was built with
+
+        """
+        rows = slice(start, None)
+        durations = pd.to_numeric(pd.Series(self._durations[rows]), errors='coerce').to_numpy(dtype=float)
+        columns = [pd.util.hash_array(self.days[rows]), pd.util.hash_array(durations),
+                   pd.util.hash_array(self._notes[rows].astype(object))]
+        for level, codes in self._codes.items():
+            # The extra entry at the end is the hash of a missing value, which code -1 picks
+            columns.append(pd.util.hash_array(np.array(self._vocabularies[level] + [None], dtype=object))[codes[rows]])
+
+        # The keywords are a set, so the hashes of the keywords a session has are added up
+        keyword_hashes = pd.util.hash_array(np.array(self._vocabularies[3], dtype=object))
+        keyword_bits = self._keyword_bits[rows]
+        keyword_column = np.zeros(len(keyword_bits), dtype=np.uint64)
+        for code, keyword_hash in enumerate(keyword_hashes):
+            word, bit = divmod(code, WORD_BITS)
+            keyword_column += ((keyword_bits[:, word] >> np.uint64(bit)) & np.uint64(1)) * keyword_hash
+        columns.append(keyword_column)
+
+        hashes = pd.util.hash_array(self.ids[rows])
+        for column in columns:
+            hashes = hashes * np.uint64(HASH_MULTIPLIER) + column
+        return hashes
+
+    def append(self, sessions_df):
+        """
+        Returns a new table with the sessions of a parsed session frame added at the end. The new table shares the
+        buffers of this one and the new rows are written into their spare rows, so appending a session doesn't copy the
+        log. The buffers are only copied, at twice the size, when they are full, or when sessions were already appended
+        to this table (which must not be changed for the tables sharing them)
+
+        """
+        new = SessionTable.from_frame(sessions_df, self._vocabularies)
+        start, length = len(self), len(self) + len(new)
+        buffers, new_columns = self._buffers, new._buffers.columns
+        if not buffers.fits(start, length, new_columns):
+            buffers = buffers.grown(start, max(length, 2 * start, MIN_CAPACITY), new_columns)
+
+        for name, values in new_columns.items():
+            buffers.columns[name][(slice(start, length),) + tuple(map(slice, values.shape[1:]))] = values
+        buffers.filled = length
+
+        return SessionTable._from_buffers(buffers, length, new._vocabularies, self._note_bytes + new._note_bytes)
+
+    def to_frame(self, positions=None):
+        """
+        Returns the sessions (optionally only those at the given positions) as a parsed session frame, in the same
+        format as the storage backends return them
+
+        """
+        positions = np.arange(len(self)) if positions is None else np.asarray(positions, dtype=np.int64)
+        columns = {'Date': pd.DatetimeIndex(self.days[positions].astype('datetime64[D]'))}
+        for level, column in LEVEL_COLUMNS.items():
+            values = np.array(self._vocabularies[level] + [None], dtype=object)
+            columns[column] = values[self.codes(level)[positions]]
+
+        # The bitsets are unpacked to one column per keyword code, and the set bits are split back into lists
+        keywords = np.array(self._vocabularies[3], dtype=object)
+        unpacked = np.unpackbits(self._keyword_bits[positions].astype('<u8').view(np.uint8), axis=1,
+                                 bitorder='little')[:, :len(keywords)]
+        rows, keyword_codes = np.nonzero(unpacked)
+        splits = np.cumsum(np.bincount(rows, minlength=len(positions)))[:-1]
+        columns['Keywords'] = [list(session_keywords) for session_keywords in np.split(keywords[keyword_codes], splits)]
+        columns['Notes'] = self._notes[positions]
+        columns['Duration'] = self._durations[positions]
+
+        return pd.DataFrame(columns, index=pd.Index(self.ids[positions], name='Session ID'))[SESSION_COLUMNS]
+
+
+def categorize_goals(goals_df):
+    """
+    Converts the identifier and condition type of the goals to categoricals (the identifiers drawn from the taxonomy
+    first), and the identifier level to a small integer, so that selecting goals compares integer codes rather than
+    strings. Returns the converted frame
+
+    """
+    goals_df = goals_df.copy()
+    identifiers = [TOTAL] + [value for values in taxonomy_vocabularies().values() for value in values]
+    encode(goals_df['Identifier'].to_numpy(), identifiers)
+    goals_df['Identifier'] = pd.Categorical(goals_df['Identifier'], categories=list(dict.fromkeys(identifiers)))
+    goals_df['Condition type'] = goals_df['Condition type'].astype('category')
+    goals_df['Identifier level'] = goals_df['Identifier level'].astype(np.int8)
+
+    return goals_df
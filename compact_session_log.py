@@ -0,0 +1,14 @@
+from data_store import DataStore
+from storage import get_backend
+
+if __name__ == '__main__':
+    """
+    Sessions saved from the dashboard are appended to the end of the session log. This script can be run to compact
+    the log; the CSV file is rewritten sorted by session ID and atomically replaced, while a SQLite database is vacuumed.
+    The daily rollup is rewritten as well, folding in the increments appended after each saved session. The backend is
+    chosen in the same way as for the app, through the PRODUCTIVITY_STORAGE environment variable
+    """
+    backend = get_backend()
+    DataStore(backend).compact_sessions()
+
+    print(f'Compacted the session log of the {backend.name} backend')
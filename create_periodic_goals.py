@@ -1,164 +1,63 @@
-import pandas as pd
+import argparse
+
+from goal_generation import extend_goals, generate_goals, replace_goals
+from storage import get_backend
+
+# "level" should be 0 for grand totals, 1 for activity groups (exercise/culture...), 2 for activities (climbing,
+# reading, industry research, ...) and 3 for activity highlights (board climbing, bench press, non-fiction, ...).
+# "identifier" is then what ever identifier is relevant to the condition (e.g. climbing, strength, ...). Condition type
+# is currently just "Count" which is meant to evaluate the number of sessions. Planning to add functionality for
+# "Duration" which shall then evaluate the total time of relevant sessions. Label allows to provide a name that can be
+# printed on the dashboard.
+#
+# "period" is 'weekly' (every N weeks from the anchor date), 'monthly' (every N calendar months) or 'custom' (any pandas
+# frequency along with a length in days), see goal_generation.goal_windows
+GOAL_SPECS = [
+    # Weekly goals here, we start at the first monday of the year
+    {'period': 'weekly', 'every': 1, 'anchor': '2025-01-06', 'level': 2, 'identifier': 'Reading', 'quantity': 2},
+
+    # Two-weekly goals here
+    {'period': 'weekly', 'every': 2, 'anchor': '2025-01-06', 'level': 2, 'identifier': 'Climbing', 'quantity': 2},
+    {'period': 'weekly', 'every': 2, 'anchor': '2025-01-06', 'level': 2, 'identifier': 'Running', 'quantity': 1},
+    {'period': 'weekly', 'every': 2, 'anchor': '2025-01-06', 'level': 2, 'identifier': 'Strength', 'quantity': 1},
+    {'period': 'weekly', 'every': 2, 'anchor': '2025-01-06', 'level': 2, 'identifier': 'Technical skills',
+     'quantity': 1},
+    {'period': 'weekly', 'every': 2, 'anchor': '2025-01-06', 'level': 2, 'identifier': 'Languages', 'quantity': 1},
+
+    # Three-weekly goals here
+    {'period': 'weekly', 'every': 3, 'anchor': '2025-01-06', 'level': 3, 'identifier': 'Lead climbing', 'quantity': 1},
+    {'period': 'weekly', 'every': 3, 'anchor': '2025-01-06', 'level': 3, 'identifier': 'Intervals', 'quantity': 1},
+
+    # Monthly goals here
+    {'period': 'monthly', 'anchor': '2025-01-01', 'level': 3, 'identifier': 'Bench press', 'label': 'Bench',
+     'quantity': 1},
+    {'period': 'monthly', 'anchor': '2025-01-01', 'level': 3, 'identifier': 'Squats', 'quantity': 1},
+    {'period': 'monthly', 'anchor': '2025-01-01', 'level': 3, 'identifier': 'Deadlifts', 'quantity': 1},
+]
 
 if __name__ == '__main__':
     """
-    This script can be run to create period goals for the dashboard. It has been set up to make it easy
-    to add based on pre-specified time intervals; weekly, bi-weekly, tri-weekly and monthly
+    This script can be run to create period goals for the dashboard from the recurrence specs above. By default the
+    goals for the given years are added to the existing goals, leaving goals that already exist untouched, so the
+    horizon can be extended without changing past goals. Use --replace to regenerate all goals from the specs, where
+    goals that existed before keep their IDs
     """
+    parser = argparse.ArgumentParser(description='Create periodic goals from the recurrence specs')
+    parser.add_argument('--start-year', type=int, default=2025, help='First year to create goals for')
+    parser.add_argument('--end-year', type=int, default=2025, help='Last year to create goals for')
+    parser.add_argument('--replace', action='store_true', help='Replace all existing goals instead of extending them')
+    args = parser.parse_args()
 
+    backend = get_backend()
 
-    # "Identifier level" should be 0 for grand totals, 1 for activity groups (exercise/culture...), 2 for activities
-    # (climbing, reading, industry research, ...) and 3 for activity highlights (board climbing, bench press,
-    # non-fiction, ...). "Identifier" is then what ever identifier is relevant to the condition (e.g. climbing,
-    # strength, ...). Condition type is currently just "Count" which is meant to evaluate the number of sessions.
-    # Planning to add functionality for "Duration" which shall then evaluate the total time of relevant sessions.
-    # Label allows to provide a name that can be printed on the dashboard
-    period_goals_df = pd.DataFrame(
-        columns=['Start date', 'End date', 'Label', 'Identifier level', 'Identifier', 'Condition type', 'Quantity']
-    )
-
-    """
-    Weekly goals here
-    """
-    start = pd.Timestamp('2025-01-06')  # We start at the first monday of the year
-    stop = pd.Timestamp('2025-01-12')
-
-    # stop will be updated every iteration of the while loop until it reaches the target
-    while stop.year != 2026:
-
-        # Do things here
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Reading',
-                                                         'Identifier level': 2,
-                                                         'Identifier': 'Reading',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 2}  # LinedIn/Finn advert review
-
-        start = start + pd.Timedelta(days=7)
-        stop = stop + pd.Timedelta(days=7)
-
-
-    """
-    Two-weekly goals here
-    """
-    start = pd.Timestamp('2025-01-06')
-    stop = pd.Timestamp('2025-01-19')
-
-    while stop.year != 2026:
-
-        # Do things here
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Climbing',
-                                                         'Identifier level': 2,
-                                                         'Identifier': 'Climbing',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 2}
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Running',
-                                                         'Identifier level': 2,
-                                                         'Identifier': 'Running',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 1}
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Strength',
-                                                         'Identifier level': 2,
-                                                         'Identifier': 'Strength',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 1}
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Technical skills',
-                                                         'Identifier level': 2,
-                                                         'Identifier': 'Technical skills',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 1}
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Languages',
-                                                         'Identifier level': 2,
-                                                         'Identifier': 'Languages',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 1}
-
-        start = start + pd.Timedelta(days=14)
-        stop = stop + pd.Timedelta(days=14)
-
-    """
-       Two-weekly goals here
-       """
-    start = pd.Timestamp('2025-01-06')
-    stop = pd.Timestamp('2025-01-26')
-
-    while stop.year != 2026:
-        # Do things here
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Lead climbing',
-                                                         'Identifier level': 3,
-                                                         'Identifier': 'Lead climbing',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 1}
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Intervals',
-                                                         'Identifier level': 3,
-                                                         'Identifier': 'Intervals',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 1}
-
-        start = start + pd.Timedelta(days=21)
-        stop = stop + pd.Timedelta(days=21)
-
-    """
-    Monthly goals here
-    """
-    start = pd.Timestamp('2025-01-01')
-    stop = start + pd.tseries.offsets.MonthEnd(0)
-
-    while stop.year != 2026:
-
-        # Do things here
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Bench',
-                                                         'Identifier level': 3,
-                                                         'Identifier': 'Bench press',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 1}
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Squats',
-                                                         'Identifier level': 3,
-                                                         'Identifier': 'Squats',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 1}
-
-        period_goals_df.loc[period_goals_df.shape[0]] = {'Start date': start,
-                                                         'End date': stop,
-                                                         'Label': 'Deadlifts',
-                                                         'Identifier level': 3,
-                                                         'Identifier': 'Deadlifts',
-                                                         'Condition type': 'Count',
-                                                         'Quantity': 1}
-
-        # Need some extra logic to account for months with 28/29/30/31 days
-        start = stop + pd.Timedelta(days=1)
-        stop = start + pd.tseries.offsets.MonthEnd(0)
+    # Without any existing goals we simply start from an empty goal frame
+    existing_goals_df = backend.read_goals() if backend.goals_stamp() is not None else generate_goals([], 0, 0)
+    if args.replace:
+        period_goals_df, added = replace_goals(existing_goals_df, GOAL_SPECS, args.start_year, args.end_year)
+    else:
+        period_goals_df, added = extend_goals(existing_goals_df, GOAL_SPECS, args.start_year, args.end_year)
 
     print(period_goals_df)
+    print(f'Added {added} goals')
 
-    period_goals_df.to_csv('Period_goals.csv')
-
+    backend.write_goals(period_goals_df)
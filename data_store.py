@@ -0,0 +1,710 @@
+import collections
+import hashlib
+import os
+import re
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from aggregation import day_numbers
+from categorical import MIN_CAPACITY, SessionTable, categorize_goals
+from goal_evaluation import evaluate_goals, add_session_to_goals, finalize_goals
+from keyword_index import KeywordIndex
+from rollup import DailyRollup
+from instrumentation import phase
+from storage import get_backend, partition_backend, sessions_to_frame, GOAL_COLUMNS, GOAL_STATUS_COLUMNS
+from write_behind import (FLUSH_SIZE, ID_BLOCK, WRITE_BEHIND, SessionJournal, journal_paths, orphaned_journals,
+                          schedule_flush)
+
+# Directory holding a data partition (a subdirectory) for each user. If this is set the app serves many users, each
+# with their own data, otherwise everyone shares the data in the working directory
+USERS_DIR = os.environ.get('PRODUCTIVITY_USERS_DIR')
+
+# User names double as the names of the data partition directories, so only plain names are accepted
+USER_PATTERN = re.compile(r'[A-Za-z0-9_@-][A-Za-z0-9_.@-]{0,63}')
+
+# Maximum number of users whose data is kept in memory, and the maximum memory (in MB) their data may take together.
+# The data of the least recently active users is dropped first
+USER_STORES = int(os.environ.get('PRODUCTIVITY_USER_STORES', 200))
+USER_CACHE_MB = float(os.environ.get('PRODUCTIVITY_USER_CACHE_MB', 1024))
+
+
+def content_hash(sessions, start=0):
+    """
+    Hash of the content of the session log (a SessionTable) from position start on; the sum of the hashes of the
+    sessions (see SessionTable.row_hashes), so the hash of a log with sessions appended is the hash of the log plus the
+    hashes of the new sessions. Returned as an array of one uint64, which wraps around rather than overflowing
+
+    """
+    return np.array([sessions.row_hashes(start).sum(dtype=np.uint64)], dtype=np.uint64)
+
+
+def sessions_fingerprint(sessions, sessions_hash=None):
+    """
+    Fingerprint of the session log (a SessionTable) that persisted derived data (the daily rollup and goal status) was
+    built from; the number of sessions, the largest ID and the content hash, so that sessions edited outside the app
+    are noticed as well. The content hash can be passed in if it is already known
+
+    """
+    sessions_hash = content_hash(sessions) if sessions_hash is None else sessions_hash
+    return [len(sessions), int(sessions.ids.max()) if len(sessions) else 0, f'{int(sessions_hash[0]):016x}']
+
+
+def goals_hash(goals_df):
+    """
+    Hash of the content of the goals, where each goal is hashed along with its ID. Returned as an array of one uint64,
+    like content_hash
+
+    """
+    goal_hashes = pd.util.hash_pandas_object(goals_df[GOAL_COLUMNS], index=True).to_numpy()
+    return np.array([goal_hashes.sum(dtype=np.uint64)], dtype=np.uint64)
+
+
+def data_fingerprint(session_fingerprint, goals_df, goals_content_hash=None):
+    """
+    Fingerprint of the sessions (given by their fingerprint) and goals a persisted goal status was evaluated from.
+    Goals are regenerated or edited in place under the same IDs, so the goals are identified by a hash of their
+    content (see goals_hash), which can be passed in if it is already known. The persisted status is joined to the
+    goals on their IDs, so it is only used for the same goals
+
+    """
+    goals_content_hash = goals_hash(goals_df) if goals_content_hash is None else goals_content_hash
+    return session_fingerprint + [int(goals_df.shape[0]), f'{int(goals_content_hash[0]):016x}']
+
+
+class SessionDateIndex:
+    """
+    Positions of the sessions in the cached session table, sorted by date, so that any page of the log (newest first)
+    can be taken without sorting the whole log. Sessions on the same day are ordered by when they were added.
+
+    Sessions are mostly logged in date order, so a new session usually goes at the end, into spare room at the end of
+    the arrays that doubles in size when it runs out. Only a session dated before the last one is inserted, which
+    copies the arrays. Either way the positions handed out by newest_first are never changed
+
+    """
+    def __init__(self, sessions):
+        days = sessions.days
+        self._order = np.argsort(days, kind='stable')
+        self._days = days[self._order]
+        self._length = len(days)
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def nbytes(self):
+        return self._order.nbytes + self._days.nbytes
+
+    def add_session(self, position, date):
+        # The new session goes after any sessions already logged on the same day
+        day = day_numbers([date])[0]
+        length = self._length
+        if length and day < self._days[length - 1]:
+            insert_at = self._days[:length].searchsorted(day, side='right')
+            self._order = np.insert(self._order[:length], insert_at, position)
+            self._days = np.insert(self._days[:length], insert_at, day)
+        else:
+            if length == len(self._order):
+                # np.resize fills the spare room with copies of the entries, which are never read
+                self._order = np.resize(self._order, max(2 * length, MIN_CAPACITY))
+                self._days = np.resize(self._days, len(self._order))
+            self._order[length] = position
+            self._days[length] = day
+        self._length = length + 1
+
+    def day_range(self, first_day=None, last_day=None):
+        """
+        Range of the sessions logged from first_day to last_day (both included, and either can be left out) in the date
+        order, as a tuple of the first and one past the last position
+
+        """
+        days = self._days[:self._length]
+        low = 0 if first_day is None else int(days.searchsorted(day_numbers([first_day])[0], side='left'))
+        high = len(days) if last_day is None else int(days.searchsorted(day_numbers([last_day])[0], side='right'))
+        return low, max(high, low)
+
+    def newest_first(self, start, stop, day_range=None):
+        """
+        Positions of the sessions from start to stop when the log (or the sessions within a range from day_range) is
+        ordered with the newest sessions first
+
+        """
+        low, high = day_range if day_range is not None else (0, self._length)
+        size = high - low
+        return self._order[low + max(size - stop, 0):low + max(size - start, 0)][::-1]
+
+
+class DataStore:
+    """
+    In-process cache of the parsed session log and period goals. The data is only read and parsed again when the
+    storage backend reports a change (for files this is the modification time and size), or when the cache is
+    explicitly invalidated after a write. Callers always get a copy of the cached data, so they are free to sort or
+    add columns without affecting other callbacks.
+
+    The session log is held in its compact form (see categorical.SessionTable), and the goals with categorical
+    identifiers, which keeps the memory of each worker down and lets the derived structures select sessions and goals
+    by integer codes.
+
+    In write-behind mode added sessions are queued and journaled rather than written to storage right away, and
+    written in batches in the background (see write_behind.py). The queued sessions are part of the data this store
+    returns from the moment they are added, while other processes see them once they have been written
+
+    """
+    def __init__(self, backend=None, user=None, write_behind=WRITE_BEHIND):
+        self.backend = backend if backend is not None else get_backend()
+        # The user whose data partition this is, if the app serves many users
+        self.user = user
+
+        self._lock = threading.RLock()
+        # For each kind of data we keep the parsed data along with the stamp of the storage it was parsed from
+        self._cache = {}
+        self._readers = {'sessions': (self.backend.sessions_stamp, self._read_sessions),
+                         'goals': (self.backend.goals_stamp, self._read_goals)}
+        # Structures derived from the cached frames (e.g. the keyword index), stored along with the kinds of data they
+        # were built from. They are dropped whenever one of those frames is read again
+        self._derived = {}
+        # Memory taken by the cached data and the derived structures, in bytes, as measured when they last changed. It
+        # is read without the lock (see StorePool), so a store busy loading its data doesn't hold up other stores
+        self.cached_bytes = 0
+        # While a derived structure is being built, the cached frames are used without checking the storage again, so
+        # that everything it is built from (e.g. the rollup from which the goal status is evaluated) comes from the same
+        # version of the data, even if another process writes to the storage in the meantime
+        self._building = 0
+        # Sessions queued in write-behind mode as (ID, session) tuples, the IDs reserved for the next ones, and the
+        # increments of the rollup from the queued sessions, or None if the rollup was built with sessions queued
+        self._queued = []
+        self._reserved_ids = collections.deque()
+        self._queued_increments = []
+        # IDs of the goals whose status changed since it was last persisted, or None if the status was evaluated with
+        # sessions queued, in which case it is persisted in full
+        self._changed_goals = set()
+        # The journal of the queued sessions is only opened when the first session is queued
+        self.write_behind = write_behind
+        self._journal = None
+        _all_stores.add(self)
+        # Journals are replayed whatever the mode, as the data may have been written in write-behind mode before
+        self._replay_journals()
+
+    def _replay_journals(self):
+        # Writes the sessions journaled by processes that crashed before writing them to storage. Sessions that did make
+        # it to storage before the crash are recognised by their ID. Usually there are no journals, and the storage
+        # isn't locked at all
+        if not journal_paths(self.backend.journal_path):
+            return
+        with self._lock, self.backend.lock:
+            for _, records in orphaned_journals(self.backend.journal_path):
+                if not records:
+                    continue
+                stored_ids = set(self._get('sessions').ids.tolist())
+                records = [(session_id, session) for session_id, session in records if session_id not in stored_ids]
+                if records:
+                    session_ids = [session_id for session_id, _ in records]
+                    self.backend.append_sessions(sessions_to_frame([session for _, session in records], session_ids),
+                                                 session_ids=session_ids)
+
+    def _read_sessions(self):
+        sessions_df = self.backend.read_sessions()
+        with phase('parse'):
+            sessions = SessionTable.from_frame(sessions_df)
+            # Sessions still queued in write-behind mode come after the ones in storage
+            if self._queued:
+                sessions = sessions.append(self._queued_frame())
+            return sessions
+
+    def _queued_frame(self):
+        return sessions_to_frame([session for _, session in self._queued],
+                                 [session_id for session_id, _ in self._queued])
+
+    def _read_goals(self):
+        goals_df = self.backend.read_goals()
+        with phase('parse'):
+            return categorize_goals(goals_df)
+
+    def _get(self, kind):
+        stamp_function, read_function = self._readers[kind]
+        with self._lock:
+            cached = self._cache.get(kind)
+            if cached is not None and self._building:
+                return cached[1]
+            stamp = stamp_function()
+            if cached is None or cached[0] != stamp:
+                cached = (stamp, read_function())
+                self._cache[kind] = cached
+                self._drop_derived(kind)
+                self._record_memory_usage()
+            return cached[1]
+
+    def _drop_derived(self, kind):
+        for name in [name for name, (kinds, _) in self._derived.items() if kind in kinds]:
+            del self._derived[name]
+
+    def _get_derived(self, name, kinds, build_function):
+        with self._lock:
+            frames = [self._get(kind) for kind in kinds]
+            if name not in self._derived:
+                self._building += 1
+                try:
+                    self._derived[name] = (kinds, build_function(*frames))
+                finally:
+                    self._building -= 1
+                self._record_memory_usage()
+            return self._derived[name][1]
+
+    def _peek_derived(self, name):
+        # Returns a derived structure if it has already been built, without building it
+        return self._derived.get(name, (None, None))[1]
+
+    def _fingerprint(self, sessions, count=None):
+        # Fingerprint of the cached session log, or of its first count sessions. The content hash of the log is kept
+        # along with the derived structures, so it is computed once per read of the log and updated as sessions are
+        # added
+        sessions_hash = self._peek_derived('sessions_hash')
+        if sessions_hash is None:
+            sessions_hash = content_hash(sessions)
+            self._derived['sessions_hash'] = (('sessions',), sessions_hash)
+        if count is None or count == len(sessions):
+            return sessions_fingerprint(sessions, sessions_hash)
+        return [count, int(sessions.ids[:count].max()) if count else 0,
+                f'{int((sessions_hash - content_hash(sessions, count))[0]):016x}']
+
+    def _data_fingerprint(self, session_fingerprint, goals_df):
+        # Fingerprint of the cached goals along with the sessions of the given fingerprint. Like the content hash of the
+        # log, the hash of the goals is kept along with the derived structures, so it is computed once per read of the
+        # goals rather than for every save
+        goals_content_hash = self._peek_derived('goals_hash')
+        if goals_content_hash is None:
+            goals_content_hash = goals_hash(goals_df)
+            self._derived['goals_hash'] = (('goals',), goals_content_hash)
+        return data_fingerprint(session_fingerprint, goals_df, goals_content_hash)
+
+    def sessions(self):
+        """
+        Returns a snapshot of the session log with parsed dates and keyword lists, decoded from the compact form
+
+        """
+        return self._get('sessions').to_frame()
+
+    def goals(self):
+        """
+        Returns a snapshot of the period goals with parsed start and end dates, and categorical identifiers
+
+        """
+        return self._get('goals').copy()
+
+    def keyword_index(self):
+        """
+        Returns the keyword index of the current session log. It is built once per version of the log and updated
+        incrementally when sessions are added, and is shared between callers so it must not be modified
+
+        """
+        return self._get_derived('keyword_index', ('sessions',), KeywordIndex.from_sessions)
+
+    def session_page(self, page, page_size, first_day=None, last_day=None):
+        """
+        Returns one page of the session log, newest sessions first, along with the total number of pages. Only the
+        sessions on the requested page are copied out of the cache, and the date ordering is kept in an index that is
+        updated as sessions are added, so the cost does not depend on the length of the log. The log can be limited to
+        the sessions logged from first_day to last_day
+
+        """
+        with self._lock:
+            date_index = self._get_derived('date_index', ('sessions',), SessionDateIndex)
+            day_range = date_index.day_range(first_day, last_day)
+            page_count = max(1, -(-(day_range[1] - day_range[0]) // page_size))
+            start = (min(max(page, 1), page_count) - 1) * page_size
+            positions = date_index.newest_first(start, start + page_size, day_range)
+            return self._get('sessions').to_frame(positions), page_count
+
+    def _build_rollup(self, sessions):
+        # The rollup is persisted by the storage backend along with a fingerprint of the session log it was built
+        # from, so it only has to be built from the log if the log was changed outside the app. With sessions queued
+        # the log doesn't match the storage, so the rollup is built and only persisted once they have been written
+        if self._queued:
+            self._queued_increments = None
+            return DailyRollup.from_sessions(sessions, self.keyword_index())
+        fingerprint = self._fingerprint(sessions)
+        persisted = self.backend.read_rollup()
+        if persisted is not None and persisted[0] == fingerprint:
+            return DailyRollup.from_long(persisted[1])
+
+        rollup = DailyRollup.from_sessions(sessions, self.keyword_index())
+        self.backend.write_rollup(fingerprint, rollup.to_long())
+
+        return rollup
+
+    def rollup(self):
+        """
+        Returns the daily rollup of the session log, i.e. the number of sessions per day for the grand total and for
+        each activity group, activity name and keyword. It is updated incrementally when sessions are added, and is
+        shared between callers so it must not be modified
+
+        """
+        return self._get_derived('rollup', ('sessions',), self._build_rollup)
+
+    def rebuild_rollup(self):
+        """
+        Rebuilds the daily rollup (and the goal status evaluated from it) from the session log, ignoring what was
+        persisted before
+
+        """
+        with self._lock, self.backend.lock:
+            sessions = self._get('sessions')
+            rollup = DailyRollup.from_sessions(sessions, self.keyword_index())
+            self.backend.write_rollup(self._fingerprint(sessions), rollup.to_long())
+            self._derived['rollup'] = (('sessions',), rollup)
+            self._derived.pop('goal_status', None)
+            self._record_memory_usage()
+
+    def _build_goal_status(self, sessions, goals_df):
+        # The goal status is persisted by the storage backend along with a fingerprint of the data it was evaluated
+        # from, so it only has to be evaluated from scratch if the sessions or goals were changed outside the app
+        fingerprint = self._data_fingerprint(self._fingerprint(sessions), goals_df)
+        self._changed_goals = set() if not self._queued else None
+        persisted = self.backend.read_goal_status() if not self._queued else None
+        if persisted is not None and persisted[0] == fingerprint:
+            return goals_df.join(persisted[1])
+
+        status_df = evaluate_goals(goals_df, self.rollup())
+        status_df['Finalized'] = status_df['End date'] < pd.Timestamp.today().normalize()
+        if not self._queued:
+            self.backend.write_goal_status(fingerprint, status_df[GOAL_STATUS_COLUMNS])
+
+        return status_df
+
+    def _persist_goal_status(self, status_df, fingerprint, fingerprint_before):
+        # Writes the goal status to storage. Only the goals that changed since the status was last persisted are
+        # written, as long as the persisted status is the one for the data of fingerprint_before
+        if self._changed_goals is not None and self.backend.goal_status_fingerprint() == fingerprint_before:
+            updates_df = status_df.loc[sorted(self._changed_goals), GOAL_STATUS_COLUMNS]
+            self.backend.update_goal_status(fingerprint, updates_df, lambda: status_df[GOAL_STATUS_COLUMNS])
+        else:
+            self.backend.write_goal_status(fingerprint, status_df[GOAL_STATUS_COLUMNS])
+        self._changed_goals = set()
+
+    def goal_status(self):
+        """
+        Returns a snapshot of the period goals along with their materialised status; the number of relevant sessions
+        logged within each goal window ('Progress'), whether the target was reached ('Satisfied') and whether the goal
+        has ended and its status is final ('Finalized'). The status is kept up to date incrementally as sessions are
+        added, rather than being evaluated again for every callback
+
+        """
+        with self._lock:
+            status_df = self._get_derived('goal_status', ('sessions', 'goals'), self._build_goal_status)
+            # Goals whose end date has passed since the last call are finalized
+            newly_finalized = finalize_goals(status_df, pd.Timestamp.today().normalize())
+            if newly_finalized.any():
+                if self._changed_goals is not None:
+                    self._changed_goals.update(status_df.index[newly_finalized])
+                if not self._queued:
+                    with self.backend.lock:
+                        fingerprint = self._data_fingerprint(self._fingerprint(self._get('sessions')),
+                                                             self._get('goals'))
+                        self._persist_goal_status(status_df, fingerprint, fingerprint)
+            return status_df.copy()
+
+    def write_sessions(self, sessions_df):
+        """
+        Writes the full session log to the storage backend and makes sure the next read picks it up, even if the file
+        stamp happens to be unchanged
+
+        """
+        with self._lock, self.backend.lock:
+            self.backend.write_sessions(sessions_df)
+            self.invalidate('sessions')
+
+    def add_session(self, session):
+        """
+        Appends a single session through the storage backend and returns its ID. If the cached session log was up to
+        date before the write, the new session is added to it (and to the indexes built from it) directly instead of
+        reading the whole log again. In write-behind mode the session is queued instead, see queue_session.
+
+        The backend lock is held from reading the stamp until all derived data has been persisted, so another process
+        (e.g. a second gunicorn worker) can't append a session in between, which would otherwise go missing from the
+        cache or from the persisted rollup
+
+        """
+        if self.write_behind:
+            return self.queue_session(session)
+
+        with self._lock, self.backend.lock:
+            stamp_before = self.backend.sessions_stamp()
+            session_id = self.backend.append_session(session)
+
+            cached = self._cache.get('sessions')
+            if cached is not None and cached[0] == stamp_before:
+                new_row = sessions_to_frame([session], [session_id])
+                # The fingerprint of the log before the session is only needed to persist the rollup (and the goal
+                # status evaluated from it) incrementally
+                fingerprint_before = self._fingerprint(cached[1]) if self._peek_derived('rollup') is not None else None
+                self._cache['sessions'] = (self.backend.sessions_stamp(), cached[1].append(new_row))
+                increments_df = self._add_to_derived(len(cached[1]), new_row)
+                self._persist_derived(fingerprint_before, increments_df)
+            else:
+                self.invalidate('sessions')
+
+            return session_id
+
+    def queue_session(self, session):
+        """
+        Queues a session to be written to storage in the background and returns its ID, which is taken from a block
+        reserved in storage. Only the journal is written before returning. The session is added to the cached log and
+        the structures derived from it straight away, the same way as when it is written directly
+
+        """
+        with self._lock:
+            if not self._reserved_ids:
+                with self.backend.lock:
+                    stamp_before = self.backend.sessions_stamp()
+                    first_id = self.backend.reserve_session_ids(ID_BLOCK)
+                    # Reserving IDs may change the stamp of the sessions (for the CSV files the manifest is written)
+                    # but not the sessions, so a cached log that was up to date still is
+                    cached = self._cache.get('sessions')
+                    if cached is not None and cached[0] == stamp_before:
+                        self._cache['sessions'] = (self.backend.sessions_stamp(), cached[1])
+                self._reserved_ids.extend(range(first_id, first_id + ID_BLOCK))
+            session_id = self._reserved_ids.popleft()
+
+            if self._journal is None:
+                self._journal = SessionJournal(self.backend.journal_path)
+                # The journal is closed along with the store, or when the process exits after the last flush
+                weakref.finalize(self, self._journal.close).atexit = False
+            self._journal.append(session_id, session)
+            self._queued.append((session_id, session))
+
+            cached = self._cache.get('sessions')
+            if cached is not None:
+                new_row = sessions_to_frame([session], [session_id])
+                self._cache['sessions'] = (cached[0], cached[1].append(new_row))
+                increments_df = self._add_to_derived(len(cached[1]), new_row)
+                if increments_df is not None and self._queued_increments is not None:
+                    self._queued_increments.append(increments_df)
+
+            schedule_flush(self, now=len(self._queued) >= FLUSH_SIZE)
+            return session_id
+
+    def flush(self):
+        """
+        Writes the sessions queued in write-behind mode to storage in a single batch, along with the rollup and goal
+        status they were added to, and clears the journal. Returns the number of sessions written
+
+        """
+        with self._lock:
+            if not self._queued or os.getpid() != self._journal.pid:
+                return 0
+            with self.backend.lock:
+                stamp_before = self.backend.sessions_stamp()
+                count = len(self._queued)
+                self.backend.append_sessions(self._queued_frame(),
+                                             session_ids=[session_id for session_id, _ in self._queued])
+                self._queued = []
+                increments = self._queued_increments
+                self._queued_increments = []
+
+                cached = self._cache.get('sessions')
+                if cached is not None and cached[0] == stamp_before:
+                    # The cached log ends with the sessions that were queued, so it now matches the storage again
+                    sessions = cached[1]
+                    self._cache['sessions'] = (self.backend.sessions_stamp(), sessions)
+                    fingerprint_before = (self._fingerprint(sessions, len(sessions) - count)
+                                          if self._peek_derived('rollup') is not None else None)
+                    self._persist_derived(fingerprint_before,
+                                          pd.concat(increments) if increments else None)
+                else:
+                    self.invalidate('sessions')
+
+                self._journal.clear()
+                return count
+
+    def _add_to_derived(self, position, new_row):
+        # Adds a new session, at the given position of the cached log, to the structures derived from the log. Returns
+        # the increments of the rollup, or None if the rollup hasn't been built
+        keyword_index = self._peek_derived('keyword_index')
+        if keyword_index is not None:
+            keyword_index.add_session(new_row['Date'].iloc[0], new_row['Keywords'].iloc[0])
+
+        date_index = self._peek_derived('date_index')
+        if date_index is not None:
+            date_index.add_session(position, new_row['Date'].iloc[0])
+
+        sessions_hash = self._peek_derived('sessions_hash')
+        if sessions_hash is not None:
+            sessions_hash += content_hash(self._cache['sessions'][1], position)
+
+        # The rollup only gets one cell incremented per key of the session
+        rollup = self._peek_derived('rollup')
+        increments_df = rollup.add_session(new_row.iloc[0]) if rollup is not None else None
+
+        # Only the goals whose window and identifier match the new session have to be updated
+        status_df = self._peek_derived('goal_status')
+        if status_df is not None and 'goals' in self._cache:
+            matches = add_session_to_goals(status_df, new_row.iloc[0])
+            if self._changed_goals is not None:
+                self._changed_goals.update(status_df.index[matches])
+
+        self._record_memory_usage()
+        return increments_df
+
+    def _persist_derived(self, fingerprint_before, increments_df):
+        # Persists the rollup and goal status after sessions were added to the cached log and written to storage.
+        # Only the increments of the rollup are written, as long as the persisted rollup is the one for the log
+        # before the sessions were added, which may not be the case if another process rebuilt it in the meantime
+        rollup = self._peek_derived('rollup')
+        if rollup is not None:
+            fingerprint = self._fingerprint(self._cache['sessions'][1])
+            if increments_df is not None and self.backend.rollup_fingerprint() == fingerprint_before:
+                self.backend.add_to_rollup(fingerprint, increments_df, rollup.to_long)
+            else:
+                self.backend.write_rollup(fingerprint, rollup.to_long())
+
+        # Likewise only the goals the sessions counted towards are written
+        status_df = self._peek_derived('goal_status')
+        if status_df is not None and 'goals' in self._cache:
+            goals_df = self._cache['goals'][1]
+            fingerprint = self._data_fingerprint(self._fingerprint(self._cache['sessions'][1]), goals_df)
+            self._persist_goal_status(status_df, fingerprint, self._data_fingerprint(fingerprint_before, goals_df)
+                                      if fingerprint_before is not None else None)
+
+    def compact_sessions(self):
+        """
+        Explicitly compacts the session storage (for the CSV backend this is an atomic rewrite of the log). The
+        persisted rollup is rewritten as well, which folds in the increments appended to it since it was last written
+
+        """
+        with self._lock, self.backend.lock:
+            self.backend.compact_sessions()
+            self.invalidate('sessions')
+            # Compacting doesn't change the fingerprint of the log, so the persisted rollup is still used if it is up to
+            # date. With sessions queued it isn't persisted until they are written
+            rollup = self.rollup()
+            if not self._queued:
+                self.backend.write_rollup(self._fingerprint(self._get('sessions')), rollup.to_long())
+
+    def write_goals(self, goals_df):
+        with self._lock, self.backend.lock:
+            self.backend.write_goals(goals_df)
+            self.invalidate('goals')
+
+    def version(self):
+        """
+        Returns a short token identifying the current version of the data, which changes whenever the sessions or goals
+        are written. It is derived from the storage stamps rather than counted in this process, so every worker serving
+        the app gives the same token for the same data, and it is cheap to get since nothing is read
+
+        """
+        stamps = (self.user, self.backend.sessions_stamp(), self.backend.goals_stamp())
+        # Sessions queued in write-behind mode are only known to this process
+        queued = self._queued
+        if queued:
+            stamps += (queued[-1][0],)
+        return hashlib.sha1(repr(stamps).encode()).hexdigest()[:16]
+
+    def memory_usage(self):
+        """
+        Estimate of the memory taken by the cached data and the structures derived from it, in bytes
+
+        """
+        with self._lock:
+            return self._record_memory_usage()
+
+    def _record_memory_usage(self):
+        # Measures the cached data and derived structures, with the lock held, and records the size in cached_bytes
+        cached = [data for _, data in self._cache.values()] + [data for _, data in self._derived.values()]
+        self.cached_bytes = sum(int(data.memory_usage().sum()) if isinstance(data, pd.DataFrame) else data.nbytes
+                                for data in cached)
+        return self.cached_bytes
+
+    def invalidate(self, kind=None):
+        """
+        Drops the cached frame for the given kind of data ('sessions' or 'goals', or both if nothing is given) so that
+        the next read parses it again
+
+        """
+        with self._lock:
+            if kind is None:
+                self._cache.clear()
+                self._derived.clear()
+            else:
+                self._cache.pop(kind, None)
+                self._drop_derived(kind)
+            self._record_memory_usage()
+
+
+class StorePool:
+    """
+    Data stores of many users, each reading from the user's own data partition (see storage.partition_backend) and
+    keeping its own caches. The stores are kept in least-recently-used order, and when there are more than max_stores
+    of them or their cached data takes more than max_bytes, the stores of the least recently active users are dropped.
+    The data of active users therefore stays in memory, while the memory of the process stays bounded however many
+    users there are
+
+    """
+    def __init__(self, directory, max_stores=USER_STORES, max_bytes=USER_CACHE_MB * 2 ** 20):
+        self.directory = directory
+        self.max_stores = max_stores
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._stores = collections.OrderedDict()
+        _all_pools.add(self)
+
+    def get(self, user):
+        """
+        Returns the store of a user, creating it (and the user's partition) if needed. The user name is used as the
+        name of the partition directory, so it has to be validated by the caller
+
+        """
+        with self._lock:
+            store = self._stores.get(user)
+            if store is None:
+                store = DataStore(partition_backend(os.path.join(self.directory, user)), user)
+                self._stores[user] = store
+            self._stores.move_to_end(user)
+            self._evict()
+            return store
+
+    def _evict(self):
+        # The most recently used store is never dropped, since it is about to be used. A dropped store keeps working
+        # for callbacks still holding it, and its memory is freed once they are done. The sizes recorded by the stores
+        # are used, as measuring a store takes its lock, which is held while it loads or builds its data
+        while len(self._stores) > max(self.max_stores, 1):
+            self._stores.popitem(last=False)
+        total = sum(store.cached_bytes for store in self._stores.values())
+        while total > self.max_bytes and len(self._stores) > 1:
+            _, store = self._stores.popitem(last=False)
+            total -= store.cached_bytes
+
+    def users(self):
+        with self._lock:
+            return list(self._stores)
+
+
+# Every pool and store of this process. Background callbacks run in forked processes, and all their locks are held
+# while forking, so a process never starts with a copy of a cache that another thread was halfway through updating.
+# The pools are locked first, in the same order as StorePool.get takes the locks
+_all_pools = weakref.WeakSet()
+_all_stores = weakref.WeakSet()
+_forking_locks = []
+
+
+def _acquire_locks():
+    _forking_locks.extend(pool._lock for pool in list(_all_pools))
+    _forking_locks.extend(store._lock for store in list(_all_stores))
+    for lock in _forking_locks:
+        lock.acquire()
+
+
+def _release_locks():
+    for lock in _forking_locks:
+        lock.release()
+    _forking_locks.clear()
+
+
+os.register_at_fork(before=_acquire_locks, after_in_parent=_release_locks, after_in_child=_release_locks)
+
+# Shared store used by the dash app when it serves a single user, and by the helper scripts
+store = DataStore()
+
+# Stores of the users when the app serves many users
+user_stores = StorePool(USERS_DIR) if USERS_DIR else None
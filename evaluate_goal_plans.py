@@ -0,0 +1,220 @@
+import argparse
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from create_periodic_goals import GOAL_SPECS
+from data_store import DataStore, USERS_DIR, USER_PATTERN
+from goal_generation import goal_windows
+from storage import partition_backend
+
+# The rollup is sent to each worker process once, when the pool is started
+_worker_rollup = None
+
+
+def period_label(spec):
+    """
+    Short description of the period of a recurrence spec, e.g. 'weekly', '2-weekly' or 'monthly'
+
+    """
+    every = spec.get('every', 1)
+    if spec['period'] == 'custom':
+        return f"{spec['freq']} ({spec['length']} days)"
+    return spec['period'] if every == 1 else f"{every}-{spec['period']}"
+
+
+def anchor_to_history(spec, first_day):
+    """
+    Moves the anchor of a spec back by whole periods to the earliest window start on or after first_day, so that the
+    goals cover the whole history without changing which days the windows start on. Windows starting before the first
+    session are left out, as the sessions logged before then are unknown
+
+    """
+    anchor = pd.Timestamp(spec['anchor'])
+    every = spec.get('every', 1)
+    if spec['period'] == 'weekly':
+        anchor -= pd.Timedelta(weeks=every) * ((anchor - first_day).days // (7 * every))
+    elif spec['period'] == 'monthly':
+        # Monthly windows start on the first of the month of the anchor, so the first month has to start after
+        # first_day
+        first_month = (first_day - pd.Timedelta(days=1)).to_period('M') + 1
+        months = every * ((anchor.to_period('M') - first_month).n // every)
+        anchor = anchor.replace(day=1) - pd.DateOffset(months=months)
+    else:
+        # The frequency can be any pandas frequency, so the anchor is moved back in jumps of steps that double in size
+        # as long as they stay on or after first_day, and then halve again
+        step = pd.tseries.frequencies.to_offset(spec['freq'])
+        jump = 1
+        while anchor - step * (2 * jump) >= first_day:
+            jump *= 2
+        while jump >= 1:
+            if anchor - step * jump >= first_day:
+                anchor -= step * jump
+            jump //= 2
+
+    return dict(spec, anchor=anchor)
+
+
+def _init_worker(rollup):
+    global _worker_rollup
+    _worker_rollup = rollup
+
+
+def _spec_key(spec):
+    # Specs with the same key have the same goal windows and progress, and only differ in their quantities or labels
+    return json.dumps({name: value for name, value in spec.items() if name not in ('quantity', 'label')},
+                      sort_keys=True, default=str)
+
+
+def spec_progress(spec, start_year, end_year, today):
+    """
+    Progress of the goals of a recurrence spec that end in the year range and before today, i.e. the number of relevant
+    sessions logged within each goal window, taken from the rollup of the worker without building the goal frames. The
+    sessions are counted in the same way as goal_evaluation.evaluate_goals does, so only 'Count' goals make progress
+
+    """
+    starts, ends = goal_windows(spec, start_year, end_year)
+    ended = ends < today
+    if spec.get('condition', 'Count') != 'Count':
+        return np.zeros(int(ended.sum()), dtype=np.int64)
+    return _worker_rollup.count(spec['level'], spec['identifier'], starts[ended], ends[ended])
+
+
+def _progress_task(task):
+    return spec_progress(*task)
+
+
+def evaluate_plans(plans, rollup, today=None, workers=None):
+    """
+    Scores each plan, a (name, recurrence specs) pair, against the whole history of the rollup as if its goals had been
+    set from the first session on. Returns one row per plan, identifier and period with the number of goals that ended
+    before today, how many of them were satisfied and the satisfaction rate.
+
+    Counting the sessions within the goal windows is what takes the time, and plans often share specs that only differ
+    in their quantities (e.g. variants of the same plan), so the progress of each distinct spec is evaluated only once,
+    split over a process pool by spec and block of years. Scoring a plan then only compares the progress to its
+    quantities
+
+    """
+    today = pd.Timestamp.today().normalize() if today is None else pd.Timestamp(today)
+    first_day = rollup.first_day
+    plans = [(name, [(_spec_key(spec), spec) for spec in specs]) for name, specs in plans]
+    distinct_specs = {}
+    for _, specs in plans:
+        for key, spec in specs:
+            if key not in distinct_specs:
+                distinct_specs[key] = anchor_to_history(spec, first_day)
+
+    # Evaluating all years of a spec at once is much cheaper than one year at a time, so the years are only split into
+    # blocks when there are too few distinct specs to keep the workers busy
+    workers = workers or os.cpu_count()
+    years = np.arange(first_day.year, today.year + 1)
+    block_count = min(len(years), -(-4 * workers // max(len(distinct_specs), 1)))
+    year_blocks = [(int(block[0]), int(block[-1])) for block in np.array_split(years, block_count)]
+    tasks = [(spec, start_year, end_year, today) for spec in distinct_specs.values()
+             for start_year, end_year in year_blocks]
+
+    if workers == 1:
+        _init_worker(rollup)
+        results = [_progress_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(rollup,)) as pool:
+            results = pool.map(_progress_task, tasks)
+    progress = {key: np.concatenate(results[position * block_count:(position + 1) * block_count])
+                for position, key in enumerate(distinct_specs)}
+
+    records = []
+    for name, specs in plans:
+        for key, spec in specs:
+            spec_goals = progress[key]
+            if len(spec_goals):
+                count_goal = spec.get('condition', 'Count') == 'Count'
+                satisfied = int((spec_goals >= spec['quantity']).sum()) if count_goal else 0
+                records.append((name, spec['identifier'], period_label(spec), len(spec_goals), satisfied))
+
+    scores_df = pd.DataFrame(records, columns=['Plan', 'Identifier', 'Period', 'Goals', 'Satisfied'])
+    scores_df['Plan'] = pd.Categorical(scores_df['Plan'], categories=list(dict.fromkeys(name for name, _ in plans)))
+    scores_df = scores_df.groupby(['Plan', 'Identifier', 'Period'], observed=True, sort=False)[
+        ['Goals', 'Satisfied']].sum().reset_index()
+    scores_df['Rate'] = scores_df['Satisfied'] / scores_df['Goals']
+
+    return scores_df
+
+
+def comparison_table(scores_df):
+    """
+    One row per plan with its overall satisfaction rate and number of goals, followed by the satisfaction rate of each
+    identifier and period. Identifiers or periods a plan doesn't have are left empty
+
+    """
+    totals_df = scores_df.groupby('Plan', observed=True, sort=False)[['Goals', 'Satisfied']].sum()
+    rates_df = scores_df.pivot_table(index='Plan', columns=['Identifier', 'Period'], values='Rate', observed=True,
+                                     sort=False)
+    rates_df.columns = [f'{identifier} ({period})' for identifier, period in rates_df.columns]
+
+    return pd.concat([pd.DataFrame({'Rate': totals_df['Satisfied'] / totals_df['Goals'], 'Goals': totals_df['Goals']}),
+                      rates_df], axis=1)
+
+
+def read_plans(path):
+    """
+    Reads candidate plans from a JSON file holding an object that maps plan names to lists of recurrence specs, in the
+    same format as GOAL_SPECS in create_periodic_goals.py
+
+    """
+    with open(path) as plans_file:
+        return list(json.load(plans_file).items())
+
+
+def scaled_plans(plans, factors):
+    """
+    Variants of the plans with the target quantity of every goal multiplied by each factor, rounded and at least 1
+
+    """
+    if factors == [1]:
+        return plans
+    return [(f'{name} x{factor:g}', [dict(spec, quantity=max(1, round(spec['quantity'] * factor))) for spec in specs])
+            for name, specs in plans for factor in factors]
+
+
+if __name__ == '__main__':
+    """
+    This script scores candidate goal plans against the whole session history, without touching the goals of the
+    dashboard, to help tune the targets in create_periodic_goals.py. Each plan is a list of recurrence specs; the plans
+    are read from JSON files (see read_plans), or the specs of create_periodic_goals.py are taken as the 'current' plan.
+    With --scale, variants of each plan with all quantities scaled are compared as well.
+
+    For every plan the goals are generated from the first session on, evaluated on the daily rollup by a pool of worker
+    processes, and the share of ended goals that were satisfied is printed per plan, identifier and period. The backend
+    is chosen in the same way as for the app, through the PRODUCTIVITY_STORAGE environment variable
+    """
+    parser = argparse.ArgumentParser(description='Compare the satisfaction rates of goal plans over the whole history')
+    parser.add_argument('plans', nargs='*', help='JSON files of plans to compare (default: the current goal specs)')
+    parser.add_argument('--scale', type=float, nargs='+', default=[1],
+                        help='Factors to scale the quantities of each plan by, one variant per factor')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--user', help='User whose partition of PRODUCTIVITY_USERS_DIR to evaluate against')
+    parser.add_argument('--output', help='CSV file to write the rate of every plan, identifier and period to')
+    args = parser.parse_args()
+
+    if args.user is not None:
+        if USERS_DIR is None:
+            parser.error('--user requires PRODUCTIVITY_USERS_DIR to be set')
+        if not USER_PATTERN.fullmatch(args.user):
+            parser.error(f'--user {args.user!r} is not a valid user name')
+        store = DataStore(partition_backend(os.path.join(USERS_DIR, args.user)))
+    else:
+        store = DataStore()
+
+    plans = [plan for path in args.plans for plan in read_plans(path)] or [('current', GOAL_SPECS)]
+    scores_df = evaluate_plans(scaled_plans(plans, args.scale), store.rollup(), workers=args.workers)
+
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None,
+                           'display.float_format', '{:.0%}'.format):
+        print(comparison_table(scores_df))
+
+    if args.output is not None:
+        scores_df.to_csv(args.output, index=False)
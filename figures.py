@@ -0,0 +1,98 @@
+import base64
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+# Maximum number of points sent to the browser per trace. Traces with more change points than this within the visible
+# range are downsampled
+MAX_POINTS = 2000
+
+# WebGL traces render much faster in the browser when there are many points, but don't work without a GPU in some
+# browsers, so they are only used when switched on with the PRODUCTIVITY_WEBGL environment variable
+USE_WEBGL = bool(os.environ.get('PRODUCTIVITY_WEBGL'))
+
+
+# Granularities the graphs can be aggregated to, with the pandas period each plotted point stands for. Weeks end on
+# Sunday
+GRANULARITIES = {'daily': 'D', 'weekly': 'W', 'monthly': 'M'}
+
+
+def period_ends(start, end, granularity='daily'):
+    """
+    The days the graphs are plotted on for the window from start to end (both included); every day, or the last day of
+    each week or month, where the last period is cut off at the end of the window. Cumulative values are taken at the
+    end of each period, so a point stands for everything up to and including its period
+
+    """
+    date_list = pd.date_range(start, end)
+    if granularity == 'daily' or len(date_list) == 0:
+        return date_list
+    ends = date_list.to_period(GRANULARITIES[granularity]).unique().end_time.normalize()
+    return ends.where(ends <= date_list[-1], date_list[-1])
+
+
+def scatter(**kwargs):
+    """
+    Returns a scatter trace, rendered with WebGL if switched on
+
+    """
+    return go.Scattergl(**kwargs) if USE_WEBGL else go.Scatter(**kwargs)
+
+
+def encode_matrix(matrix):
+    """
+    Encodes an integer matrix as base64 of its little-endian int32 values in row-major order, which the browser can
+    decode straight into an Int32Array. This is far more compact than a JSON list of lists
+
+    """
+    return base64.b64encode(np.ascontiguousarray(matrix, dtype='<i4').tobytes()).decode('ascii')
+
+
+def visible_range(relayout_data):
+    """
+    Returns the x-range the user zoomed in to as a tuple of two timestamps, from the relayoutData of a graph, or None if
+    the whole range is shown
+
+    """
+    if not relayout_data:
+        return None
+    if 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        return pd.Timestamp(relayout_data['xaxis.range[0]']), pd.Timestamp(relayout_data['xaxis.range[1]'])
+    if 'xaxis.range' in relayout_data:
+        return pd.Timestamp(relayout_data['xaxis.range'][0]), pd.Timestamp(relayout_data['xaxis.range'][1])
+    return None
+
+
+def _window(date_list, x_range):
+    # Positions of the first and last day of date_list to plot; the days within the visible range, along with the day
+    # before and after it so the lines run on to the edges of the graph
+    if x_range is None:
+        return 0, len(date_list)
+    start = max(date_list.searchsorted(x_range[0], side='right') - 1, 0)
+    stop = min(date_list.searchsorted(x_range[1], side='left') + 1, len(date_list))
+    return start, max(stop, start)
+
+
+def step_points(date_list, values, x_range=None, max_points=MAX_POINTS):
+    """
+    Reduces a daily series, such as a cumulative count, to the days on which its value changes, along with the first
+    and last day. Drawn with line_shape='hv' this gives exactly the same line as plotting every day, but for a
+    cumulative count there are usually far fewer change points than days. Only the points within the visible x-range
+    are kept, and if there are still more than max_points they are thinned out evenly. Returns the x and y values
+
+    """
+    start, stop = _window(date_list, x_range)
+    dates, values = date_list[start:stop], np.asarray(values)[start:stop]
+    if len(values) == 0:
+        return dates, values
+
+    changes = np.ones(len(values), dtype=bool)
+    changes[1:] = values[1:] != values[:-1]
+    changes[-1] = True
+    positions = np.flatnonzero(changes)
+    if len(positions) > max_points:
+        positions = positions[np.unique(np.linspace(0, len(positions) - 1, max_points).round().astype(int))]
+
+    return dates[positions], values[positions]
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+from aggregation import day_values
+
+
+def evaluate_goals(goals_df, rollup):
+    """
+    Evaluates all goals in one call. Returns a copy of the goals with a 'Progress' column, the number of relevant
+    sessions logged within the goal window, and a 'Satisfied' column indicating whether the target quantity was
+    reached. The session counts are taken from the daily rollup of the session log, with the goals evaluated in groups
+    sharing the same identifier and each group answered with one vectorised lookup in the cumulative counts. Only the
+    'Count' condition type is supported so far, other goals get a progress of 0
+
+    """
+    goals_df = goals_df.copy()
+    progress = np.zeros(goals_df.shape[0], dtype=np.int64)
+
+    count_goals = (goals_df['Condition type'] == 'Count').to_numpy()
+    groups = goals_df[count_goals].groupby(['Identifier level', 'Identifier'], dropna=False).indices
+
+    count_positions = np.flatnonzero(count_goals)
+    for (level, identifier), group_positions in groups.items():
+        positions = count_positions[group_positions]
+        progress[positions] = rollup.count(level, identifier,
+                                           goals_df['Start date'].iloc[positions],
+                                           goals_df['End date'].iloc[positions])
+
+    goals_df['Progress'] = progress
+    goals_df['Satisfied'] = count_goals & (progress >= goals_df['Quantity'].to_numpy())
+
+    return goals_df
+
+
+def session_matches_goals(goals_df, session):
+    """
+    Boolean mask of the goals a single session counts towards, i.e. the 'Count' goals whose window contains the session
+    date and whose identifier matches the session's activity group, activity name or one of its keywords
+
+    """
+    levels = goals_df['Identifier level'].to_numpy()
+    date = pd.Timestamp(session['Date']).normalize()
+
+    # The identifiers are categorical, so the session's values are looked up in the categories once and the goals are
+    # matched on the integer codes. Values that no goal has get code -2, which matches nothing
+    identifiers = goals_df['Identifier'].astype('category')
+    codes = identifiers.cat.codes.to_numpy()
+    session_codes = identifiers.cat.categories.get_indexer([session['Activity group'], session['Activity name']] +
+                                                           list(session['Keywords']))
+    session_codes[session_codes < 0] = -2
+
+    matches_identifier = ((levels == 0) |
+                          ((levels == 1) & (codes == session_codes[0])) |
+                          ((levels == 2) & (codes == session_codes[1])) |
+                          ((levels == 3) & np.isin(codes, session_codes[2:])))
+
+    return ((goals_df['Condition type'] == 'Count').to_numpy() & matches_identifier &
+            (goals_df['Start date'] <= date).to_numpy() & (date <= goals_df['End date']).to_numpy())
+
+
+def add_session_to_goals(status_df, session):
+    """
+    Updates an evaluated goal frame in place with a newly logged session; only the goals the session counts towards
+    get their progress and satisfied status updated. Returns the mask of updated goals
+
+    """
+    matches = session_matches_goals(status_df, session)
+    status_df.loc[matches, 'Progress'] += 1
+    status_df.loc[matches, 'Satisfied'] = status_df.loc[matches, 'Progress'] >= status_df.loc[matches, 'Quantity']
+
+    return matches
+
+
+def finalize_goals(status_df, today):
+    """
+    Marks the goals whose end date has passed as finalized, in place. Returns the mask of newly finalized goals
+
+    """
+    newly_finalized = (~status_df['Finalized'] & (status_df['End date'] < today)).to_numpy()
+    status_df.loc[newly_finalized, 'Finalized'] = True
+
+    return newly_finalized
+
+
+def goals_in_period(goals_df, period, today):
+    """
+    Boolean mask of the goals in a period relative to today; 'active' goals have a window including today, 'past'
+    goals ended on or before today, and 'future' goals start on or after today
+
+    """
+    if period == 'active':
+        return (goals_df['Start date'] <= today) & (today <= goals_df['End date'])
+    elif period == 'past':
+        return today >= goals_df['End date']
+    return today <= goals_df['Start date']
+
+
+def cumulative_goal_counts(goals_df, date_list, identifier=None):
+    """
+    For each day in date_list, the number of goals (optionally only those with the given identifier) that have ended
+    on or before that day, and how many of those were satisfied. Expects the goals to have been evaluated already
+
+    """
+    if identifier is not None:
+        goals_df = goals_df[goals_df['Identifier'] == identifier]
+
+    days = day_values(date_list)
+    end_days = np.sort(day_values(goals_df['End date']))
+    satisfied_end_days = np.sort(day_values(goals_df.loc[goals_df['Satisfied'], 'End date']))
+
+    return end_days.searchsorted(days, side='right'), satisfied_end_days.searchsorted(days, side='right')
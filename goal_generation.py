@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+from storage import GOAL_COLUMNS
+
+# Columns identifying a goal. Two goals with the same values in these columns are the same goal, which is used to avoid
+# adding goals that already exist when extending the goal horizon
+GOAL_KEY_COLUMNS = ['Start date', 'End date', 'Identifier level', 'Identifier', 'Condition type']
+
+
+def goal_windows(spec, start_year, end_year):
+    """
+    Materialises the goal windows of a single recurrence spec as two arrays of start and end dates. Only windows that
+    end within the year range (both years included) are kept.
+
+    The spec is a dict with a 'period' key, which is one of
+        - 'weekly': windows of 'every' weeks (default 1), starting on the 'anchor' date
+        - 'monthly': windows of 'every' calendar months (default 1), starting on the first of the month of 'anchor'
+        - 'custom': windows starting at each date of pd.date_range(anchor, freq=spec['freq']) and lasting
+          'length' days
+
+    """
+    anchor = pd.Timestamp(spec['anchor'])
+    horizon_end = pd.Timestamp(year=end_year, month=12, day=31)
+    every = spec.get('every', 1)
+
+    if spec['period'] == 'weekly':
+        starts = pd.date_range(anchor, horizon_end, freq=pd.Timedelta(weeks=every))
+        ends = starts + pd.Timedelta(weeks=every) - pd.Timedelta(days=1)
+    elif spec['period'] == 'monthly':
+        starts = pd.date_range(anchor.replace(day=1), horizon_end, freq=pd.offsets.MonthBegin(every))
+        ends = starts + pd.offsets.MonthEnd(every)
+    elif spec['period'] == 'custom':
+        starts = pd.date_range(anchor, horizon_end, freq=spec['freq'])
+        ends = starts + pd.Timedelta(days=spec['length'] - 1)
+    else:
+        raise ValueError(f"Unknown goal period '{spec['period']}', expected 'weekly', 'monthly' or 'custom'")
+
+    in_range = (ends.year >= start_year) & (ends.year <= end_year)
+
+    return starts[in_range], ends[in_range]
+
+
+def generate_goals(specs, start_year, end_year):
+    """
+    Materialises a list of recurrence specs into one goal dataframe in the same format as Period_goals.csv. Besides
+    the keys used by goal_windows, each spec has an 'identifier', its 'level' (see create_periodic_goals.py) and a
+    target 'quantity', and optionally a 'label' (defaults to the identifier) and 'condition' (defaults to 'Count')
+
+    """
+    frames = []
+    for spec in specs:
+        starts, ends = goal_windows(spec, start_year, end_year)
+        frames.append(pd.DataFrame({'Start date': starts,
+                                    'End date': ends,
+                                    'Label': spec.get('label', spec['identifier']),
+                                    'Identifier level': spec['level'],
+                                    'Identifier': spec['identifier'],
+                                    'Condition type': spec.get('condition', 'Count'),
+                                    'Quantity': spec['quantity']}))
+
+    if not frames:
+        return pd.DataFrame(columns=GOAL_COLUMNS)
+
+    return pd.concat(frames, ignore_index=True)[GOAL_COLUMNS]
+
+
+def extend_goals(existing_goals_df, specs, start_year, end_year):
+    """
+    Generates the goals of the specs for the year range and adds the ones that don't exist yet to the existing goals.
+    Existing goals keep their IDs and are left untouched, the new goals get IDs following the largest existing ID.
+    Returns the combined goals and the number of goals added
+
+    """
+    generated_df = generate_goals(specs, start_year, end_year)
+
+    existing_keys = pd.MultiIndex.from_frame(existing_goals_df[GOAL_KEY_COLUMNS])
+    new_goals_df = generated_df[~pd.MultiIndex.from_frame(generated_df[GOAL_KEY_COLUMNS]).isin(existing_keys)]
+
+    first_id = int(existing_goals_df.index.max()) + 1 if existing_goals_df.shape[0] else 0
+    new_goals_df.index = pd.RangeIndex(first_id, first_id + new_goals_df.shape[0])
+
+    return pd.concat([existing_goals_df, new_goals_df]), new_goals_df.shape[0]
+
+
+def replace_goals(existing_goals_df, specs, start_year, end_year):
+    """
+    Generates the goals of the specs for the year range to replace the existing goals. Generated goals that match an
+    existing goal on GOAL_KEY_COLUMNS keep its ID (taking over the label and quantity of the specs), so regenerating
+    unchanged specs gives back the same goals under the same IDs. The other generated goals get IDs following the
+    largest existing ID, and existing goals that aren't generated any more are dropped. Returns the goals, ordered by
+    ID, and the number of goals added
+
+    """
+    generated_df = generate_goals(specs, start_year, end_year)
+
+    # An existing goal can only be matched once, so of duplicate goals only the first keeps an existing ID
+    existing_keys = pd.MultiIndex.from_frame(existing_goals_df[GOAL_KEY_COLUMNS])
+    unique_existing = ~existing_keys.duplicated()
+    generated_keys = pd.MultiIndex.from_frame(generated_df[GOAL_KEY_COLUMNS])
+    positions = existing_keys[unique_existing].get_indexer(generated_keys)
+    positions[generated_keys.duplicated()] = -1
+
+    new = positions < 0
+    first_id = int(existing_goals_df.index.max()) + 1 if existing_goals_df.shape[0] else 0
+    ids = np.empty(generated_df.shape[0], dtype=np.int64)
+    ids[~new] = existing_goals_df.index[unique_existing][positions[~new]]
+    ids[new] = np.arange(first_id, first_id + new.sum())
+    generated_df.index = pd.Index(ids, name=existing_goals_df.index.name)
+
+    return generated_df.sort_index(), int(new.sum())
@@ -0,0 +1,270 @@
+import argparse
+import collections
+import hashlib
+import itertools
+import json
+import os
+import re
+import zoneinfo
+
+import dateutil.tz
+import numpy as np
+import pandas as pd
+
+from data_store import DataStore, USERS_DIR, USER_PATTERN
+from storage import get_backend, partition_backend
+
+# Number of activities read from an export at a time. Each chunk is committed to the session log in a single write
+CHUNK_SIZE = 10000
+
+# Size of the blocks a JSON export is read in
+JSON_BLOCK_SIZE = 2 ** 20
+
+# Columns of the supported exports; the ID, start time, type, title and duration of an activity, along with the format
+# of the start time, whether the start time is in UTC rather than local time, and the unit of the duration (None for
+# durations written as hh:mm:ss). 'strava' is the activities.csv of Strava's bulk export and 'strava-api' the
+# activities as returned by the Strava API. Garmin Connect's activity list has no activity ID, so the start time
+# identifies an activity instead
+EXPORT_FORMATS = {'strava': {'source': 'strava', 'id': 'Activity ID', 'date': 'Activity Date',
+                             'date_format': '%b %d, %Y, %I:%M:%S %p', 'utc': True, 'type': 'Activity Type',
+                             'title': 'Activity Name', 'duration': 'Elapsed Time', 'duration_unit': 's'},
+                  'strava-api': {'source': 'strava', 'id': 'id', 'date': 'start_date_local', 'date_format': 'ISO8601',
+                                 'utc': False, 'type': 'sport_type', 'title': 'name', 'duration': 'elapsed_time',
+                                 'duration_unit': 's'},
+                  'garmin': {'source': 'garmin', 'id': None, 'date': 'Date', 'date_format': '%Y-%m-%d %H:%M:%S',
+                             'utc': False, 'type': 'Activity Type', 'title': 'Title', 'duration': 'Time',
+                             'duration_unit': None}}
+
+# The activity group, activity name and highlights the activity types of the exports are logged as, keyed on the type
+# in lower case with anything but letters removed. Activities of other types are skipped
+ACTIVITY_TYPES = {'run': ('Exercise', 'Running', ()),
+                  'running': ('Exercise', 'Running', ()),
+                  'trailrun': ('Exercise', 'Running', ()),
+                  'trailrunning': ('Exercise', 'Running', ()),
+                  'treadmillrunning': ('Exercise', 'Running', ()),
+                  'virtualrun': ('Exercise', 'Running', ()),
+                  'ride': ('Exercise', 'Cycling', ()),
+                  'cycling': ('Exercise', 'Cycling', ()),
+                  'virtualride': ('Exercise', 'Cycling', ()),
+                  'gravelride': ('Exercise', 'Cycling', ()),
+                  'mountainbikeride': ('Exercise', 'Cycling', ()),
+                  'ebikeride': ('Exercise', 'Cycling', ()),
+                  'roadbiking': ('Exercise', 'Cycling', ()),
+                  'mountainbiking': ('Exercise', 'Cycling', ()),
+                  'gravelcycling': ('Exercise', 'Cycling', ()),
+                  'indoorcycling': ('Exercise', 'Cycling', ()),
+                  'rockclimbing': ('Exercise', 'Climbing', ()),
+                  'climbing': ('Exercise', 'Climbing', ()),
+                  'indoorclimbing': ('Exercise', 'Climbing', ()),
+                  'bouldering': ('Exercise', 'Climbing', ('Bouldering',)),
+                  'weighttraining': ('Exercise', 'Strength', ()),
+                  'strengthtraining': ('Exercise', 'Strength', ()),
+                  'nordicski': ('Exercise', 'Cross-country skiing', ()),
+                  'crosscountryskiing': ('Exercise', 'Cross-country skiing', ()),
+                  'crosscountryclassicskiing': ('Exercise', 'Cross-country skiing', ('Classic',)),
+                  'crosscountryskateskiing': ('Exercise', 'Cross-country skiing', ('Skate',)),
+                  'skateski': ('Exercise', 'Cross-country skiing', ('Skate',))}
+
+
+def _json_lines(path):
+    with open(path) as json_file:
+        for line in json_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _json_array(path, block_size=JSON_BLOCK_SIZE):
+    # Decodes the records of a JSON array one at a time while reading the file in blocks, so the whole file is never
+    # held in memory
+    decoder = json.JSONDecoder()
+    separator = re.compile(r'[\s,]*')
+    with open(path) as json_file:
+        buffer = json_file.read(block_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f'{path} does not hold a JSON array of activities')
+        position = 1
+        while True:
+            position = separator.match(buffer, position).end()
+            if buffer.startswith(']', position):
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The record runs on into the next block
+                block = json_file.read(block_size)
+                if not block:
+                    raise
+                buffer, position = buffer[position:] + block, 0
+                continue
+            yield record
+
+
+def read_export(path, export_format, chunk_size=CHUNK_SIZE):
+    """
+    Yields the activities of an export file in chunks of chunk_size rows, as frames holding the columns of the export
+    format. CSV files are read with pandas, and JSON files can either hold an array of activities or one activity per
+    line (.jsonl or .ndjson)
+
+    """
+    fields = EXPORT_FORMATS[export_format]
+    columns = [fields[field] for field in ('id', 'date', 'type', 'title', 'duration') if fields[field] is not None]
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        yield from pd.read_csv(path, usecols=columns, dtype=str, chunksize=chunk_size)
+        return
+
+    records = _json_lines(path) if extension in ('.jsonl', '.ndjson') else _json_array(path)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+        yield pd.DataFrame.from_records(chunk, columns=columns)
+
+
+def import_key(source, start, activity_type, source_id):
+    """
+    Key an imported activity is recognised by when it is imported again; a 64-bit hash of its source, start time (as
+    written in the export, so the key doesn't depend on the time zone it was imported in), activity type and ID in the
+    source
+
+    """
+    digest = hashlib.blake2b('\x1f'.join((source, start, activity_type, source_id)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def to_sessions(chunk_df, export_format, timezone=None):
+    """
+    Maps a chunk of an export onto the session log columns; the activity type gives the activity group, name and
+    highlights, the title becomes the notes and the duration is converted to minutes. Start times in UTC are converted
+    to the given time zone (the local time zone by default) before taking their day, so activities are logged on the
+    day they took place. Returns the sessions, their import keys, and the number of activities of each type that were
+    skipped because the type is unknown or the start time couldn't be parsed
+
+    """
+    fields = EXPORT_FORMATS[export_format]
+    activity_types = chunk_df[fields['type']].fillna('').astype(str)
+    activities = activity_types.str.lower().str.replace('[^a-z]', '', regex=True).map(ACTIVITY_TYPES)
+
+    # Local times are parsed as if they were in UTC, which leaves them as they are, and only the day they fall on
+    # matters. Times written in another format than usual are parsed one at a time, which is much slower
+    dates = chunk_df[fields['date']]
+    starts = pd.to_datetime(dates, format=fields['date_format'], utc=True, errors='coerce')
+    unparsed = starts.isna() & dates.notna()
+    if unparsed.any():
+        starts[unparsed] = pd.to_datetime(dates[unparsed], format='mixed', utc=True, errors='coerce')
+    if fields['utc']:
+        starts = starts.dt.tz_convert(timezone if timezone is not None else dateutil.tz.tzlocal())
+    days = starts.dt.tz_localize(None).dt.normalize()
+
+    valid = activities.notna() & days.notna()
+    skipped = collections.Counter(activity_types[~valid])
+    activities, days, chunk_df = activities[valid], days[valid], chunk_df[valid]
+
+    durations = chunk_df[fields['duration']]
+    if fields['duration_unit'] is None:
+        minutes = pd.to_timedelta(durations, errors='coerce').dt.total_seconds() / 60
+    else:
+        unit_seconds = pd.Timedelta(1, fields['duration_unit']).total_seconds()
+        minutes = pd.to_numeric(durations, errors='coerce') * unit_seconds / 60
+
+    sessions_df = pd.DataFrame({'Date': days.to_numpy(),
+                                'Activity group': [activity[0] for activity in activities],
+                                'Activity name': [activity[1] for activity in activities],
+                                'Keywords': [list(activity[2]) for activity in activities],
+                                'Notes': chunk_df[fields['title']].astype(object).where(
+                                    chunk_df[fields['title']].notna(), None).to_numpy(),
+                                'Duration': minutes.round(1).to_numpy(dtype=float)})
+
+    source_ids = chunk_df[fields['id'] if fields['id'] is not None else fields['date']].astype(str)
+    keys = np.array([import_key(fields['source'], start, activity_type, source_id) for start, activity_type, source_id
+                     in zip(dates[valid].astype(str), activity_types[valid], source_ids)], dtype=np.int64)
+
+    return sessions_df, keys, skipped
+
+
+def _contains(sorted_keys, keys):
+    # Whether each key is in the sorted array of keys
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), max(len(sorted_keys) - 1, 0))
+    return sorted_keys[positions] == keys if len(sorted_keys) else np.zeros(len(keys), dtype=bool)
+
+
+def import_activities(backend, paths, export_format, chunk_size=CHUNK_SIZE, timezone=None):
+    """
+    Streams the activities of the export files into the session log, one chunk at a time, so the memory used doesn't
+    depend on the size of the exports. Activities that have been imported before, or appear twice in the exports, are
+    skipped, which makes it safe to import overlapping exports or run an import again after it was interrupted. The
+    import keys of the imported activities are kept in a sorted array for the whole import. Start times in UTC are
+    converted to the timezone (the local time zone by default), see to_sessions.
+
+    The backend lock is held for the whole import, so sessions saved from the app in the meantime wait until it is
+    done. Returns the number of imported and duplicate activities, and the number of skipped activities per type
+
+    """
+    imported = duplicates = 0
+    skipped = collections.Counter()
+    with backend.lock:
+        known_keys = np.sort(backend.read_import_keys())
+        for path in paths:
+            for chunk_df in read_export(path, export_format, chunk_size):
+                sessions_df, keys, chunk_skipped = to_sessions(chunk_df, export_format, timezone)
+                skipped.update(chunk_skipped)
+
+                # Only the first occurrence of each key within the chunk is new, and only if it wasn't imported before
+                new = np.zeros(len(keys), dtype=bool)
+                new[np.unique(keys, return_index=True)[1]] = True
+                new &= ~_contains(known_keys, keys)
+                if new.any():
+                    backend.append_sessions(sessions_df[new], keys[new])
+                    new_keys = np.sort(keys[new])
+                    known_keys = np.insert(known_keys, np.searchsorted(known_keys, new_keys), new_keys)
+
+                imported += int(new.sum())
+                duplicates += int((~new).sum())
+
+    return imported, duplicates, skipped
+
+
+if __name__ == '__main__':
+    """
+    Bulk import of activities from exports of other apps (see EXPORT_FORMATS), e.g. years of history from Strava or
+    Garmin Connect. The exports are streamed in chunks and each chunk is appended to the session log in one write,
+    rather than saving the activities one at a time. Activities already imported are recognised and skipped. The
+    backend is chosen in the same way as for the app, through the PRODUCTIVITY_STORAGE environment variable, and with
+    --user the activities are imported into a user's partition of PRODUCTIVITY_USERS_DIR.
+
+    Afterwards the daily rollup is rebuilt, so the app doesn't have to do so when it first reads the imported sessions
+    """
+    parser = argparse.ArgumentParser(description='Import activities from CSV or JSON exports into the session log')
+    parser.add_argument('paths', nargs='+', help='Export files to import')
+    parser.add_argument('--format', default='strava', choices=list(EXPORT_FORMATS), help='Format of the exports')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='Number of activities read and committed at a time')
+    parser.add_argument('--user', help='User whose partition of PRODUCTIVITY_USERS_DIR to import into')
+    parser.add_argument('--timezone', help='Time zone the activities took place in, e.g. Europe/Oslo, which start '
+                                           'times given in UTC are converted to (default: the local time zone)')
+    args = parser.parse_args()
+
+    if args.timezone is not None:
+        try:
+            zoneinfo.ZoneInfo(args.timezone)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            parser.error(f'--timezone {args.timezone!r} is not a known time zone')
+
+    if args.user is not None:
+        if USERS_DIR is None:
+            parser.error('--user requires PRODUCTIVITY_USERS_DIR to be set')
+        if not USER_PATTERN.fullmatch(args.user):
+            parser.error(f'--user {args.user!r} is not a valid user name')
+        backend = partition_backend(os.path.join(USERS_DIR, args.user))
+    else:
+        backend = get_backend()
+
+    imported, duplicates, skipped = import_activities(backend, args.paths, args.format, args.chunk_size,
+                                                      args.timezone)
+
+    print(f'Imported {imported} activities, skipped {duplicates} already imported')
+    for activity_type, count in skipped.most_common():
+        print(f'Skipped {count} {activity_type!r} activities, as the type is unknown or the start time is invalid')
+    if imported:
+        DataStore(backend).rebuild_rollup()
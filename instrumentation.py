@@ -0,0 +1,262 @@
+import bisect
+import collections
+import contextlib
+import contextvars
+import cProfile
+import functools
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+# Directory profiles are written to when profiling is switched on, see profiling_requested, and the number of profiles
+# kept there. The oldest profiles are removed when there are more
+PROFILE_DIR = os.environ.get('PRODUCTIVITY_PROFILE_DIR', 'profiles')
+MAX_PROFILES = int(os.environ.get('PRODUCTIVITY_MAX_PROFILES', 100))
+
+# Profiling every callback is switched on with PRODUCTIVITY_PROFILE. Clients can only ask for a single request to be
+# profiled if PRODUCTIVITY_PROFILE_REQUESTS is set, as profiling takes time and every profile is written to disk
+PROFILE_ALL = bool(os.environ.get('PRODUCTIVITY_PROFILE'))
+PROFILE_REQUESTS = bool(os.environ.get('PRODUCTIVITY_PROFILE_REQUESTS'))
+
+# Upper bounds of the histogram buckets, for durations in seconds and payload sizes in bytes
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+# Number of most recent observations the quantiles are computed from
+RECENT_WINDOW = 1000
+QUANTILES = (0.5, 0.9, 0.99)
+
+# The phases a callback's time is split into; reading the data, parsing it, computing the results, building the figure
+# or components, and Dash serialising the response. Time not spent in any other phase is counted as 'compute'
+PHASES = ('load', 'parse', 'compute', 'figure', 'serialize')
+
+
+class Histogram:
+    """
+    Histogram of observed values, both over the lifetime of the process (bucket counts, sum and count, as expected by
+    Prometheus) and over a rolling window of the most recent observations, from which quantiles are computed so that
+    a recent slowdown isn't drowned out by the history
+
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = collections.deque(maxlen=RECENT_WINDOW)
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantiles(self):
+        return dict(zip(QUANTILES, np.quantile(list(self.recent), QUANTILES))) if self.recent else {}
+
+
+class Metrics:
+    """
+    Registry of the histograms kept per callback; the time spent in each phase and the size of the responses. All
+    methods are thread safe, as the server may handle several callbacks at once
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.payloads = {}
+
+    def observe_duration(self, callback, phase, seconds):
+        with self._lock:
+            if (callback, phase) not in self.durations:
+                self.durations[(callback, phase)] = Histogram(DURATION_BUCKETS)
+            self.durations[(callback, phase)].observe(seconds)
+
+    def observe_payload(self, callback, size):
+        with self._lock:
+            if callback not in self.payloads:
+                self.payloads[callback] = Histogram(SIZE_BUCKETS)
+            self.payloads[callback].observe(size)
+
+    def to_prometheus(self):
+        """
+        Returns all metrics in the Prometheus text exposition format
+
+        """
+        lines = []
+        with self._lock:
+            _histogram_lines(lines, 'dashboard_callback_phase_seconds',
+                             'Time spent in each phase of a Dash callback', self.durations,
+                             lambda key: {'callback': key[0], 'phase': key[1]})
+            _histogram_lines(lines, 'dashboard_callback_payload_bytes',
+                             'Size of the response of a Dash callback', self.payloads,
+                             lambda key: {'callback': key})
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def _histogram_lines(lines, name, description, histograms, labels_of):
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} histogram')
+    for key, histogram in sorted(histograms.items()):
+        labels = labels_of(key)
+        cumulative = 0
+        for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.bucket_counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(dict(labels, le=bound))} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+
+    # The quantiles of the recent observations are exposed as a separate summary
+    lines.append(f'# HELP {name}_recent {description}, over the last {RECENT_WINDOW} calls')
+    lines.append(f'# TYPE {name}_recent summary')
+    for key, histogram in sorted(histograms.items()):
+        labels = labels_of(key)
+        for quantile, value in histogram.quantiles().items():
+            lines.append(f'{name}_recent{_format_labels(dict(labels, quantile=quantile))} {value}')
+        lines.append(f'{name}_recent_sum{_format_labels(labels)} {sum(histogram.recent)}')
+        lines.append(f'{name}_recent_count{_format_labels(labels)} {len(histogram.recent)}')
+
+
+# The metrics of this process, shared by all callbacks
+metrics = Metrics()
+# Callbacks run in background processes are forked from the server while other threads may be recording metrics
+os.register_at_fork(before=metrics._lock.acquire, after_in_parent=metrics._lock.release,
+                    after_in_child=metrics._lock.release)
+
+
+class _CallbackTimer:
+    # Timings of a single callback call. Phases can be nested (e.g. parsing within a load), in which case the time is
+    # only counted for the innermost phase
+    def __init__(self, callback):
+        self.callback = callback
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.stack = []
+
+
+_current_timer = contextvars.ContextVar('current_timer', default=None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Context manager attributing the time spent within it to a phase of the callback being run. Outside of an
+    instrumented callback (e.g. in the helper scripts) it does nothing
+
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    timer.stack.append([name, 0.0])
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _, nested = timer.stack.pop()
+        timer.phases[name] = timer.phases.get(name, 0.0) + elapsed - nested
+        if timer.stack:
+            timer.stack[-1][1] += elapsed
+
+
+def profiling_requested():
+    """
+    Returns True if the callback being run should be profiled. Profiling is either switched on for all callbacks with
+    the PRODUCTIVITY_PROFILE environment variable, or, if PRODUCTIVITY_PROFILE_REQUESTS is set, for a single request by
+    sending it with the X-Profile header (or a 'profile' cookie, which is easy to set from the browser console)
+
+    """
+    if PROFILE_ALL:
+        return True
+    if not PROFILE_REQUESTS:
+        return False
+
+    import flask
+    if not flask.has_request_context():
+        return False
+    return bool(flask.request.headers.get('X-Profile') or flask.request.cookies.get('profile'))
+
+
+def _save_profile(profile, callback):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    file_name = re.sub(r'[^\w.-]', '_', callback)
+    path = os.path.join(PROFILE_DIR, f'{file_name}-{time.time_ns()}.prof')
+    profile.dump_stats(path)
+
+    # Only the newest MAX_PROFILES profiles are kept, going by the time at the end of their names. Another worker may
+    # be removing the same profiles
+    profiles = [name for name in os.listdir(PROFILE_DIR) if re.fullmatch(r'.+-\d+\.prof', name)]
+    profiles.sort(key=lambda name: int(name[:-len('.prof')].rsplit('-', 1)[1]))
+    for name in profiles[:max(len(profiles) - MAX_PROFILES, 0)]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except FileNotFoundError:
+            pass
+    return path
+
+
+def timed(function):
+    """
+    Decorator for the Dash callback functions, recording the time spent in each phase of the callback. It goes below
+    the @app.callback decorator. When the callback is served by Flask, the time Dash takes to serialise the response
+    and the size of the response are recorded as well, see init_app
+
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        timer = _CallbackTimer(function.__name__)
+        token = _current_timer.set(timer)
+        profile = cProfile.Profile() if profiling_requested() else None
+        try:
+            with phase('compute'):
+                if profile is not None:
+                    result = profile.runcall(function, *args, **kwargs)
+                else:
+                    result = function(*args, **kwargs)
+        finally:
+            _current_timer.reset(token)
+            for name, seconds in timer.phases.items():
+                if name != 'serialize':
+                    metrics.observe_duration(timer.callback, name, seconds)
+            if profile is not None:
+                _save_profile(profile, timer.callback)
+
+        import flask
+        if flask.has_request_context():
+            flask.g.instrumented_callback = (timer.callback, time.perf_counter())
+
+        return result
+
+    return wrapper
+
+
+def init_app(server):
+    """
+    Sets up the instrumentation on the Flask server of the app; the serialisation time and response size of the
+    callbacks are recorded after each request, and the metrics are served in the Prometheus text format on /metrics
+
+    """
+    import flask
+
+    @server.after_request
+    def record_response(response):
+        instrumented = flask.g.pop('instrumented_callback', None)
+        if instrumented is not None:
+            callback, finished = instrumented
+            metrics.observe_duration(callback, 'serialize', time.perf_counter() - finished)
+            if not response.is_streamed:
+                metrics.observe_payload(callback, response.calculate_content_length() or 0)
+        return response
+
+    @server.route('/metrics')
+    def metrics_endpoint():
+        return flask.Response(metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
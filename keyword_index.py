@@ -0,0 +1,71 @@
+import numpy as np
+
+from aggregation import day_values
+from taxonomy import all_highlights
+
+
+class KeywordIndex:
+    """
+    Inverted index from each keyword (session highlight) to the sorted array of days on which a session with that
+    keyword was logged. Counting the sessions with a keyword within a date range is then two searchsorted lookups
+    instead of checking the keyword list of every session. The vocabulary always includes the highlights defined in
+    the taxonomy, along with any other keyword found in the session log.
+
+    The index is built once per version of the session log and is shared between callbacks, so it should be treated as
+    read-only outside of add_session. Adding a session replaces the arrays of the affected keywords rather than changing
+    them in place, so arrays already handed out are never modified
+
+    """
+    def __init__(self, days_by_keyword):
+        self._days = days_by_keyword
+
+    @classmethod
+    def from_sessions(cls, sessions):
+        """
+        Builds the index from the session log in its compact form (a SessionTable), taking the days of the sessions
+        whose keyword bitset has the bit of each keyword set
+
+        """
+        order = np.argsort(sessions.days, kind='stable')
+        sorted_days = sessions.days[order].astype('datetime64[D]')
+
+        days_by_keyword = {keyword: np.array([], dtype='datetime64[D]') for keyword in all_highlights()}
+        # The days are sorted before masking, so the days of each keyword are sorted as well
+        for keyword in sessions.vocabulary(3):
+            days_by_keyword[keyword] = sorted_days[sessions.mask(3, keyword)[order]]
+
+        return cls(days_by_keyword)
+
+    @property
+    def keywords(self):
+        return list(self._days)
+
+    @property
+    def nbytes(self):
+        return sum(keyword_days.nbytes for keyword_days in self._days.values())
+
+    def days(self, keyword):
+        """
+        Sorted array of the days on which a session with the keyword was logged
+
+        """
+        return self._days.get(keyword, np.array([], dtype='datetime64[D]'))
+
+    def count(self, keyword, start_dates, end_dates):
+        """
+        Number of sessions with the keyword logged between each start date and end date (both included)
+
+        """
+        keyword_days = self.days(keyword)
+        return (keyword_days.searchsorted(day_values(end_dates), side='right') -
+                keyword_days.searchsorted(day_values(start_dates), side='left'))
+
+    def add_session(self, date, keywords):
+        """
+        Updates the index with a newly logged session, inserting its day into the array of each of its keywords
+
+        """
+        day = day_values([date])[0]
+        for keyword in dict.fromkeys(keywords):
+            keyword_days = self.days(keyword)
+            self._days[keyword] = np.insert(keyword_days, keyword_days.searchsorted(day, side='right'), day)
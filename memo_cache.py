@@ -0,0 +1,147 @@
+import collections
+import hashlib
+import os
+import pickle
+import threading
+import time
+import weakref
+
+from storage import atomic_write
+
+# Number of results kept in memory, and how long (in seconds) a result is served from the cache
+CACHE_SIZE = int(os.environ.get('PRODUCTIVITY_CACHE_SIZE', 256))
+CACHE_TTL = float(os.environ.get('PRODUCTIVITY_CACHE_TTL', 3600))
+
+# Directory of the disk tier shared by all workers. The disk tier is only used if this is set
+CACHE_DIR = os.environ.get('PRODUCTIVITY_CACHE_DIR')
+
+# Number of results kept on disk; the oldest files are removed once there are more
+DISK_CACHE_SIZE = 4096
+
+
+class MemoCache:
+    """
+    Cache of callback results, keyed on everything the result depends on (typically the data version, the inputs of
+    the callback and the current date). Results are kept in memory with least-recently-used eviction and expire after
+    ttl seconds. Optionally results are also written to a directory as pickles, so that workers serving the same app
+    can share them; a result missing from memory is then looked up on disk before it is computed.
+
+    Results are shared between callers, so they must not be modified
+
+    """
+    def __init__(self, max_entries=CACHE_SIZE, ttl=CACHE_TTL, directory=CACHE_DIR, max_disk_entries=DISK_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self._lock = threading.Lock()
+        # Maps each key to the time the result was computed and the result, least recently used first
+        self._entries = collections.OrderedDict()
+        self._disk_writes = 0
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        _all_caches.add(self)
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.pickle')
+
+    def _read_disk(self, key):
+        try:
+            path = self._disk_path(key)
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'rb') as cache_file:
+                stored_key, created, value = pickle.load(cache_file)
+        except (OSError, pickle.PickleError, EOFError, AttributeError, ImportError):
+            return None
+        # The key is stored along with the value, in case of a hash collision
+        return (created, value) if stored_key == key else None
+
+    def _write_disk(self, key, created, value):
+        atomic_write(self._disk_path(key), lambda cache_file: pickle.dump((key, created, value), cache_file),
+                     binary=True)
+        # Every so often the oldest files are removed, to keep the size of the directory bounded
+        self._disk_writes += 1
+        if self._disk_writes % 64 == 0:
+            entries = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:max(len(entries) - self.max_disk_entries, 0)]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def get(self, key):
+        """
+        Returns the cached result for the key, or None if there is no result that hasn't expired
+
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        entry = self._read_disk(key) if self.directory is not None else None
+        with self._lock:
+            if entry is None:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._store(key, entry)
+            self.hits += 1
+            return entry[1]
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, key, value):
+        entry = (time.time(), value)
+        with self._lock:
+            self._store(key, entry)
+        if self.directory is not None:
+            self._write_disk(key, *entry)
+
+    def get_or_compute(self, key, compute_function):
+        """
+        Returns the cached result for the key, computing and caching it if needed. Two callers missing the same key at
+        the same time may both compute it, which is harmless as the result is the same
+
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute_function()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Every cache of this process. Their locks are held while forking (background callbacks run in forked processes), so
+# the child never starts with a lock taken by a thread that doesn't exist there. The handlers are registered once for
+# the module, as fork handlers can't be removed again, and caches that are no longer used drop out of the set
+_all_caches = weakref.WeakSet()
+_forking_locks = []
+
+
+def _acquire_locks():
+    _forking_locks.extend(cache._lock for cache in list(_all_caches))
+    for lock in _forking_locks:
+        lock.acquire()
+
+
+def _release_locks():
+    for lock in _forking_locks:
+        lock.release()
+    _forking_locks.clear()
+
+
+os.register_at_fork(before=_acquire_locks, after_in_parent=_release_locks, after_in_child=_release_locks)
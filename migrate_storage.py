@@ -0,0 +1,18 @@
+import argparse
+
+from storage import CsvBackend, SqliteBackend, migrate, SESSION_LOG_PATH, PERIOD_GOALS_PATH, DATABASE_PATH
+
+if __name__ == '__main__':
+    """
+    One-shot migration of the session log and period goals from the CSV files into a SQLite database. Afterwards the
+    app can be started with PRODUCTIVITY_STORAGE=sqlite to read and write the database instead of the CSV files
+    """
+    parser = argparse.ArgumentParser(description='Migrate the CSV data files into a SQLite database')
+    parser.add_argument('--sessions', default=SESSION_LOG_PATH, help='Path to the session log CSV file')
+    parser.add_argument('--goals', default=PERIOD_GOALS_PATH, help='Path to the period goals CSV file')
+    parser.add_argument('--database', default=DATABASE_PATH, help='Path to the SQLite database to write')
+    args = parser.parse_args()
+
+    session_count, goal_count = migrate(CsvBackend(args.sessions, args.goals), SqliteBackend(args.database))
+
+    print(f'Migrated {session_count} sessions and {goal_count} goals to {args.database}')
@@ -0,0 +1,13 @@
+from data_store import DataStore
+
+if __name__ == '__main__':
+    """
+    The daily rollup of the session log is updated by the app whenever a session is saved, and is only rebuilt when
+    the session log has been changed outside the app. This script can be run to rebuild it from the session log
+    explicitly. The backend is chosen in the same way as for the app, through the PRODUCTIVITY_STORAGE environment
+    variable
+    """
+    store = DataStore()
+    store.rebuild_rollup()
+
+    print(f'Rebuilt the daily rollup with {len(store.rollup().keys)} keys')
@@ -0,0 +1,206 @@
+import numpy as np
+import pandas as pd
+
+from aggregation import LEVEL_COLUMNS, day_values, day_positions, split_selection
+from keyword_index import KeywordIndex
+from storage import ROLLUP_COLUMNS
+
+# Identifier used for the grand total (level 0) in the rollup
+TOTAL = 'Total'
+
+
+
+class DailyRollup:
+    """
+    Number of sessions logged per day for every key, where a key is a level and identifier: the grand total (level 0),
+    each activity group (level 1), each activity name (level 2) and each keyword (level 3). The counts are held as a
+    matrix with one row per day, from the first to the last day with a session, and one column per key.
+
+    Everything the graphs and goals need can be answered from the cumulative sums of this matrix, so their cost
+    depends on the number of days and keys rather than the number of sessions. Adding a session only increments one
+    cell per key it belongs to
+
+    """
+    def __init__(self, first_day, counts, keys):
+        self._first_day = np.datetime64(first_day, 'D')
+        self._counts = counts
+        self._columns = {key: column for column, key in enumerate(keys)}
+        # The cumulative sums are computed when first needed, and tagged with the version of the counts they were
+        # computed from. The version is bumped whenever a session is added
+        self._version = 0
+        self._cumulative = (None, None)
+
+    @classmethod
+    def from_sessions(cls, sessions, keyword_index=None):
+        """
+        Builds the rollup from the session log in its compact form (a SessionTable) with one bincount per level, over
+        the combined identifier code and day. A prebuilt keyword index for the sessions can be passed in to avoid
+        building it again
+
+        """
+        days = sessions.days
+        if len(days) == 0:
+            return cls(pd.Timestamp.today().normalize(), np.zeros((0, 0), dtype=np.int64), [])
+
+        first_day = np.datetime64(int(days.min()), 'D')
+        date_list = pd.date_range(first_day, np.datetime64(int(days.max()), 'D'))
+        positions = (days - days.min()).astype(np.int64)
+        n_days = len(date_list)
+
+        keys = [(0, TOTAL)]
+        columns = [np.bincount(positions, minlength=n_days)]
+        for level in LEVEL_COLUMNS:
+            codes, vocabulary = sessions.codes(level).astype(np.int64), sessions.vocabulary(level)
+            valid = codes >= 0
+            matrix = np.bincount(codes[valid] * n_days + positions[valid],
+                                 minlength=len(vocabulary) * n_days).reshape(len(vocabulary), n_days)
+            # Only the identifiers that were actually logged get a key
+            for code in np.flatnonzero(matrix.any(axis=1)):
+                keys.append((level, vocabulary[code]))
+                columns.append(matrix[code])
+
+        if keyword_index is None:
+            keyword_index = KeywordIndex.from_sessions(sessions)
+        for keyword in keyword_index.keywords:
+            keys.append((3, keyword))
+            columns.append(np.bincount(day_positions(keyword_index.days(keyword), date_list), minlength=n_days))
+
+        return cls(first_day, np.column_stack(columns).astype(np.int64), keys)
+
+    @classmethod
+    def from_long(cls, rollup_df):
+        """
+        Builds the rollup from its persisted long format, with one row per date, level, identifier and count. The same
+        cell may appear several times (e.g. increments appended after each saved session), in which case the counts
+        are added up
+
+        """
+        if rollup_df.shape[0] == 0:
+            return cls(pd.Timestamp.today().normalize(), np.zeros((0, 0), dtype=np.int64), [])
+
+        dates = day_values(rollup_df['Date'])
+        first_day = dates.min()
+        rows = (dates - first_day).astype(np.int64)
+
+        key_codes, keys = pd.factorize(pd.MultiIndex.from_arrays([rollup_df['Level'].astype(int),
+                                                                  rollup_df['Identifier']]))
+        counts = np.zeros((rows.max() + 1, len(keys)), dtype=np.int64)
+        np.add.at(counts, (rows, key_codes), rollup_df['Count'].to_numpy().astype(np.int64))
+
+        return cls(first_day, counts, list(keys))
+
+    def to_long(self):
+        """
+        Returns the rollup in its long format, leaving out the cells without any sessions
+
+        """
+        rows, columns = np.nonzero(self._counts)
+        keys = list(self._columns)
+        return pd.DataFrame({'Date': self._first_day + rows,
+                             'Level': [keys[column][0] for column in columns],
+                             'Identifier': [keys[column][1] for column in columns],
+                             'Count': self._counts[rows, columns]})[ROLLUP_COLUMNS]
+
+    @property
+    def keys(self):
+        return list(self._columns)
+
+    @property
+    def first_day(self):
+        # First day of the counts, i.e. the day of the first session (today without any sessions)
+        return pd.Timestamp(self._first_day)
+
+    @property
+    def nbytes(self):
+        # Memory taken by the counts and their cumulative sums, in bytes
+        cumulative = self._cumulative[1]
+        return self._counts.nbytes + (cumulative.nbytes if cumulative is not None else 0)
+
+    def add_session(self, session):
+        """
+        Adds a newly logged session to the rollup. Returns the increments in the long format, so that they can be
+        persisted without writing the whole rollup
+
+        """
+        day = day_values([session['Date']])[0]
+        keys = [(0, TOTAL), (1, session['Activity group']), (2, session['Activity name'])]
+        keys.extend((3, keyword) for keyword in dict.fromkeys(session['Keywords']))
+
+        # Grow the matrix if the session is outside the current range of days or has a key not seen before
+        if self._counts.shape[0] == 0:
+            self._first_day = day
+        if day < self._first_day:
+            self._counts = np.vstack([np.zeros((int((self._first_day - day).astype(int)), self._counts.shape[1]),
+                                               dtype=np.int64), self._counts])
+            self._first_day = day
+        row = int((day - self._first_day).astype(int))
+        if row >= self._counts.shape[0]:
+            self._counts = np.vstack([self._counts, np.zeros((row + 1 - self._counts.shape[0], self._counts.shape[1]),
+                                                             dtype=np.int64)])
+        new_keys = [key for key in keys if key not in self._columns]
+        if new_keys:
+            for key in new_keys:
+                self._columns[key] = len(self._columns)
+            self._counts = np.hstack([self._counts, np.zeros((self._counts.shape[0], len(new_keys)), dtype=np.int64)])
+
+        for key in keys:
+            self._counts[row, self._columns[key]] += 1
+        self._version += 1
+
+        return pd.DataFrame({'Date': [pd.Timestamp(day)] * len(keys),
+                             'Level': [key[0] for key in keys],
+                             'Identifier': [key[1] for key in keys],
+                             'Count': 1})[ROLLUP_COLUMNS]
+
+    def _cumulative_at(self, key, dates):
+        # Cumulative number of sessions for the key up to and including each of the dates. Local references are used
+        # since a session may be added from another thread while the lookup runs
+        version = self._version
+        first_day, counts = self._first_day, self._counts
+        cached_version, cumulative = self._cumulative
+        if cached_version != version:
+            cumulative = counts.cumsum(axis=0)
+            self._cumulative = (version, cumulative)
+
+        column = self._columns.get(key)
+        if column is None or column >= cumulative.shape[1] or cumulative.shape[0] == 0:
+            return np.zeros(len(dates), dtype=np.int64)
+
+        rows = np.clip((day_values(dates) - first_day).astype(np.int64), -1, cumulative.shape[0] - 1)
+        return np.where(rows >= 0, cumulative[np.maximum(rows, 0), column], 0)
+
+    def count(self, level, identifier, start_dates, end_dates):
+        """
+        Number of sessions for the key logged between each start date and end date (both included)
+
+        """
+        key = (0, TOTAL) if level == 0 else (int(level), identifier)
+        day_before_start = pd.DatetimeIndex(start_dates) - pd.Timedelta(days=1)
+        return self._cumulative_at(key, end_dates) - self._cumulative_at(key, day_before_start)
+
+    def cumulative_counts(self, selection, date_list):
+        """
+        Cumulative number of sessions up to and including each day of date_list, for each of the selected dropdown
+        values
+
+        """
+        counts = {}
+        for value in selection:
+            identifier, level = split_selection(value)
+            counts[value] = self._cumulative_at((0, TOTAL) if level == 0 else (level, identifier), date_list)
+
+        return pd.DataFrame(counts, index=date_list, columns=list(selection))
+
+    def period_counts(self, selection, start, period_ends):
+        """
+        Number of sessions in each period for each of the selected dropdown values, where the first period runs from
+        the start up to and including the first of period_ends, and every other period from the day after the previous
+        end. Also returns the number of sessions logged before the start for each value, which cumulative sums over
+        the periods are seeded with. Only the cumulative counts at the ends are looked up, so the cost depends on the
+        number of periods rather than on the length of the history
+
+        """
+        offsets = self.cumulative_counts(selection, pd.DatetimeIndex([pd.Timestamp(start) - pd.Timedelta(days=1)]))
+        cumulative = self.cumulative_counts(selection, period_ends)
+        counts = np.diff(cumulative.to_numpy(), axis=0, prepend=offsets.to_numpy())
+        return offsets.iloc[0], pd.DataFrame(counts, index=period_ends, columns=list(selection))
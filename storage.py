@@ -0,0 +1,912 @@
+import ast
+import contextlib
+import csv
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import phase
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Default locations of the data files, relative to the working directory the app is started from
+SESSION_LOG_PATH = 'Session_log.csv'
+PERIOD_GOALS_PATH = 'Period_goals.csv'
+DATABASE_PATH = 'productivity.db'
+
+# Column names used in the dataframes handed to the app
+SESSION_COLUMNS = ['Date', 'Activity group', 'Activity name', 'Keywords', 'Notes', 'Duration']
+GOAL_COLUMNS = ['Start date', 'End date', 'Label', 'Identifier level', 'Identifier', 'Condition type', 'Quantity']
+GOAL_STATUS_COLUMNS = ['Progress', 'Satisfied', 'Finalized']
+ROLLUP_COLUMNS = ['Date', 'Level', 'Identifier', 'Count']
+
+# How often and how long apart a read of an append-only file is retried while a rewrite is being committed
+_COMMITTED_READ_ATTEMPTS = 20
+_COMMITTED_READ_DELAY = 0.005
+
+
+def _file_stamp(path):
+    """
+    Returns a cheap fingerprint of a file (modification time and size) used to decide whether the data has to be read
+    again
+
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def atomic_write(path, write_function, binary=False):
+    """
+    Writes a file by first writing to a temporary file in the same directory and then renaming it over the target. A
+    crash halfway through a write therefore leaves the old file intact instead of a truncated one. The file is opened
+    in text mode unless binary is set
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with (os.fdopen(file_descriptor, 'wb') if binary else os.fdopen(file_descriptor, 'w', newline='')) as temp_file:
+            write_function(temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def parse_keywords(value):
+    """
+    The keywords are written to the CSV file as a list-like string, so when reading the file back in we have to
+    translate it to an actual list again. Missing values become an empty list
+
+    """
+    if isinstance(value, list):
+        return value
+    if pd.isnull(value) or value == '':
+        return []
+    return ast.literal_eval(value)
+
+
+def _parse_duration(value):
+    return float('nan') if value is None or value == '' else float(value)
+
+
+def sessions_to_frame(sessions, session_ids):
+    """
+    Builds a normalised session dataframe (the same format as returned by the backends) from a list of session
+    records, i.e. dicts with the session log columns as keys
+
+    """
+    sessions_df = pd.DataFrame({'Date': pd.to_datetime([session['Date'] for session in sessions]),
+                                'Activity group': [session['Activity group'] for session in sessions],
+                                'Activity name': [session['Activity name'] for session in sessions],
+                                'Keywords': [parse_keywords(session.get('Keywords')) for session in sessions],
+                                'Notes': [session.get('Notes') for session in sessions],
+                                'Duration': [_parse_duration(session.get('Duration')) for session in sessions]},
+                               index=pd.Index(session_ids, name='Session ID'))
+
+    return sessions_df[SESSION_COLUMNS]
+
+
+class FileLock:
+    """
+    Advisory lock on a lock file, used to serialise writes from several processes (e.g. gunicorn workers) to the same
+    data files. The lock is re-entrant within a process, so a write method can be called while the lock is already
+    held for a longer sequence of operations. On platforms without fcntl only threads within the process are
+    serialised
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            self._file = open(self.path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *_):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+    def locked_elsewhere(self):
+        """
+        Returns True if a writer currently holds the lock, without waiting for it
+
+        """
+        if fcntl is None:
+            return False
+        with open(self.path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+
+
+def _read_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _commit(path, manifest_path, **values):
+    """
+    Records the current size and inode of an append-only file in its manifest, along with any other values. Readers
+    only read the part of the file covered by the manifest, so they never see a half-written append
+
+    """
+    stat = os.stat(path)
+    manifest = dict(values, size=stat.st_size, inode=stat.st_ino)
+    atomic_write(manifest_path, lambda manifest_file: json.dump(manifest, manifest_file))
+
+
+def _read_committed(path, manifest_path, lock, read_function):
+    """
+    Reads an append-only file without waiting for writers. Only the bytes recorded in the manifest are passed on to
+    read_function, so a concurrent append is either fully included or not at all. If the file has been replaced by an
+    atomic rewrite that is not committed yet, the read is retried shortly. Files without a manifest, or that were
+    changed outside the app, are read as they are
+
+    """
+    for _ in range(_COMMITTED_READ_ATTEMPTS):
+        manifest = _read_json(manifest_path)
+        if manifest is None:
+            break
+        with open(path, 'rb') as data_file:
+            stat = os.fstat(data_file.fileno())
+            if stat.st_ino == manifest['inode'] and stat.st_size >= manifest['size']:
+                # Anything after the committed size is either an append in progress, or rows added by hand if nobody
+                # is writing at the moment
+                if stat.st_size > manifest['size'] and not lock.locked_elsewhere():
+                    return read_function(data_file)
+                return read_function(io.BytesIO(data_file.read(manifest['size'])))
+        time.sleep(_COMMITTED_READ_DELAY)
+
+    return read_function(path)
+
+
+class CsvBackend:
+    """
+    Storage backend keeping the sessions and goals in the two plain CSV files shipped with the app.
+
+    The backend is safe to use from several processes at once. All writes take an exclusive advisory lock, files that
+    are rewritten are replaced atomically, and the append-only files (the session log and the daily rollup) have a
+    manifest recording how much of the file has been committed. Readers never take the lock; they only read the
+    committed part of the append-only files and always see either the old or the new version of rewritten files
+
+    """
+    name = 'csv'
+
+    def __init__(self, session_path=SESSION_LOG_PATH, goals_path=PERIOD_GOALS_PATH):
+        self.session_path = session_path
+        self.goals_path = goals_path
+        # Lock file serialising all writes to the data files
+        self.lock = FileLock(session_path + '.lock')
+        # Manifest of the session log, holding the committed size of the log and the ID of the next session
+        self.manifest_path = session_path + '.manifest'
+        # Import keys of the activities imported from exports (see import_activities.py), as little-endian int64 values.
+        # The committed size of this file is kept in the manifest of the session log, so the keys are committed in the
+        # same step as the sessions they belong to
+        self.imports_path = session_path + '.imports'
+        # Base path of the journals of sessions queued in write-behind mode (see write_behind.py)
+        self.journal_path = session_path + '.journal'
+        # File holding the materialised status of each goal and its manifest, which also holds the fingerprint of the
+        # data the status was evaluated from. Changed goals are appended, so a goal may have several rows, the last one
+        # being its current status
+        self.goal_status_path = os.path.splitext(goals_path)[0] + '_status.csv'
+        self.goal_status_manifest_path = self.goal_status_path + '.manifest'
+        # Files holding the daily rollup of the session log and its manifest, which also holds the fingerprint of the
+        # log the rollup was built from
+        self.rollup_path = os.path.join(os.path.dirname(session_path), 'Daily_rollup.csv')
+        self.rollup_manifest_path = self.rollup_path + '.manifest'
+
+    def sessions_stamp(self):
+        return _file_stamp(self.session_path), _file_stamp(self.manifest_path)
+
+    def goals_stamp(self):
+        return _file_stamp(self.goals_path)
+
+    def read_sessions(self):
+        """
+        Reads the committed part of the session log and normalises the columns; dates become datetime objects and
+        keywords become lists
+
+        """
+        with phase('load'):
+            sessions_df = _read_committed(self.session_path, self.manifest_path, self.lock,
+                                          lambda session_file: pd.read_csv(session_file, index_col=0))
+        with phase('parse'):
+            sessions_df['Date'] = pd.to_datetime(sessions_df['Date'])
+            sessions_df['Keywords'] = sessions_df['Keywords'].apply(parse_keywords)
+
+        return sessions_df
+
+    def read_goals(self):
+        """
+        Reads the period goals and converts the start and end dates to datetime objects
+
+        """
+        with phase('load'):
+            goals_df = pd.read_csv(self.goals_path, index_col=0)
+        with phase('parse'):
+            goals_df['Start date'] = pd.to_datetime(goals_df['Start date'])
+            goals_df['End date'] = pd.to_datetime(goals_df['End date'])
+
+        return goals_df
+
+    def next_session_id(self):
+        """
+        Returns the ID the next appended session will get. The counter is kept in the manifest next to the session log
+        so that allocating an ID does not require reading the log. If the manifest is missing, or doesn't match the
+        log because the log was changed outside the app, the ID follows the largest ID in the log
+
+        """
+        manifest = _read_json(self.manifest_path)
+        stat = _file_stamp(self.session_path)
+        if stat is None:
+            return 1
+        if manifest is not None and os.stat(self.session_path).st_ino == manifest['inode'] and \
+                stat[1] == manifest['size']:
+            return manifest['next_id']
+
+        session_ids = pd.read_csv(self.session_path, usecols=[0]).iloc[:, 0]
+        next_id = int(session_ids.max()) + 1 if len(session_ids) else 1
+
+        return max(next_id, manifest['next_id']) if manifest is not None else next_id
+
+    def append_session(self, session):
+        """
+        Appends a single session to the end of the session log without reading or rewriting the rest of the file.
+        Returns the ID given to the session
+
+        """
+        with self.lock:
+            session_id = self.next_session_id()
+
+            row = [session_id, pd.Timestamp(session['Date']).strftime('%Y-%m-%d'), session['Activity group'],
+                   session['Activity name'], parse_keywords(session.get('Keywords')) or None, session.get('Notes'),
+                   session.get('Duration')]
+
+            with open(self.session_path, 'a+b') as session_file:
+                lines = io.StringIO(newline='')
+                if session_file.tell() == 0:
+                    # Starting a new log, so the header has to be written first
+                    csv.writer(lines, lineterminator=os.linesep).writerow(['Session ID'] + SESSION_COLUMNS)
+                else:
+                    # If the file was edited by hand the last line might be missing its line break
+                    session_file.seek(-1, os.SEEK_END)
+                    if session_file.read(1) not in (b'\n', b'\r'):
+                        lines.write(os.linesep)
+                csv.writer(lines, lineterminator=os.linesep).writerow(row)
+                # The whole record is written in one go
+                session_file.write(lines.getvalue().encode())
+                session_file.flush()
+                os.fsync(session_file.fileno())
+
+            self._commit_sessions(session_id + 1)
+
+        return session_id
+
+    def reserve_session_ids(self, count):
+        """
+        Reserves count consecutive session IDs, which no other append will hand out, and returns the first of them. The
+        reservation only moves the ID counter in the manifest on, without writing to the session log
+
+        """
+        with self.lock:
+            first_id = self.next_session_id()
+            self._commit_sessions(first_id + count)
+        return first_id
+
+    def append_sessions(self, sessions_df, import_keys=None, session_ids=None):
+        """
+        Appends many sessions (a frame with the session log columns) to the end of the session log in a single write,
+        giving them consecutive IDs unless their (reserved) IDs are given. Returns the IDs. The import keys of the
+        sessions, if given, are appended to the import keys file and committed in the same manifest update as the
+        sessions, so after a crash either both or neither are there
+
+        """
+        with self.lock:
+            next_id = self.next_session_id()
+            if session_ids is None:
+                session_ids = np.arange(next_id, next_id + sessions_df.shape[0])
+            rows_df = sessions_df[SESSION_COLUMNS].set_axis(pd.Index(session_ids, name='Session ID'))
+            # Empty keyword lists are written as missing values, just like sessions saved without highlights
+            rows_df['Keywords'] = [keywords or None for keywords in rows_df['Keywords']]
+
+            imports_size = self._imports_size()
+            if import_keys is not None and len(import_keys):
+                with open(self.imports_path, 'ab') as imports_file:
+                    # Anything after the committed keys was left behind by an import that didn't commit
+                    imports_file.truncate(imports_size)
+                    imports_file.write(np.asarray(import_keys, dtype='<i8').tobytes())
+                    imports_file.flush()
+                    os.fsync(imports_file.fileno())
+                imports_size += 8 * len(import_keys)
+
+            with open(self.session_path, 'a+b') as session_file:
+                lines = io.StringIO(newline='')
+                if session_file.tell() > 0:
+                    # If the file was edited by hand the last line might be missing its line break
+                    session_file.seek(-1, os.SEEK_END)
+                    if session_file.read(1) not in (b'\n', b'\r'):
+                        lines.write(os.linesep)
+                rows_df.to_csv(lines, header=session_file.tell() == 0, date_format='%Y-%m-%d',
+                               lineterminator=os.linesep)
+                session_file.write(lines.getvalue().encode())
+                session_file.flush()
+                os.fsync(session_file.fileno())
+
+            self._commit_sessions(max(next_id, int(np.max(session_ids)) + 1 if len(session_ids) else next_id),
+                                  imports_size)
+
+        return session_ids
+
+    def _imports_size(self):
+        # Size of the committed part of the import keys file. Manifests written before the first import don't have it,
+        # in which case the keys file is taken as it is
+        manifest = _read_json(self.manifest_path)
+        if manifest is not None and 'imports_size' in manifest:
+            return manifest['imports_size']
+        stamp = _file_stamp(self.imports_path)
+        return 0 if stamp is None else stamp[1] - stamp[1] % 8
+
+    def _commit_sessions(self, next_id, imports_size=None):
+        # The committed size of the import keys is carried over by every commit of the session log
+        _commit(self.session_path, self.manifest_path, next_id=next_id,
+                imports_size=self._imports_size() if imports_size is None else imports_size)
+
+    def read_import_keys(self):
+        """
+        Returns the import keys of all activities imported so far, as an int64 array
+
+        """
+        size = self._imports_size()
+        try:
+            with open(self.imports_path, 'rb') as imports_file:
+                return np.frombuffer(imports_file.read(size), dtype='<i8').astype(np.int64)
+        except FileNotFoundError:
+            return np.zeros(0, dtype=np.int64)
+
+    def write_import_keys(self, import_keys):
+        with self.lock:
+            atomic_write(self.imports_path,
+                         lambda imports_file: imports_file.write(np.asarray(import_keys, dtype='<i8').tobytes()),
+                         binary=True)
+            self._commit_sessions(self.next_session_id(), 8 * len(import_keys))
+
+    def write_sessions(self, sessions_df):
+        with self.lock:
+            # IDs handed out or reserved before are never handed out again, even if their sessions are left out
+            next_id = self.next_session_id()
+            atomic_write(self.session_path,
+                         lambda session_file: sessions_df.to_csv(session_file, date_format='%Y-%m-%d'))
+            self._commit_sessions(max(int(sessions_df.index.max()) + 1 if sessions_df.shape[0] else 1, next_id))
+
+    def compact_sessions(self):
+        """
+        Rewrites the session log in one go, sorted by session ID, replacing the old file atomically
+
+        """
+        with self.lock:
+            sessions_df = self.read_sessions().sort_index()
+            # Empty keyword lists are written as missing values, just like sessions saved without highlights
+            sessions_df['Keywords'] = sessions_df['Keywords'].apply(lambda keywords: keywords or None)
+            self.write_sessions(sessions_df)
+
+    def write_goals(self, goals_df):
+        with self.lock:
+            atomic_write(self.goals_path, lambda goals_file: goals_df.to_csv(goals_file, date_format='%Y-%m-%d'))
+
+    def read_goal_status(self):
+        """
+        Returns the persisted goal status as a tuple of the fingerprint of the data it was evaluated from and a frame
+        indexed by goal ID, or None if no status has been saved yet
+
+        """
+        manifest = _read_json(self.goal_status_manifest_path)
+        if manifest is None or _file_stamp(self.goal_status_path) is None:
+            return None
+
+        # As for the rollup, the fingerprint has to belong to the version of the status that is read
+        with phase('load'):
+            status_df = _read_committed(self.goal_status_path, self.goal_status_manifest_path, self.lock,
+                                        lambda status_file: pd.read_csv(status_file, index_col=0))
+        if _read_json(self.goal_status_manifest_path) != manifest:
+            return None
+
+        # Goals that were updated have several rows, of which the last one holds the current status
+        status_df = status_df[~status_df.index.duplicated(keep='last')].sort_index()
+        status_df.index.name = None
+        status_df['Progress'] = status_df['Progress'].astype('int64')
+        status_df[['Satisfied', 'Finalized']] = status_df[['Satisfied', 'Finalized']].astype(bool)
+
+        return manifest['fingerprint'], status_df[GOAL_STATUS_COLUMNS]
+
+    def goal_status_fingerprint(self):
+        manifest = _read_json(self.goal_status_manifest_path)
+        return None if manifest is None else manifest['fingerprint']
+
+    def write_goal_status(self, fingerprint, status_df):
+        with self.lock:
+            atomic_write(self.goal_status_path,
+                         lambda status_file: status_df[GOAL_STATUS_COLUMNS].to_csv(status_file, index_label='Goal ID'))
+            _commit(self.goal_status_path, self.goal_status_manifest_path, fingerprint=fingerprint,
+                    goals=status_df.shape[0], appended=0)
+
+    def update_goal_status(self, fingerprint, updates_df, status_function):
+        """
+        Appends the status of the goals that changed instead of rewriting the status of every goal. Once more rows have
+        been appended than there are goals, the file is rewritten with the full status returned by status_function,
+        so the file and the time to read it don't grow with the number of saved sessions
+
+        """
+        with self.lock:
+            manifest = _read_json(self.goal_status_manifest_path)
+            appended = manifest['appended'] + updates_df.shape[0]
+            if appended > manifest['goals']:
+                self.write_goal_status(fingerprint, status_function())
+                return
+            with open(self.goal_status_path, 'a', newline='') as status_file:
+                updates_df[GOAL_STATUS_COLUMNS].to_csv(status_file, header=False)
+                status_file.flush()
+                os.fsync(status_file.fileno())
+            _commit(self.goal_status_path, self.goal_status_manifest_path, fingerprint=fingerprint,
+                    goals=manifest['goals'], appended=appended)
+
+    def read_rollup(self):
+        """
+        Returns the persisted daily rollup as a tuple of the fingerprint of the session log it was built from and the
+        rollup in its long format, or None if no rollup has been saved yet
+
+        """
+        manifest = _read_json(self.rollup_manifest_path)
+        if manifest is None or _file_stamp(self.rollup_path) is None:
+            return None
+
+        # The fingerprint has to belong to the same version of the rollup that is read, so the manifest is only used
+        # if it is still the current one after reading
+        with phase('load'):
+            rollup_df = _read_committed(self.rollup_path, self.rollup_manifest_path, self.lock,
+                                        lambda rollup_file: pd.read_csv(rollup_file, parse_dates=['Date']))
+        if _read_json(self.rollup_manifest_path) != manifest:
+            return None
+
+        return manifest['fingerprint'], rollup_df[ROLLUP_COLUMNS]
+
+    def rollup_fingerprint(self):
+        manifest = _read_json(self.rollup_manifest_path)
+        return None if manifest is None else manifest['fingerprint']
+
+    def write_rollup(self, fingerprint, rollup_df):
+        with self.lock:
+            atomic_write(self.rollup_path,
+                         lambda rollup_file: rollup_df.to_csv(rollup_file, index=False, date_format='%Y-%m-%d'))
+            _commit(self.rollup_path, self.rollup_manifest_path, fingerprint=fingerprint, cells=rollup_df.shape[0],
+                    appended=0)
+
+    def add_to_rollup(self, fingerprint, increments_df, rollup_function):
+        """
+        Appends increments to the persisted rollup instead of rewriting it; the rows for the same cell are added up
+        when the rollup is read back. The fingerprint is only committed after the increments have been written, so a
+        crash in between makes the rollup be rebuilt rather than be silently out of date.
+
+        Once more rows have been appended than the rollup had cells when it was last written, it is rewritten with the
+        full rollup returned by rollup_function instead, so the file and the time to read it scale with the days and
+        keys rather than with the number of sessions ever saved
+
+        """
+        with self.lock:
+            manifest = _read_json(self.rollup_manifest_path)
+            appended = manifest.get('appended', 0) + increments_df.shape[0]
+            if appended > manifest.get('cells', 0):
+                self.write_rollup(fingerprint, rollup_function())
+                return
+            with open(self.rollup_path, 'a', newline='') as rollup_file:
+                increments_df.to_csv(rollup_file, header=False, index=False, date_format='%Y-%m-%d')
+                rollup_file.flush()
+                os.fsync(rollup_file.fileno())
+            _commit(self.rollup_path, self.rollup_manifest_path, fingerprint=fingerprint, cells=manifest['cells'],
+                    appended=appended)
+
+
+class SqliteBackend:
+    """
+    Storage backend using a single SQLite database. Columns are typed, the dates are stored as ISO dates and indexed,
+    and the keywords are normalised into a separate table with one row per session and keyword, so nothing has to be
+    parsed from text when reading the data back.
+
+    Each write is a single transaction, so it is atomic across processes. The database uses write-ahead logging so that
+    readers never wait for a writer, and a writer waits for another writer rather than failing. The lock file is only
+    needed to keep sequences of several writes together (see DataStore.add_session)
+
+    """
+    name = 'sqlite'
+
+    # Seconds a writer waits for another process to finish writing before giving up
+    busy_timeout = 30
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id INTEGER PRIMARY KEY,
+            date DATE NOT NULL,
+            activity_group TEXT NOT NULL,
+            activity_name TEXT,
+            notes TEXT,
+            duration REAL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_date ON sessions (date);
+        CREATE TABLE IF NOT EXISTS session_keywords (
+            session_id INTEGER NOT NULL REFERENCES sessions (session_id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            keyword TEXT NOT NULL,
+            PRIMARY KEY (session_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS session_keywords_keyword ON session_keywords (keyword);
+        CREATE TABLE IF NOT EXISTS goals (
+            goal_id INTEGER PRIMARY KEY,
+            start_date DATE NOT NULL,
+            end_date DATE NOT NULL,
+            label TEXT,
+            identifier_level INTEGER NOT NULL,
+            identifier TEXT NOT NULL,
+            condition_type TEXT NOT NULL,
+            quantity INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS goals_end_date ON goals (end_date);
+        CREATE TABLE IF NOT EXISTS goal_status (
+            goal_id INTEGER PRIMARY KEY,
+            progress INTEGER NOT NULL,
+            satisfied BOOLEAN NOT NULL,
+            finalized BOOLEAN NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS daily_rollup (
+            date DATE NOT NULL,
+            level INTEGER NOT NULL,
+            identifier TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (date, level, identifier)
+        );
+        CREATE TABLE IF NOT EXISTS imported_activities (
+            import_key INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    # Mapping between the dataframe columns used in the app and the columns in the database
+    session_column_map = {'Date': 'date', 'Activity group': 'activity_group', 'Activity name': 'activity_name',
+                          'Notes': 'notes', 'Duration': 'duration'}
+    goal_column_map = {'Start date': 'start_date', 'End date': 'end_date', 'Label': 'label',
+                       'Identifier level': 'identifier_level', 'Identifier': 'identifier',
+                       'Condition type': 'condition_type', 'Quantity': 'quantity'}
+
+    def __init__(self, path=DATABASE_PATH):
+        self.path = path
+        self.lock = FileLock(path + '.lock')
+        self.journal_path = path + '.journal'
+        with self._connect() as connection:
+            # The journal mode is stored in the database, so this only has to be set once
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.executescript(self.schema)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # Runs the block in a transaction, which is committed if the block succeeds and rolled back otherwise, on a
+        # connection that is closed afterwards rather than when it is garbage collected
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout)
+        try:
+            connection.execute('PRAGMA foreign_keys = ON')
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _version(self, kind):
+        with self._connect() as connection:
+            version = connection.execute('SELECT value FROM metadata WHERE key = ?', (kind + '_version',)).fetchone()
+        return None if version is None else version[0]
+
+    def _bump_version(self, connection, kind):
+        # Each write to the sessions or goals bumps a version number, which is used as the stamp of that data. Unlike
+        # the modification time of the database file, this is not affected by writes to the other tables
+        connection.execute("INSERT INTO metadata VALUES (?, '1') ON CONFLICT (key) DO UPDATE SET "
+                           "value = CAST(value AS INTEGER) + 1", (kind + '_version',))
+
+    def sessions_stamp(self):
+        return self._version('sessions')
+
+    def goals_stamp(self):
+        return self._version('goals')
+
+    def read_sessions(self):
+        with phase('load'), self._connect() as connection:
+            sessions_df = pd.read_sql_query('SELECT * FROM sessions ORDER BY session_id', connection,
+                                            index_col='session_id', parse_dates=['date'])
+            keywords_df = pd.read_sql_query('SELECT session_id, keyword FROM session_keywords '
+                                            'ORDER BY session_id, position', connection)
+
+        with phase('parse'):
+            sessions_df = sessions_df.rename(columns={value: key for key, value in self.session_column_map.items()})
+            sessions_df.index.name = 'Session ID'
+            sessions_df['Duration'] = sessions_df['Duration'].astype(float)
+
+            # Put the keywords back together into one list per session, sessions without keywords get an empty list
+            keyword_lists = keywords_df.groupby('session_id')['keyword'].agg(list)
+            sessions_df['Keywords'] = [keyword_lists.get(session_id, []) for session_id in sessions_df.index]
+
+        return sessions_df[SESSION_COLUMNS]
+
+    def read_goals(self):
+        with phase('load'), self._connect() as connection:
+            goals_df = pd.read_sql_query('SELECT * FROM goals ORDER BY goal_id', connection, index_col='goal_id',
+                                         parse_dates=['start_date', 'end_date'])
+
+        goals_df = goals_df.rename(columns={value: key for key, value in self.goal_column_map.items()})
+        goals_df.index.name = None
+
+        return goals_df[GOAL_COLUMNS]
+
+    def _session_rows(self, sessions_df):
+        for session_id, row in zip(sessions_df.index, sessions_df.itertuples(index=False)):
+            date, activity_group, activity_name, _, notes, duration = row
+            yield (int(session_id), pd.Timestamp(date).date().isoformat(), activity_group, activity_name,
+                   None if pd.isnull(notes) else notes,
+                   None if pd.isnull(duration) or duration == '' else float(duration))
+
+    def _keyword_rows(self, sessions_df):
+        for session_id, keywords in zip(sessions_df.index, sessions_df['Keywords']):
+            for position, keyword in enumerate(parse_keywords(keywords)):
+                yield int(session_id), position, keyword
+
+    def write_sessions(self, sessions_df):
+        sessions_df = sessions_df[SESSION_COLUMNS]
+        with self.lock, self._connect() as connection:
+            connection.execute('DELETE FROM session_keywords')
+            connection.execute('DELETE FROM sessions')
+            connection.executemany('INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?)', self._session_rows(sessions_df))
+            connection.executemany('INSERT INTO session_keywords VALUES (?, ?, ?)', self._keyword_rows(sessions_df))
+            self._bump_version(connection, 'sessions')
+
+    def _next_session_id(self, connection):
+        # The ID after the largest one in the table, or after the last reserved ID if that is larger
+        return connection.execute(
+            "SELECT MAX(COALESCE((SELECT MAX(session_id) FROM sessions), 0) + 1, "
+            "COALESCE((SELECT CAST(value AS INTEGER) FROM metadata WHERE key = 'next_session_id'), 1))").fetchone()[0]
+
+    def reserve_session_ids(self, count):
+        with self.lock, self._connect() as connection:
+            first_id = self._next_session_id(connection)
+            connection.execute("INSERT OR REPLACE INTO metadata VALUES ('next_session_id', ?)",
+                               (str(first_id + count),))
+        return first_id
+
+    def append_session(self, session):
+        """
+        Inserts a single session with the next ID, which follows the largest ID in the primary key index unless IDs
+        have been reserved beyond it
+
+        """
+        with self.lock, self._connect() as connection:
+            session_id = self._next_session_id(connection)
+            connection.execute(
+                'INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?)',
+                (session_id, pd.Timestamp(session['Date']).date().isoformat(), session['Activity group'],
+                 session['Activity name'], session.get('Notes'), _parse_duration(session.get('Duration'))))
+            connection.executemany('INSERT INTO session_keywords VALUES (?, ?, ?)',
+                                   [(session_id, position, keyword) for position, keyword in
+                                    enumerate(parse_keywords(session.get('Keywords')))])
+            self._bump_version(connection, 'sessions')
+
+        return session_id
+
+    def append_sessions(self, sessions_df, import_keys=None, session_ids=None):
+        """
+        Inserts many sessions in a single transaction, along with their import keys if given, and returns their IDs
+
+        """
+        with self.lock, self._connect() as connection:
+            if session_ids is None:
+                first_id = self._next_session_id(connection)
+                session_ids = np.arange(first_id, first_id + sessions_df.shape[0])
+            rows_df = sessions_df[SESSION_COLUMNS].set_axis(pd.Index(session_ids, name='Session ID'))
+            connection.executemany('INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?)', self._session_rows(rows_df))
+            connection.executemany('INSERT INTO session_keywords VALUES (?, ?, ?)', self._keyword_rows(rows_df))
+            if import_keys is not None:
+                connection.executemany('INSERT INTO imported_activities VALUES (?)',
+                                       ((int(import_key),) for import_key in import_keys))
+            self._bump_version(connection, 'sessions')
+
+        return session_ids
+
+    def read_import_keys(self):
+        with self._connect() as connection:
+            rows = connection.execute('SELECT import_key FROM imported_activities').fetchall()
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    def write_import_keys(self, import_keys):
+        with self.lock, self._connect() as connection:
+            connection.execute('DELETE FROM imported_activities')
+            connection.executemany('INSERT INTO imported_activities VALUES (?)',
+                                   ((int(import_key),) for import_key in import_keys))
+
+    def compact_sessions(self):
+        with self.lock, self._connect() as connection:
+            connection.execute('VACUUM')
+
+    def write_goals(self, goals_df):
+        rows = ((int(goal_id), pd.Timestamp(row[0]).date().isoformat(), pd.Timestamp(row[1]).date().isoformat(),
+                 row[2], int(row[3]), row[4], row[5], int(row[6]))
+                for goal_id, row in zip(goals_df.index, goals_df[GOAL_COLUMNS].itertuples(index=False)))
+        with self.lock, self._connect() as connection:
+            connection.execute('DELETE FROM goals')
+            connection.executemany('INSERT INTO goals VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._bump_version(connection, 'goals')
+
+    def read_goal_status(self):
+        with self._connect() as connection:
+            fingerprint = connection.execute(
+                "SELECT value FROM metadata WHERE key = 'goal_status_fingerprint'").fetchone()
+            if fingerprint is None:
+                return None
+            status_df = pd.read_sql_query('SELECT * FROM goal_status ORDER BY goal_id', connection,
+                                          index_col='goal_id')
+
+        status_df = status_df.rename(columns={'progress': 'Progress', 'satisfied': 'Satisfied',
+                                              'finalized': 'Finalized'})
+        status_df.index.name = None
+        status_df[['Satisfied', 'Finalized']] = status_df[['Satisfied', 'Finalized']].astype(bool)
+
+        return json.loads(fingerprint[0]), status_df[GOAL_STATUS_COLUMNS]
+
+    def goal_status_fingerprint(self):
+        with self._connect() as connection:
+            fingerprint = connection.execute(
+                "SELECT value FROM metadata WHERE key = 'goal_status_fingerprint'").fetchone()
+        return None if fingerprint is None else json.loads(fingerprint[0])
+
+    def _goal_status_rows(self, status_df):
+        return ((int(goal_id), int(progress), bool(satisfied), bool(finalized))
+                for goal_id, progress, satisfied, finalized in
+                zip(status_df.index, *(status_df[column] for column in GOAL_STATUS_COLUMNS)))
+
+    def _set_goal_status_fingerprint(self, connection, fingerprint):
+        connection.execute("INSERT OR REPLACE INTO metadata VALUES ('goal_status_fingerprint', ?)",
+                           (json.dumps(fingerprint),))
+
+    def write_goal_status(self, fingerprint, status_df):
+        with self.lock, self._connect() as connection:
+            connection.execute('DELETE FROM goal_status')
+            connection.executemany('INSERT INTO goal_status VALUES (?, ?, ?, ?)', self._goal_status_rows(status_df))
+            self._set_goal_status_fingerprint(connection, fingerprint)
+
+    def update_goal_status(self, fingerprint, updates_df, status_function):
+        # Only the rows of the changed goals are replaced, so the full status is never needed
+        with self.lock, self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO goal_status VALUES (?, ?, ?, ?)',
+                                   self._goal_status_rows(updates_df))
+            self._set_goal_status_fingerprint(connection, fingerprint)
+
+    def read_rollup(self):
+        with self._connect() as connection:
+            fingerprint = connection.execute(
+                "SELECT value FROM metadata WHERE key = 'rollup_fingerprint'").fetchone()
+            if fingerprint is None:
+                return None
+            with phase('load'):
+                rollup_df = pd.read_sql_query('SELECT * FROM daily_rollup', connection, parse_dates=['date'])
+
+        rollup_df.columns = ROLLUP_COLUMNS
+
+        return json.loads(fingerprint[0]), rollup_df
+
+    def rollup_fingerprint(self):
+        with self._connect() as connection:
+            fingerprint = connection.execute(
+                "SELECT value FROM metadata WHERE key = 'rollup_fingerprint'").fetchone()
+        return None if fingerprint is None else json.loads(fingerprint[0])
+
+    def _set_rollup_fingerprint(self, connection, fingerprint):
+        connection.execute("INSERT OR REPLACE INTO metadata VALUES ('rollup_fingerprint', ?)", (json.dumps(fingerprint),))
+
+    def _rollup_rows(self, rollup_df):
+        return ((pd.Timestamp(date).date().isoformat(), int(level), identifier, int(count))
+                for date, level, identifier, count in rollup_df[ROLLUP_COLUMNS].itertuples(index=False))
+
+    def write_rollup(self, fingerprint, rollup_df):
+        with self.lock, self._connect() as connection:
+            connection.execute('DELETE FROM daily_rollup')
+            connection.executemany('INSERT INTO daily_rollup VALUES (?, ?, ?, ?)', self._rollup_rows(rollup_df))
+            self._set_rollup_fingerprint(connection, fingerprint)
+
+    def add_to_rollup(self, fingerprint, increments_df, rollup_function):
+        # The increments are added to the rows of their cells, so the table never grows beyond the cells of the rollup
+        # and it never has to be rewritten
+        with self.lock, self._connect() as connection:
+            connection.executemany('INSERT INTO daily_rollup VALUES (?, ?, ?, ?) ON CONFLICT (date, level, identifier) '
+                                   'DO UPDATE SET count = count + excluded.count', self._rollup_rows(increments_df))
+            self._set_rollup_fingerprint(connection, fingerprint)
+
+
+def get_backend(name=None):
+    """
+    Returns the storage backend to use. The backend can be chosen with the PRODUCTIVITY_STORAGE environment variable
+    ('csv' or 'sqlite'), with the CSV files being the default
+
+    """
+    name = name or os.environ.get('PRODUCTIVITY_STORAGE', 'csv')
+    if name == 'csv':
+        return CsvBackend(os.environ.get('PRODUCTIVITY_SESSION_LOG', SESSION_LOG_PATH),
+                          os.environ.get('PRODUCTIVITY_PERIOD_GOALS', PERIOD_GOALS_PATH))
+    elif name == 'sqlite':
+        return SqliteBackend(os.environ.get('PRODUCTIVITY_DATABASE', DATABASE_PATH))
+
+    raise ValueError(f"Unknown storage backend '{name}', expected 'csv' or 'sqlite'")
+
+
+def partition_backend(directory, name=None):
+    """
+    Returns the storage backend for a data partition, i.e. a directory holding the data of a single user in the same
+    files as the app uses by default (the two CSV files, or a SQLite database). The backend is chosen in the same way
+    as in get_backend. The directory and empty data files are created the first time a partition is used
+
+    """
+    name = name or os.environ.get('PRODUCTIVITY_STORAGE', 'csv')
+    os.makedirs(directory, exist_ok=True)
+    if name == 'csv':
+        backend = CsvBackend(os.path.join(directory, SESSION_LOG_PATH), os.path.join(directory, PERIOD_GOALS_PATH))
+        with backend.lock:
+            if not os.path.exists(backend.session_path):
+                backend.write_sessions(pd.DataFrame(columns=SESSION_COLUMNS, index=pd.Index([], name='Session ID')))
+            if not os.path.exists(backend.goals_path):
+                backend.write_goals(pd.DataFrame(columns=GOAL_COLUMNS))
+        return backend
+    elif name == 'sqlite':
+        return SqliteBackend(os.path.join(directory, DATABASE_PATH))
+
+    raise ValueError(f"Unknown storage backend '{name}', expected 'csv' or 'sqlite'")
+
+
+def migrate(source, target):
+    """
+    Copies all sessions and goals from one backend to another, e.g. from the CSV files into a new SQLite database. The
+    import keys of the imported activities are copied as well, so they aren't imported again
+
+    """
+    sessions_df = source.read_sessions()
+    goals_df = source.read_goals()
+
+    target.write_sessions(sessions_df)
+    target.write_import_keys(source.read_import_keys())
+    target.write_goals(goals_df)
+
+    return sessions_df.shape[0], goals_df.shape[0]
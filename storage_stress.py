@@ -0,0 +1,113 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+from categorical import SessionTable
+from data_store import DataStore, sessions_fingerprint
+from rollup import DailyRollup
+from storage import CsvBackend, SqliteBackend, migrate
+
+
+def make_backend(name, directory):
+    if name == 'csv':
+        return CsvBackend(os.path.join(directory, 'Session_log.csv'), os.path.join(directory, 'Period_goals.csv'))
+    return SqliteBackend(os.path.join(directory, 'productivity.db'))
+
+
+def save_sessions(name, directory, worker, count, write_behind=False):
+    # Each worker has its own store, just like each gunicorn worker process importing app.py. Reads are mixed in with
+    # the saves so the workers keep picking up each other's sessions
+    store = DataStore(make_backend(name, directory), write_behind=write_behind)
+    session_ids = []
+    for number in range(count):
+        session_ids.append(store.add_session({'Date': pd.Timestamp('2025-03-01') + pd.Timedelta(days=number % 30),
+                                              'Activity group': 'Exercise', 'Activity name': 'Climbing',
+                                              'Keywords': ['Lead climbing'] if number % 2 else [],
+                                              'Notes': f'Worker {worker}, session {number}', 'Duration': ''}))
+        if number % 5 == 0:
+            store.goal_status()
+            store.session_page(1, 15)
+    # The pool doesn't let its processes exit normally, so the sessions still queued in write-behind mode are written
+    # here, as they would be when a gunicorn worker shuts down
+    store.flush()
+    return session_ids
+
+
+def sorted_rollup(rollup):
+    return rollup.to_long().sort_values(['Date', 'Level', 'Identifier'], ignore_index=True)
+
+
+def check(name, directory, initial_count, session_ids):
+    backend = make_backend(name, directory)
+    sessions_df = backend.read_sessions()
+    problems = []
+
+    if len(set(session_ids)) != len(session_ids):
+        problems.append('the same session ID was given out more than once')
+    if not sessions_df.index.is_unique:
+        problems.append('the session log has duplicate session IDs')
+    if sessions_df.shape[0] != initial_count + len(session_ids):
+        problems.append(f'the session log has {sessions_df.shape[0]} sessions, expected '
+                        f'{initial_count + len(session_ids)}')
+    if not set(session_ids) <= set(sessions_df.index):
+        problems.append('saved sessions are missing from the session log')
+
+    # The persisted rollup may be behind if the last save came from a process whose cache was out of date, in which
+    # case it is rebuilt on the next read. If its fingerprint says it is up to date though, it has to match the log
+    sessions = SessionTable.from_frame(sessions_df)
+    expected = sorted_rollup(DailyRollup.from_sessions(sessions))
+    persisted = backend.read_rollup()
+    if persisted is not None and persisted[0] == sessions_fingerprint(sessions):
+        if not sorted_rollup(DailyRollup.from_long(persisted[1])).equals(expected):
+            problems.append('the persisted rollup does not match the session log')
+    if not sorted_rollup(DataStore(backend, write_behind=False).rollup()).equals(expected):
+        problems.append('the rollup loaded by a new process does not match the session log')
+
+    return sessions_df.shape[0], problems
+
+
+if __name__ == '__main__':
+    """
+    This script can be run to check that the storage holds up when the app runs in several processes, e.g. under
+    gunicorn with multiple workers. A copy of the data is made in a temporary directory, and a number of processes
+    then save sessions to it at the same time. Afterwards every saved session should be in the log exactly once, and
+    the persisted rollup should match the log. With --write-behind the processes queue their sessions and write them
+    in batches (see write_behind.py)
+    """
+    parser = argparse.ArgumentParser(description='Save sessions from several processes at once and check the result')
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv', help='Storage backend to test')
+    parser.add_argument('--workers', type=int, default=4, help='Number of processes saving sessions')
+    parser.add_argument('--sessions', type=int, default=50, help='Number of sessions saved by each process')
+    parser.add_argument('--write-behind', action='store_true', help='Queue the sessions and write them in batches')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        source = CsvBackend()
+        if args.backend == 'csv':
+            shutil.copy(source.session_path, directory)
+            shutil.copy(source.goals_path, directory)
+        else:
+            migrate(source, make_backend('sqlite', directory))
+        initial_count = make_backend(args.backend, directory).read_sessions().shape[0]
+
+        with multiprocessing.Pool(args.workers) as pool:
+            results = pool.starmap(save_sessions, [(args.backend, directory, worker, args.sessions, args.write_behind)
+                                                   for worker in range(args.workers)])
+        session_ids = [session_id for worker_ids in results for session_id in worker_ids]
+
+        final_count, problems = check(args.backend, directory, initial_count, session_ids)
+    finally:
+        shutil.rmtree(directory)
+
+    print(f'{args.workers} processes saved {len(session_ids)} sessions, the log went from {initial_count} to '
+          f'{final_count} sessions')
+    for problem in problems:
+        print(f'FAILED: {problem}')
+    if problems:
+        raise SystemExit(1)
+    print('OK')
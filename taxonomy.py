@@ -0,0 +1,24 @@
+# The activities that can be logged in the app. Activity groups map to their subactivities, and subactivities map to
+# the highlights (keywords) that can be ticked off for a session. Ordering here defines the ordering in the app, and the
+# first subactivity of each group is the one selected by default
+
+SUBACTIVITIES = {'Exercise': ['Climbing', 'Running', 'Strength', 'Cross-country skiing', 'Cycling'],
+                 'Technical': ['Technical skills'],
+                 'Culture': ['Reading', 'Languages']}
+
+HIGHLIGHTS = {'Climbing': ['Lead climbing', 'Toprope climbing', 'Bouldering'],
+              'Running': ['Base', 'Tempo', 'Intervals'],
+              'Strength': ['Bench press', 'Deadlifts', 'Squats'],
+              'Cross-country skiing': ['Classic', 'Skate'],
+              'Cycling': [],
+              'Technical skills': ['Personal projects', 'Technical books', 'Courses'],
+              'Reading': ['Fiction', 'Non-fiction'],
+              'Languages': []}
+
+
+def all_highlights():
+    """
+    Returns the full highlight vocabulary, in the order the highlights are defined
+
+    """
+    return [highlight for highlights in HIGHLIGHTS.values() for highlight in highlights]
@@ -0,0 +1,194 @@
+import atexit
+import glob
+import itertools
+import json
+import logging
+import os
+import threading
+import weakref
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Sessions saved from the app are only queued and journaled, and written to storage in batches by a background thread,
+# if this is set. How often the queued sessions are written (in seconds), and how many sessions may be queued before
+# they are written right away, can be set as well
+WRITE_BEHIND = bool(os.environ.get('PRODUCTIVITY_WRITE_BEHIND'))
+FLUSH_INTERVAL = float(os.environ.get('PRODUCTIVITY_FLUSH_INTERVAL', 1))
+FLUSH_SIZE = int(os.environ.get('PRODUCTIVITY_FLUSH_SIZE', 100))
+
+# Number of session IDs reserved in storage at a time for the queued sessions
+ID_BLOCK = 64
+
+logger = logging.getLogger(__name__)
+
+# Numbers the journals of this process, as a process can have several stores for the same data, and the journals that
+# are open, which are closed when the process exits
+_journal_numbers = itertools.count()
+_open_journals = weakref.WeakSet()
+
+
+class SessionJournal:
+    """
+    Journal of the sessions queued by one data store, one JSON record per line holding the ID given to the session and
+    the session itself. Each record is synced to disk before the save is acknowledged, which only takes appending a
+    line rather than writing to the storage backend. The journal is cleared once the queued sessions have been written
+    to storage.
+
+    The journal is locked for as long as the process that writes it is running, so a journal that isn't locked was left
+    behind by a crash, and its sessions are written to storage by the next store opened on the same data (see
+    orphaned_journals). On platforms without fcntl every journal found when a store is opened is taken to be left behind
+
+    """
+    def __init__(self, base_path):
+        self.pid = os.getpid()
+        self.path = f'{base_path}.{self.pid}-{next(_journal_numbers)}'
+
+        # The journal is created and locked under a name journal_paths doesn't match, and only then renamed, as another
+        # process could otherwise lock it in between, take it to be left behind and remove it
+        directory, name = os.path.split(self.path)
+        creating_path = os.path.join(directory, f'.{name}.new')
+        try:
+            # Left behind by a process that crashed while creating its journal and had the same process ID
+            os.remove(creating_path)
+        except FileNotFoundError:
+            pass
+        self._file = os.fdopen(os.open(creating_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666), 'w')
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        os.rename(creating_path, self.path)
+        self._records = 0
+        _open_journals.add(self)
+
+    def append(self, session_id, session):
+        self._file.write(json.dumps({'id': session_id, 'session': session}, default=str) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records += 1
+
+    def clear(self):
+        self._file.truncate(0)
+        self._file.seek(0)
+        os.fsync(self._file.fileno())
+        self._records = 0
+
+    def close(self):
+        # A journal still holding sessions is kept, so that they are written to storage later
+        if self._file.closed or os.getpid() != self.pid:
+            return
+        if self._records == 0:
+            os.remove(self.path)
+        self._file.close()
+
+
+def _read_journal(journal_file):
+    records = []
+    for line in journal_file:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # The last record may have been cut off by the crash, in which case the save was never acknowledged
+            break
+        records.append((record['id'], record['session']))
+    return records
+
+
+def journal_paths(base_path):
+    """
+    Paths of the journals of the data at base_path, of running processes as well as of ones that are gone
+
+    """
+    return sorted(glob.glob(glob.escape(base_path) + '.*'))
+
+
+def orphaned_journals(base_path):
+    """
+    Yields the path and the records of each journal of the data left behind by a process that is no longer running.
+    The journal stays locked while the caller writes its sessions to storage, and is removed when the caller moves on
+    to the next one
+
+    """
+    for path in journal_paths(base_path):
+        try:
+            journal_file = open(path)
+        except FileNotFoundError:
+            continue
+        with journal_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(journal_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+            yield path, _read_journal(journal_file)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# Stores with queued sessions, which are kept alive until their sessions have been written, and the thread writing
+# them. The thread is woken up early once a store has more than FLUSH_SIZE sessions queued
+_condition = threading.Condition()
+_queued_stores = set()
+_flush_requested = False
+_flush_thread = None
+
+
+def schedule_flush(store, now=False):
+    """
+    Makes sure the queued sessions of a data store are written within FLUSH_INTERVAL seconds, or as soon as possible if
+    now is set. This starts the background thread writing them when first needed
+
+    """
+    global _flush_requested, _flush_thread
+    with _condition:
+        _queued_stores.add(store)
+        if _flush_thread is None or not _flush_thread.is_alive():
+            _flush_thread = threading.Thread(target=_flush_loop, name='write-behind', daemon=True)
+            _flush_thread.start()
+        if now:
+            _flush_requested = True
+            _condition.notify()
+
+
+def _flush_loop():
+    global _flush_requested
+    while True:
+        with _condition:
+            _condition.wait_for(lambda: _flush_requested, FLUSH_INTERVAL)
+            _flush_requested = False
+            stores = list(_queued_stores)
+            _queued_stores.clear()
+        flush_stores(stores)
+
+
+def flush_stores(stores):
+    """
+    Writes the queued sessions of the stores to storage. A store that fails to write them keeps them queued, and is
+    tried again after the next interval
+
+    """
+    for store in stores:
+        try:
+            store.flush()
+        except Exception:
+            logger.exception('Writing the queued sessions to storage failed, retrying in %s seconds', FLUSH_INTERVAL)
+            with _condition:
+                _queued_stores.add(store)
+
+
+def _flush_at_exit():
+    with _condition:
+        stores = list(_queued_stores)
+        _queued_stores.clear()
+    flush_stores(stores)
+    for journal in list(_open_journals):
+        journal.close()
+
+
+atexit.register(_flush_at_exit)
+# The condition is held while forking (background callbacks run in forked processes), so the child never starts with
+# it taken by a thread that doesn't exist there
+os.register_at_fork(before=_condition.acquire, after_in_parent=_condition.release, after_in_child=_condition.release)